@@ -0,0 +1,5 @@
+"""
+Benchmarks of the orchestration layer of the simulator (runners, staging,
+logging and batches), run against the stand-in tools of
+simulator.utils.test_helpers.StubTools. Run them with python -m benchmarks.
+"""
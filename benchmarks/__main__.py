@@ -0,0 +1,64 @@
+import argparse
+import json
+import tempfile
+
+from .batch_scaling import batch_scaling
+from .log_pump import log_pump
+from .orchestration import run_overhead
+from .staging import staging_io
+
+
+_suites = {
+    "orchestration": run_overhead,
+    "staging": staging_io,
+    "log_pump": log_pump,
+    "batch_scaling": batch_scaling,
+}
+
+
+def run_benchmarks(suites, workers=None, output=None):
+    results = {}
+    for suite in suites:
+        kwargs = {"max_workers": workers} if suite == "batch_scaling" else {}
+        with tempfile.TemporaryDirectory() as folder:
+            results[suite] = _suites[suite](folder, **kwargs)
+        print(json.dumps({suite: results[suite]}, indent=4))
+
+    if output:
+        with open(output, "w+") as f:
+            json.dump(results, f, indent=4)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        "python -m benchmarks",
+        description="Benchmarks of the orchestration layer of the "
+        "simulator, run against stand-in tools",
+    )
+    parser.add_argument(
+        "suites",
+        nargs="*",
+        help="Benchmarks to run, among {}, default : all of them".format(
+            ", ".join(_suites)
+        ),
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        required=False,
+        help="Largest number of workers of the batch scaling benchmark",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        required=False,
+        help="Json file in which to write the results",
+    )
+
+    args = parser.parse_args()
+    unknown = [s for s in args.suites if s not in _suites]
+    if unknown:
+        parser.error("unknown benchmarks : {}".format(", ".join(unknown)))
+    run_benchmarks(args.suites or list(_suites), args.workers, args.output)
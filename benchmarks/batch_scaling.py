@@ -0,0 +1,78 @@
+from os import cpu_count, path
+import time
+
+from simulator.runner import SimulationRunner
+from simulator.utils.test_helpers import StubTools
+
+from .common import make_inputs
+
+
+def batch_scaling(folder, max_workers=None, sleep=0.5, jobs_per_worker=2):
+    """
+    Measures the wall time of a batch of runs as the number of workers
+    grows, with stand-ins taking a fixed time
+
+    Parameters
+    ----------
+    folder : str
+        Folder in which to write the inputs and outputs
+    max_workers : int, optional
+        Largest number of workers measured, the batch being run with 1, 2,
+        4, ... up to this many workers, default : min(cpu count, 8)
+    sleep : float, optional
+        Running time of every stand-in, default : 0.5
+    jobs_per_worker : int, optional
+        Number of jobs in the batch per worker at max_workers, default : 2
+
+    Returns
+    -------
+    dict
+        For every number of workers, the wall time of the batch, the
+        speedup over a single worker and the parallel efficiency
+
+    """
+    max_workers = max_workers if max_workers else min(cpu_count(), 8)
+    stubs = StubTools(
+        path.join(folder, "stubs"),
+        voxsim_profile={"sleep": sleep},
+        fiberfox_profile={"sleep": sleep},
+    ).install()
+    geometry_infos, simulation_infos = make_inputs(
+        path.join(folder, "inputs"), resolution=(16, 16, 16), n_dirs=6
+    )
+    runner = SimulationRunner(stubs.get_config("local"))
+    n_jobs = max_workers * jobs_per_worker
+
+    workers = sorted(
+        {min(2 ** i, max_workers) for i in range(max_workers.bit_length())}
+        | {max_workers}
+    )
+    results = {}
+    for n_workers in workers:
+        jobs = [
+            {
+                "run_name": "job{}".format(i),
+                "phantom_infos": geometry_infos,
+                "simulation_infos": simulation_infos,
+                "output_folder": path.join(
+                    folder, "w{}".format(n_workers), "job{}".format(i)
+                ),
+                "inter_axonal_fraction": 0.3,
+            }
+            for i in range(n_jobs)
+        ]
+        start = time.perf_counter()
+        failed = [
+            r for r in runner.run_batch(jobs, n_workers) if not r.succeeded
+        ]
+        wall = time.perf_counter() - start
+        if failed:
+            raise failed[0].exception
+
+        results[n_workers] = {"wall": wall}
+
+    for n_workers, result in results.items():
+        result["speedup"] = results[1]["wall"] / result["wall"]
+        result["efficiency"] = result["speedup"] / n_workers
+
+    return results
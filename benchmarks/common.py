@@ -0,0 +1,99 @@
+from contextlib import contextmanager
+import time
+
+import numpy as np
+
+from simulator.factory import GeometryFactory, SimulationFactory
+
+
+def make_inputs(folder, name="bench", resolution=(32, 32, 32), n_dirs=30):
+    """
+    Generates a geometry with one bundle and a simulation of its intra,
+    inter and two extra axonal compartments
+
+    Parameters
+    ----------
+    folder : str
+        Folder in which to write the configuration files
+    name : str, optional
+        Name of the configuration files, default : "bench"
+    resolution : tuple(int), optional
+        Resolution of the phantom and of the simulation,
+        default : (32, 32, 32)
+    n_dirs : int, optional
+        Number of gradient directions simulated, default : 30
+
+    Returns
+    -------
+    tuple(GeometryInfos, SimulationInfos)
+        Geometry and simulation configurations
+
+    """
+    resolution, spacing = list(resolution), [2, 2, 2]
+    geometry_handler = GeometryFactory.get_geometry_handler(resolution, spacing)
+    bundle = GeometryFactory.create_bundle(
+        2, 1, 5, [[1, 0, 0], [0.5, 0, 0], [0, 0, 0]]
+    )
+    meta = GeometryFactory.create_cluster_meta(
+        3, 1000, 1, [0.5, 0, 0], [[0, 1], [0, 1], [0, 1]]
+    )
+    geometry_handler.add_cluster(
+        GeometryFactory.create_cluster(meta, [bundle], [0.5, 0, 0])
+    )
+    geometry_infos = geometry_handler.generate_json_configuration_files(
+        name, folder
+    )
+
+    Type = SimulationFactory.CompartmentType
+    compartments = [
+        SimulationFactory.generate_fiber_stick_compartment(
+            1.7e-3, 900, 80, Type.INTRA_AXONAL
+        ),
+        SimulationFactory.generate_fiber_stick_compartment(
+            1.0e-3, 900, 80, Type.INTER_AXONAL
+        ),
+        SimulationFactory.generate_extra_ball_compartment(
+            3e-3, 4000, 2000, Type.EXTRA_AXONAL_1
+        ),
+        SimulationFactory.generate_extra_ball_compartment(
+            2e-3, 4000, 2000, Type.EXTRA_AXONAL_2
+        ),
+    ]
+    simulation_handler = SimulationFactory.get_simulation_handler(
+        geometry_handler, compartments
+    )
+    simulation_handler.set_acquisition_profile(
+        SimulationFactory.generate_acquisition_profile(100, 1000, 1)
+    )
+    directions = np.random.default_rng(0).normal(size=(n_dirs, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, None]
+    simulation_handler.set_gradient_profile(
+        SimulationFactory.generate_gradient_profile(
+            [1000] * n_dirs, directions.tolist()
+        )
+    )
+    simulation_infos = simulation_handler.generate_xml_configuration_file(
+        name + "_simulation", folder
+    )
+
+    return geometry_infos, simulation_infos
+
+
+@contextmanager
+def timer(timings, key):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[key] = timings.get(key, 0.0) + time.perf_counter() - start
+
+
+def summarize(values):
+    values = np.asarray(values, dtype=float)
+    return {
+        "mean": float(np.mean(values)),
+        "min": float(np.min(values)),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "max": float(np.max(values)),
+    }
@@ -0,0 +1,99 @@
+from os import makedirs, path
+import re
+import threading
+import time
+
+from simulator.runner.simulation_runner import AsyncRunner
+from simulator.utils.test_helpers import StubTools
+
+from .common import summarize
+
+
+_STAMP = re.compile(r"\[STUB\] line \d+ at ([0-9.]+)")
+
+
+class _LogWatcher(threading.Thread):
+    """Records the delay between the writing of the lines of the stand-in
+    and their appearance in the log file"""
+
+    def __init__(self, log_file, period=1e-3):
+        super().__init__(daemon=True)
+        self._log_file = log_file
+        self._period = period
+        self._done = threading.Event()
+        self.latencies = []
+
+    def run(self):
+        offset, remainder = 0, ""
+        while not self._done.is_set():
+            if path.exists(self._log_file):
+                with open(self._log_file) as f:
+                    f.seek(offset)
+                    content = f.read()
+                    offset = f.tell()
+                now = time.time()
+                lines = (remainder + content).split("\n")
+                remainder = lines.pop()
+                for line in lines:
+                    match = _STAMP.search(line)
+                    if match:
+                        self.latencies.append(now - float(match.group(1)))
+            time.sleep(self._period)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def log_pump(folder, n_lines=(100, 10000), duration=1.0):
+    """
+    Measures the latency and throughput of the relay of the output of the
+    commands to the log files
+
+    Parameters
+    ----------
+    folder : str
+        Folder in which to write the stand-ins and logs
+    n_lines : tuple(int), optional
+        Numbers of lines written by the stand-in, default : (100, 10000)
+    duration : float, optional
+        Time over which the stand-in spreads its lines, 0 to write them
+        all at once, default : 1.0
+
+    Returns
+    -------
+    dict
+        For every number of lines, the wall time of the command, the
+        throughput in lines per second and statistics of the latency of
+        the lines
+
+    """
+    results = {}
+    for lines in n_lines:
+        stubs = StubTools(
+            path.join(folder, "stubs{}".format(lines)),
+            voxsim_profile={"sleep": duration, "log_lines": lines},
+        ).install()
+        output = path.join(folder, "out{}".format(lines))
+        makedirs(output, exist_ok=True)
+        log_file = path.join(output, "pump.log")
+        command = "{} -f none -r 2,2,2 -s 1,1,1 -o {} --nii".format(
+            stubs.voxsim_exec, path.join(output, "pump")
+        )
+
+        runner, watcher = AsyncRunner(), _LogWatcher(log_file)
+        watcher.start()
+        start = time.perf_counter()
+        runner._run_command(command, log_file, "[PUMP]")
+        wall = time.perf_counter() - start
+        time.sleep(0.01)
+        watcher.stop()
+        runner.stop()
+
+        results[lines] = {
+            "wall": wall,
+            "throughput": lines / wall,
+            "latency": summarize(watcher.latencies),
+        }
+
+    return results
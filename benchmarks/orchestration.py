@@ -0,0 +1,78 @@
+from os import path
+import time
+
+from simulator.runner import SimulationRunner
+from simulator.utils.test_helpers import StubTools
+
+from .common import make_inputs, summarize
+
+
+class _TimedRunner(SimulationRunner):
+    """Runner accounting for the time spent running commands"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.command_time = 0.0
+
+    def _run_commands(self, commands, max_concurrent=None, timeout=None):
+        start = time.perf_counter()
+        try:
+            return super()._run_commands(commands, max_concurrent, timeout)
+        finally:
+            self.command_time += time.perf_counter() - start
+
+
+def run_overhead(folder, n_runs=5, resolution=(32, 32, 32), n_dirs=30):
+    """
+    Measures the time a run spends outside of the tools it launches, for
+    every backend able to run the stand-ins
+
+    Parameters
+    ----------
+    folder : str
+        Folder in which to write the inputs and outputs
+    n_runs : int, optional
+        Number of runs per backend, default : 5
+    resolution : tuple(int), optional
+        Resolution of the phantom, default : (32, 32, 32)
+    n_dirs : int, optional
+        Number of gradient directions, default : 30
+
+    Returns
+    -------
+    dict
+        For every backend, statistics of the wall time of the runs, of the
+        time spent in the commands they launched (including the startup of
+        the stand-ins) and of the time spent in python around them
+
+    """
+    stubs = StubTools(path.join(folder, "stubs")).install()
+    geometry_infos, simulation_infos = make_inputs(
+        path.join(folder, "inputs"), resolution=resolution, n_dirs=n_dirs
+    )
+
+    results = {}
+    for backend in ["local", "singularity"]:
+        runner = _TimedRunner(stubs.get_config(backend))
+        totals, commands = [], []
+        for i in range(n_runs):
+            runner.command_time = 0.0
+            start = time.perf_counter()
+            runner.run(
+                "run{}".format(i),
+                geometry_infos,
+                simulation_infos,
+                path.join(folder, backend),
+                inter_axonal_fraction=0.3,
+            )
+            totals.append(time.perf_counter() - start)
+            commands.append(runner.command_time)
+        runner.stop()
+
+        results[backend] = {
+            "total": summarize(totals),
+            "commands": summarize(commands),
+            "python": summarize([t - c for t, c in zip(totals, commands)]),
+        }
+
+    return results
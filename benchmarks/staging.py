@@ -0,0 +1,69 @@
+from os import path
+import time
+
+from simulator.runner import SimulationRunner
+from simulator.runner.datastore import Datastore
+from simulator.utils.test_helpers import StubTools
+
+from .common import make_inputs
+
+
+def staging_io(folder, resolution=(64, 64, 64), output_nifti=True):
+    """
+    Measures the time taken to prepare and stage the compartment maps of a
+    phantom, for every staging mode
+
+    Parameters
+    ----------
+    folder : str
+        Folder in which to write the inputs and outputs
+    resolution : tuple(int), optional
+        Resolution of the phantom, default : (64, 64, 64)
+    output_nifti : bool, optional
+        Use nifti maps instead of nrrd, default : True
+
+    Returns
+    -------
+    dict
+        For every staging mode, the time taken to generate the maps and to
+        stage them, the bytes staged by each mode and the throughput
+
+    """
+    stubs = StubTools(path.join(folder, "stubs")).install()
+    geometry_infos, simulation_infos = make_inputs(
+        path.join(folder, "inputs"), resolution=resolution, n_dirs=1
+    )
+    runner = SimulationRunner(stubs.get_config("local"))
+    runner.generate_phantom(
+        "bench", geometry_infos, folder, output_nifti=output_nifti
+    )
+    phantom_folder = path.join(folder, "phantom")
+
+    results = {}
+    for mode in Datastore.StagingMode:
+        if mode is Datastore.StagingMode.AUTO:
+            continue
+
+        datastore = Datastore(
+            runner._create_outputs(path.join(folder, mode.value)),
+            path.join(phantom_folder, "bench_phantom_merged_bundles.fib"),
+            simulation_infos["compartment_ids"],
+            0.3,
+            mode,
+        )
+        start = time.perf_counter()
+        datastore.load_compartments(phantom_folder, "bench", output_nifti)
+        loaded = time.perf_counter()
+        datastore.stage_compartments("bench")
+        staged = time.perf_counter()
+
+        size = sum(datastore.staging_stats.values())
+        results[mode.value] = {
+            "generate": loaded - start,
+            "stage": staged - loaded,
+            "bytes": dict(datastore.staging_stats),
+            "throughput": size / max(staged - start, 1e-9),
+        }
+        datastore.unload()
+
+    return results
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+
+from simulator.runner import SimulationRunner
+from simulator.runner.mpi import MPICampaign
+
+
+def run_campaign(campaign_file, summary_file=None):
+    campaign = MPICampaign(SimulationRunner())
+    if not campaign.is_root:
+        campaign.run()
+        return
+
+    with open(campaign_file) as f:
+        jobs = json.load(f)
+
+    results = campaign.run(jobs)
+
+    summary = [result.to_dict() for result in results]
+    for entry in summary:
+        outcome = entry["error"] if entry["error"] else entry["output"]
+        print("{} : {}".format(entry["run_name"], outcome))
+
+    if summary_file:
+        with open(summary_file, "w+") as f:
+            json.dump(summary, f, indent=4)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        "MPI simulation campaign. Run with mpirun -n <ranks>, rank 0 "
+        "dispatches the jobs to the other ranks"
+    )
+    parser.add_argument(
+        "campaign",
+        type=str,
+        help="Json file containing a list of jobs, each a dict of the "
+        "arguments of SimulationRunner.run (run_name, phantom_infos, "
+        "simulation_infos, output_folder, ...)",
+    )
+    parser.add_argument(
+        "--summary",
+        type=str,
+        required=False,
+        help="Json file in which to write the results of the jobs",
+    )
+
+    args = parser.parse_args()
+    run_campaign(args.campaign, args.summary)
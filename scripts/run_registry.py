@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+
+from simulator.runner.registry import RunRegistry
+
+
+def _parse_criterion(criterion):
+    name, value = criterion.split("=", 1)
+    try:
+        return name, json.loads(value)
+    except ValueError:
+        return name, value
+
+
+def list_runs(registry, criteria, output_json=False, limit=None):
+    columns = {k: v for k, v in criteria.items() if v is not None}
+    parameters = dict(_parse_criterion(p) for p in columns.pop("param", []))
+    runs = registry.query(parameters, limit, **columns)
+
+    if output_json:
+        print(json.dumps(runs, indent=4))
+        return
+
+    for run in runs:
+        print(
+            "{id:>6}  {status:<8}  {run_name:<24}  {key:.12}  {folder}".format(
+                folder=run["output_folder"], **run
+            )
+        )
+
+
+def show_run(registry, run_id):
+    run = registry.get(run_id)
+    if run is None:
+        raise SystemExit("No run {} in {}".format(run_id, registry.path))
+    print(json.dumps(run, indent=4))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        "Queries the registry of the runs of the simulator"
+    )
+    parser.add_argument(
+        "registry", type=str, help="SQLite database of the registry"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = commands.add_parser(
+        "list", help="List the runs matching criteria, most recent first"
+    )
+    list_parser.add_argument("--status", type=str, required=False)
+    list_parser.add_argument("--name", dest="run_name", required=False)
+    list_parser.add_argument("--key", type=str, required=False)
+    list_parser.add_argument("--geometry-key", type=str, required=False)
+    list_parser.add_argument("--simulation-key", type=str, required=False)
+    list_parser.add_argument("--gradients-key", type=str, required=False)
+    list_parser.add_argument(
+        "--param",
+        action="append",
+        default=[],
+        help="Value of a parameter of the runs, given as path=value, where "
+        "path is the json path of the parameter in the parameters of the "
+        "run (e.g. simulation.acquisition.tEcho=100 or "
+        "geometry.resolution[0]=32)",
+    )
+    list_parser.add_argument("--limit", type=int, required=False)
+    list_parser.add_argument(
+        "--json", action="store_true", help="Output the runs as json"
+    )
+
+    show_parser = commands.add_parser(
+        "show", help="Show all the fields of a run"
+    )
+    show_parser.add_argument("id", type=int)
+
+    args = parser.parse_args()
+    run_registry = RunRegistry(args.registry)
+    if args.command == "list":
+        list_runs(
+            run_registry,
+            {
+                "status": args.status,
+                "run_name": args.run_name,
+                "key": args.key,
+                "geometry_key": args.geometry_key,
+                "simulation_key": args.simulation_key,
+                "gradients_key": args.gradients_key,
+                "param": args.param,
+            },
+            args.json,
+            args.limit,
+        )
+    else:
+        show_run(run_registry, args.id)
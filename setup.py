@@ -8,7 +8,9 @@ if __name__ == "__main__":
     setup(
         name="simulation_generator",
         version="1.0.0",
-        packages=find_packages(exclude=("tests", "tests.*")),
+        packages=find_packages(
+            exclude=("tests", "tests.*", "benchmarks", "benchmarks.*")
+        ),
         url="",
         license="",
         author="avcaron",
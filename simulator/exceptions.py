@@ -9,6 +9,7 @@ class SimulationRunnerException(Exception):
         Voxsim = 3
         Finalization = 4
         Default = 5
+        Timeout = 6
 
     def __init__(
         self, message, err_type=ExceptionType.Default, err_code=None, log=None
@@ -55,6 +55,12 @@ class GeometryHandler:
         self._parameters_dict["clusters"].append(cluster)
         return self
 
+    def get_clusters(self):
+        return self._parameters_dict["clusters"]
+
+    def get_spheres(self):
+        return self._parameters_dict["spheres"]
+
     def get_resolution(self):
         return self._parameters_dict["resolution"]
 
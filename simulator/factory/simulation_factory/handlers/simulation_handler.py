@@ -96,3 +96,62 @@ class SimulationHandler:
             output_naming + ".ffp",
             [cmp["ID"] for cmp in self._compartments],
         )
+
+    def generate_sharded_xml_configuration_files(
+        self, output_naming, n_shards, simulation_path=""
+    ):
+        """
+        Generates the configuration of the simulation, along with the ones
+        of shards of it, each simulating a subset of the gradient directions
+        (see GradientProfile.split), which can be simulated concurrently
+        and merged back afterward. Artifacts that depend on the order of
+        the volumes (motion, drift and spikes) cannot be sharded.
+
+        Parameters
+        ----------
+        output_naming : str
+            Name of the configuration file
+        n_shards : int
+            Number of shards in which to split the gradient directions
+        simulation_path : str, optional
+            Folder in which to write the configuration files, default : ""
+
+        Returns
+        -------
+        SimulationInfos
+            Simulation configuration, listing its shards under the "shards"
+            key, each with its configuration file and the indexes of the
+            volumes it simulates
+
+        """
+        artifacts = self._art_model.get_volume_dependent_artifacts()
+        if artifacts:
+            raise ValueError(
+                "Artifacts {} depend on the order of the volumes and cannot "
+                "be simulated in shards".format(", ".join(artifacts))
+            )
+
+        infos = self.generate_xml_configuration_file(
+            output_naming, simulation_path
+        )
+
+        gradient_profile, shards = self._grad_profile, []
+        try:
+            for i, (profile, volumes) in enumerate(
+                gradient_profile.split(n_shards)
+            ):
+                self._grad_profile = profile
+                shard_infos = self.generate_xml_configuration_file(
+                    "{}_shard{}".format(output_naming, i), simulation_path
+                )
+                shards.append(
+                    {
+                        "param_file": shard_infos["param_file"],
+                        "volumes": volumes,
+                    }
+                )
+        finally:
+            self._grad_profile = gradient_profile
+
+        infos.generate_new_key("shards", shards)
+        return infos
@@ -42,10 +42,29 @@ class ArtifactModel(XmlTreeElement):
             "doAddDrift": {"value": False, "drift": 0.06},
         }
 
+    def get_volume_dependent_artifacts(self):
+        """
+        Lists the enabled artifacts that depend on the order of the volumes
+        of the acquisition, such as motion and drift which evolve through
+        the acquisition, and spikes which are drawn over all its volumes
+
+        Returns
+        -------
+        list(str)
+            Names of the enabled volume dependent artifacts
+
+        """
+        return [
+            artifact
+            for artifact in ["doAddMotion", "doAddDrift", "addspikes"]
+            if self._models[artifact]["value"]
+        ]
+
     def dump_to_xml(self, parent_element):
         artifacts_element = SubElement(parent_element, "artifacts")
 
         for artifact, data in self._models.items():
+            data = dict(data)
             self._create_text_element(
                 artifacts_element, artifact, str(data.pop("value")).lower()
             )
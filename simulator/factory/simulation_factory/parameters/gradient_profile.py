@@ -99,12 +99,16 @@ class TensorValuedByParamsType(XmlTreeElement):
 
 
 class GradientProfile(XmlTreeElement):
-    def __init__(self, bvals, bvecs, g_type):
-        self._nominal_bval = (
-            max(bvals)
-            if type(g_type) is StejskalTannerType
-            else g_type.get_bval()
-        )
+    def __init__(self, bvals, bvecs, g_type, nominal_bval=None):
+        self._bvals = list(bvals)
+        self._bvecs = [list(bvec) for bvec in bvecs]
+        self._nominal_bval = nominal_bval
+        if self._nominal_bval is None:
+            self._nominal_bval = (
+                max(bvals)
+                if type(g_type) is StejskalTannerType
+                else g_type.get_bval()
+            )
         self._directions = self._scale_gradients(bvecs, bvals)
         self._num_gradients = self._get_number_of_gradients(self._directions)
         self._gtype = g_type
@@ -124,6 +128,53 @@ class GradientProfile(XmlTreeElement):
             list(filter(lambda d: not isclose(norm(d), 0.0), directions))
         )
 
+    def get_bvals(self):
+        return self._bvals
+
+    def get_bvecs(self):
+        return self._bvecs
+
+    def get_type(self):
+        return self._gtype
+
+    def split(self, n_shards):
+        """
+        Splits the profile into profiles each simulating a subset of the
+        diffusion weighted volumes, dealt in turn to every shard so that
+        all shards sample every shell. Each shard keeps all the b0 volumes
+        of the profile.
+
+        Parameters
+        ----------
+        n_shards : int
+            Number of shards to create
+
+        Returns
+        -------
+        list(tuple(GradientProfile, list(int)))
+            Profile of every shard, along with the indexes in the original
+            profile of the volumes it simulates
+        """
+        b0s = [i for i, d in enumerate(self._directions) if isclose(norm(d), 0)]
+        dwis = [i for i in range(len(self._directions)) if i not in b0s]
+
+        shards = []
+        for shard in range(min(n_shards, len(dwis))):
+            volumes = sorted(b0s + dwis[shard::n_shards])
+            shards.append(
+                (
+                    GradientProfile(
+                        [self._bvals[i] for i in volumes],
+                        [self._bvecs[i] for i in volumes],
+                        self._gtype,
+                        self._nominal_bval,
+                    ),
+                    volumes,
+                )
+            )
+
+        return shards
+
     def dump_to_xml(self, parent_element):
         self._create_text_element(
             parent_element, "bvalue", str(self._nominal_bval)
@@ -0,0 +1,333 @@
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from copy import copy
+import multiprocessing
+from os import cpu_count
+import queue
+import threading
+import time
+import traceback
+
+from .metrics import get_reuses
+from ..exceptions import SimulationRunnerException
+
+
+class BatchJob:
+    """
+    A single simulation of a batch, described by the same parameters
+    as the ones given to SimulationRunner.run
+    """
+
+    def __init__(
+        self,
+        run_name,
+        phantom_infos,
+        simulation_infos,
+        output_folder,
+        **run_kwargs
+    ):
+        """
+        Parameters
+        ----------
+        run_name : str
+            Name given to the run outputs
+        phantom_infos : GeometryInfos or dict
+            Geometry configuration generated by the GeometryHandler
+        simulation_infos : SimulationInfos or dict
+            Simulation configuration generated by the SimulationHandler
+        output_folder : str
+            Folder in which to write the outputs of the run
+        run_kwargs :
+            Named arguments forwarded to SimulationRunner.run
+        """
+        self.run_name = run_name
+        self.phantom_infos = phantom_infos
+        self.simulation_infos = simulation_infos
+        self.output_folder = output_folder
+        self.run_kwargs = run_kwargs
+
+    @classmethod
+    def from_any(cls, job):
+        if isinstance(job, BatchJob):
+            return job
+        if isinstance(job, dict):
+            return cls(**job)
+        return cls(*job)
+
+    def get_arguments(self):
+        return (
+            self.run_name,
+            self.phantom_infos,
+            self.simulation_infos,
+            self.output_folder,
+        )
+
+    def __repr__(self):
+        return "BatchJob({}, {})".format(self.run_name, self.output_folder)
+
+
+class BatchResult:
+    """Outcome of a job executed by the BatchExecutor"""
+
+    def __init__(self, index, job, result=None, exception=None, trace=None):
+        self.index = index
+        self.job = job
+        self.result = result
+        self.exception = exception
+        self.traceback = trace
+        self.metrics = {}
+        self.attempts = 1
+        self.failures = []
+
+    @property
+    def succeeded(self):
+        return self.exception is None
+
+    @property
+    def reused(self):
+        """Tells if the job reused outputs instead of computing them"""
+        return any(self.metrics.get(k) for k in _REUSE_MARKERS)
+
+    @property
+    def computed(self):
+        """
+        Tells if the job succeeded at its first attempt and computed all its
+        outputs, such that its metrics measure a whole run
+        """
+        return self.succeeded and self.attempts == 1 and not self.reused
+
+    @property
+    def error_type(self):
+        if self.exception is None:
+            return None
+        if isinstance(self.exception, SimulationRunnerException):
+            return self.exception.err_type.name
+        return type(self.exception).__name__
+
+    def get(self):
+        """
+        Returns the value returned by the job, or raises the
+        exception that made it fail
+
+        Returns
+        -------
+        object
+            Value returned by SimulationRunner.run
+
+        """
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def to_dict(self):
+        """
+        Describes the outcome of the job with json serializable values
+
+        Returns
+        -------
+        dict
+            Index and name of the job, its output, the type, message and
+            log of the error that made it fail, its number of attempts,
+            the errors of its failed attempts and its metrics
+
+        """
+        return {
+            "index": self.index,
+            "run_name": self.job.run_name,
+            "succeeded": self.succeeded,
+            "output": self.result,
+            "error_type": self.error_type,
+            "error": None if self.succeeded else str(self.exception),
+            "log": getattr(self.exception, "log", None),
+            "attempts": self.attempts,
+            "failures": self.failures,
+            "metrics": self.metrics,
+        }
+
+    def __repr__(self):
+        return "BatchResult({}, {}, {})".format(
+            self.index,
+            self.job.run_name,
+            "success" if self.succeeded else repr(self.exception),
+        )
+
+
+_REUSE_MARKERS = ["cache_hit", "reused", "resumed_stages"]
+_worker = threading.local()
+
+
+def _take_cpu_budget(budgets):
+    _worker.cpu_budget = budgets.get()
+
+
+def execute_job(runner, index, job):
+    """Runs a job, retrying it as allowed by the retry policy of the runner"""
+    if getattr(_worker, "cpu_budget", None) is not None:
+        runner.cpu_budget = _worker.cpu_budget
+
+    retry_policy, attempt, failures = runner.retry_policy, 1, []
+    while True:
+        start = time.perf_counter()
+        try:
+            result = BatchResult(
+                index, job, runner.run(*job.get_arguments(), **job.run_kwargs)
+            )
+        except Exception as e:
+            result = BatchResult(
+                index, job, exception=e, trace=traceback.format_exc()
+            )
+
+        result.attempts, result.failures = attempt, failures
+        result.metrics["run_time"] = time.perf_counter() - start
+        if result.succeeded and runner.last_metrics is not None:
+            result.metrics.update(get_reuses(runner.last_metrics))
+        if (
+            result.succeeded
+            or retry_policy is None
+            or not retry_policy.should_retry(result.exception, attempt)
+        ):
+            return result
+
+        failures.append(
+            {
+                "attempt": attempt,
+                "error_type": result.error_type,
+                "error": str(result.exception),
+            }
+        )
+        retry_policy.wait(attempt)
+        attempt += 1
+
+
+class BatchExecutor:
+    """
+    Executes many simulation jobs concurrently. Each job is run by its own
+    copy of the runner, either in a pool of processes or of threads. When
+    given a cpu budget, every worker of the pool gets an equal share of it
+    for the tools of the jobs it runs.
+
+    When given a runtime model, the jobs are handed to the workers as they
+    free up, longest estimated first, so that the largest jobs do not end
+    up running alone at the end of the batch. The model is updated with
+    the running time of every job that computes all its outputs at its
+    first attempt.
+    """
+
+    def __init__(
+        self,
+        runner,
+        max_workers=None,
+        use_processes=True,
+        cpu_budget=None,
+        runtime_model=None,
+    ):
+        """
+        Parameters
+        ----------
+        runner : SimulationRunner
+            Runner used as template for every job
+        max_workers : int, optional
+            Maximum number of jobs running at the same time,
+            default : number of cpus on the machine
+        use_processes : bool, optional
+            Run the jobs in a process pool instead of a thread pool,
+            default : True
+        cpu_budget : CPUBudget, optional
+            Cpus shared by the workers, default : None
+        runtime_model : RuntimeModel, optional
+            Model used to run the longest jobs first, default : None
+        """
+        self._runner = runner
+        self._max_workers = max_workers if max_workers else cpu_count()
+        self._use_processes = use_processes
+        self._cpu_budgets = (
+            cpu_budget.split(self._max_workers) if cpu_budget else None
+        )
+        self.runtime_model = runtime_model
+
+    def _create_pool(self):
+        initializer, initargs = None, ()
+        if self._cpu_budgets:
+            budgets = (
+                multiprocessing.Queue()
+                if self._use_processes
+                else queue.Queue()
+            )
+            for budget in self._cpu_budgets:
+                budgets.put(budget)
+            initializer, initargs = _take_cpu_budget, (budgets,)
+
+        if self._use_processes:
+            return ProcessPoolExecutor(
+                self._max_workers, initializer=initializer, initargs=initargs
+            )
+        return ThreadPoolExecutor(
+            self._max_workers, initializer=initializer, initargs=initargs
+        )
+
+    def _submit(self, pool, index, job):
+        return pool.submit(execute_job, copy(self._runner), index, job)
+
+    def map(self, jobs, ordered=True):
+        """
+        Run all the jobs and yield their results
+
+        Parameters
+        ----------
+        jobs : list
+            List of BatchJob, or of tuples and dicts describing them
+        ordered : bool, optional
+            Yield the results in the order of the jobs list instead of in
+            their order of completion, default : True
+
+        Returns
+        -------
+        generator(BatchResult)
+            Results of the jobs, one per job
+
+        """
+        jobs = [BatchJob.from_any(job) for job in jobs]
+        if self.runtime_model is not None:
+            yield from self._map_longest_first(jobs, ordered)
+            return
+
+        with self._create_pool() as pool:
+            futures = [
+                self._submit(pool, index, job) for index, job in enumerate(jobs)
+            ]
+            for future in futures if ordered else as_completed(futures):
+                yield future.result()
+
+    def _map_longest_first(self, jobs, ordered):
+        model = self.runtime_model
+        features = [model.get_job_features(job) for job in jobs]
+        pending, running, results = list(range(len(jobs))), {}, {}
+        next_index = 0
+
+        with self._create_pool() as pool:
+            while pending or running:
+                pending.sort(key=lambda i: model.estimate(features[i]))
+                while pending and len(running) < self._max_workers:
+                    index = pending.pop()
+                    running[self._submit(pool, index, jobs[index])] = index
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    index, result = running.pop(future), future.result()
+                    if result.computed:
+                        model.update(
+                            features[index], result.metrics["run_time"]
+                        )
+                    results[index] = result
+
+                if not ordered:
+                    for index in list(results):
+                        yield results.pop(index)
+                while next_index in results:
+                    yield results.pop(next_index)
+                    next_index += 1
@@ -0,0 +1,313 @@
+import fcntl
+from contextlib import contextmanager
+from hashlib import sha256
+import json
+from os import (
+    O_CREAT,
+    O_RDWR,
+    close,
+    link,
+    listdir,
+    makedirs,
+    open as os_open,
+    path,
+    remove,
+    replace,
+)
+from shutil import copyfile, rmtree
+import time
+
+
+_FICLONE = 0x40049409
+
+
+def hash_file(file_path, hasher=None, block_size=2 ** 20):
+    """Feeds the content of a file to a hasher, a new sha256 by default"""
+    hasher = hasher if hasher else sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            hasher.update(block)
+    return hasher
+
+
+def _reflink(source, destination):
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+
+
+def materialize(source, destination):
+    """
+    Makes a file available at a new location, trying in order a hardlink, a
+    reflink and a copy. Returns False only if the data was copied.
+    """
+    if path.realpath(source) == path.realpath(destination):
+        return True
+    if path.lexists(destination):
+        remove(destination)
+
+    try:
+        link(source, destination)
+        return True
+    except OSError:
+        pass
+
+    try:
+        _reflink(source, destination)
+        return True
+    except OSError:
+        if path.exists(destination):
+            remove(destination)
+
+    copyfile(source, destination)
+    return False
+
+
+def get_geometry_files(phantom_infos):
+    """
+    Lists the base json file of a geometry configuration, followed by its
+    structure files
+    """
+    base_file = path.join(
+        phantom_infos["file_path"], phantom_infos["base_file"]
+    )
+    with open(base_file) as f:
+        base = json.load(f)
+
+    root = base.get("path", phantom_infos["file_path"])
+    return [base_file] + [
+        path.join(root, structure.get("extension", ""), name)
+        for structure in base.get("structures", [])
+        for name in structure.get("names", [])
+    ]
+
+
+def hash_geometry(phantom_infos):
+    """
+    Digest of a geometry configuration, which only depends on the content of
+    its files, not on their names or location
+    """
+    with open(
+        path.join(phantom_infos["file_path"], phantom_infos["base_file"])
+    ) as f:
+        base = json.load(f)
+
+    root = base.pop("path", phantom_infos["file_path"])
+    for structure in base.get("structures", []):
+        if "names" in structure:
+            structure["names"] = [
+                hash_file(
+                    path.join(root, structure.get("extension", ""), name)
+                ).hexdigest()
+                for name in structure["names"]
+            ]
+
+    return sha256(json.dumps(base, sort_keys=True).encode()).hexdigest()
+
+
+class PhantomCache:
+    """
+    Content-addressed store of the outputs of voxsim. Entries are keyed by
+    the content of the geometry files and the arguments given to voxsim,
+    and the least recently used ones are evicted once the cache grows
+    beyond its maximum size.
+
+    Files are materialized from the cache by hardlink when possible, hence
+    phantom outputs must not be modified in place.
+    """
+
+    _index_name = "index.json"
+    _lock_name = ".lock"
+
+    def __init__(self, cache_path, max_size=None):
+        """
+        Parameters
+        ----------
+        cache_path : str
+            Folder in which to store the cached phantoms
+        max_size : int, optional
+            Maximum size of the cache in bytes, default : unbounded
+        """
+        self._path = cache_path
+        self._max_size = max_size
+        makedirs(self._path, exist_ok=True)
+
+    def get_key(self, phantom_infos, *arguments):
+        """
+        Computes the cache key of a phantom
+
+        Parameters
+        ----------
+        phantom_infos : GeometryInfos or dict
+            Geometry configuration generated by the GeometryHandler
+        arguments :
+            Any other parameter given to voxsim that changes its outputs
+
+        Returns
+        -------
+        str
+            Key of the phantom in the cache
+
+        """
+        return sha256(
+            json.dumps(
+                [hash_geometry(phantom_infos)] + [str(a) for a in arguments]
+            ).encode()
+        ).hexdigest()
+
+    def fetch(self, key, output_folder, prefix):
+        """
+        Materializes a cached phantom in a folder
+
+        Parameters
+        ----------
+        key : str
+            Key of the phantom in the cache
+        output_folder : str
+            Folder in which to materialize the phantom outputs
+        prefix : str
+            Prefix given to the outputs, as passed to voxsim
+
+        Returns
+        -------
+        bool
+            True if the phantom was in the cache, with all its files
+
+        """
+        with self._locked_index() as index:
+            entry = index["entries"].get(key)
+            if entry is None:
+                index["stats"]["misses"] += 1
+                return False
+
+            outputs = [
+                path.join(output_folder, prefix + f) for f in entry["files"]
+            ]
+            try:
+                for suffix, output in zip(entry["files"], outputs):
+                    materialize(path.join(self._path, key, suffix), output)
+            except FileNotFoundError:
+                # Files of the entry were deleted behind the index
+                for output in outputs:
+                    if path.lexists(output):
+                        remove(output)
+                self._remove_entry(index, key)
+                index["stats"]["misses"] += 1
+                return False
+
+            entry["last_access"] = time.time()
+            index["stats"]["hits"] += 1
+            return True
+
+    def store(self, key, output_folder, prefix):
+        """
+        Adds the outputs of a phantom to the cache
+
+        Parameters
+        ----------
+        key : str
+            Key of the phantom in the cache
+        output_folder : str
+            Folder containing the phantom outputs
+        prefix : str
+            Prefix given to the outputs, as passed to voxsim
+
+        """
+        files = [f for f in listdir(output_folder) if f.startswith(prefix)]
+
+        with self._locked_index() as index:
+            entry_path = path.join(self._path, key)
+            rmtree(entry_path, ignore_errors=True)
+            makedirs(entry_path)
+
+            size = 0
+            for f in files:
+                cached = path.join(entry_path, f[len(prefix) :])
+                materialize(path.join(output_folder, f), cached)
+                size += path.getsize(cached)
+
+            index["entries"][key] = {
+                "files": [f[len(prefix) :] for f in files],
+                "size": size,
+                "last_access": time.time(),
+            }
+            self._evict(index)
+
+    def clear(self):
+        with self._locked_index() as index:
+            for key in list(index["entries"]):
+                self._remove_entry(index, key)
+
+    def stats(self):
+        """
+        Returns the usage statistics of the cache
+
+        Returns
+        -------
+        dict
+            Number of entries, size, hits, misses and evictions of the cache
+
+        """
+        with self._locked_index() as index:
+            stats = dict(index["stats"])
+            stats["entries"] = len(index["entries"])
+            stats["size"] = sum(e["size"] for e in index["entries"].values())
+
+        stats["max_size"] = self._max_size
+        requests = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / requests if requests else 0.0
+        return stats
+
+    def report(self):
+        return (
+            "Phantom cache {} : {entries} entries, {size} bytes, "
+            "{hits} hits, {misses} misses ({hit_rate:.1%} hit rate), "
+            "{evictions} evictions".format(self._path, **self.stats())
+        )
+
+    def _evict(self, index):
+        if self._max_size is None:
+            return
+
+        entries = sorted(
+            index["entries"].items(), key=lambda e: e[1]["last_access"]
+        )
+        size = sum(e["size"] for _, e in entries)
+        for key, entry in entries[:-1]:
+            if size <= self._max_size:
+                break
+            size -= entry["size"]
+            self._remove_entry(index, key)
+            index["stats"]["evictions"] += 1
+
+    def _remove_entry(self, index, key):
+        rmtree(path.join(self._path, key), ignore_errors=True)
+        index["entries"].pop(key)
+
+    @contextmanager
+    def _locked_index(self):
+        lock = os_open(path.join(self._path, self._lock_name), O_RDWR | O_CREAT)
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = self._read_index()
+            yield index
+            self._write_index(index)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            close(lock)
+
+    def _read_index(self):
+        index_path = path.join(self._path, self._index_name)
+        if not path.exists(index_path):
+            return {
+                "entries": {},
+                "stats": {"hits": 0, "misses": 0, "evictions": 0},
+            }
+
+        with open(index_path) as f:
+            return json.load(f)
+
+    def _write_index(self, index):
+        index_path = path.join(self._path, self._index_name)
+        with open(index_path + ".tmp", "w+") as f:
+            json.dump(index, f)
+        replace(index_path + ".tmp", index_path)
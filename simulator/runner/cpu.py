@@ -0,0 +1,142 @@
+from glob import glob
+from os import cpu_count, path, sched_getaffinity, sched_setaffinity
+
+
+THREAD_VARIABLES = [
+    "OMP_NUM_THREADS",
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+]
+
+
+def parse_cpu_list(cpu_list):
+    """Sorted cpus of a list in the format of the kernel (e.g. "0-3,8,10-11")"""
+    cpus = set()
+    for interval in cpu_list.strip().split(","):
+        if not interval:
+            continue
+        bounds = [int(b) for b in interval.split("-")]
+        cpus.update(range(bounds[0], bounds[-1] + 1))
+    return sorted(cpus)
+
+
+def get_numa_nodes():
+    """
+    Cpus of every NUMA node of the machine, read from /sys, a single node
+    holding all the cpus if the topology is not available
+    """
+    nodes = []
+    for node in sorted(
+        glob("/sys/devices/system/node/node[0-9]*"),
+        key=lambda n: int(path.basename(n)[4:]),
+    ):
+        try:
+            with open(path.join(node, "cpulist")) as f:
+                cpus = parse_cpu_list(f.read())
+        except OSError:
+            continue
+        if cpus:
+            nodes.append(cpus)
+
+    return nodes if nodes else [list(range(cpu_count()))]
+
+
+class CPUBudget:
+    """
+    Share of the cpus of the machine given to a job. The tools it runs are
+    told to use that many threads through the environment variables of
+    their threading runtimes (OpenMP, ITK, MKL, ...), and can be pinned to
+    a set of cpus.
+    """
+
+    def __init__(self, threads, cpus=None):
+        """
+        Parameters
+        ----------
+        threads : int
+            Number of threads the tools may use
+        cpus : list(int), optional
+            Cpus to which the tools are pinned, default : None
+        """
+        self.threads = max(1, threads)
+        self.cpus = sorted(cpus) if cpus else None
+
+    @classmethod
+    def available(cls, pin=False):
+        """
+        Budget holding all the cpus the process may run on
+
+        Parameters
+        ----------
+        pin : bool, optional
+            Pin the tools to the cpus, default : False
+
+        Returns
+        -------
+        CPUBudget
+            Budget of the process
+
+        """
+        cpus = sorted(sched_getaffinity(0))
+        return cls(len(cpus), cpus if pin else None)
+
+    def split(self, n_slots):
+        """
+        Divides the budget between jobs running at the same time. When the
+        budget is pinned, the cpus of every slot are taken, as far as
+        possible, from a single NUMA node, and the slots are spread over
+        the nodes in proportion of their cpus.
+
+        Parameters
+        ----------
+        n_slots : int
+            Number of jobs sharing the budget
+
+        Returns
+        -------
+        list(CPUBudget)
+            Budget of every slot
+
+        """
+        if self.cpus is None:
+            return [CPUBudget(self.threads // n_slots) for _ in range(n_slots)]
+
+        if n_slots >= len(self.cpus):
+            return [
+                CPUBudget(1, [self.cpus[i % len(self.cpus)]])
+                for i in range(n_slots)
+            ]
+
+        budget = set(self.cpus)
+        nodes = [[c for c in node if c in budget] for node in get_numa_nodes()]
+        nodes = [n for n in nodes if n]
+        nodes += [sorted(budget.difference(*nodes))]
+        nodes = [n for n in nodes if n]
+
+        slots_per_node = [len(n) * n_slots // len(self.cpus) for n in nodes]
+        remainders = sorted(
+            range(len(nodes)),
+            key=lambda i: len(nodes[i]) * n_slots % len(self.cpus),
+            reverse=True,
+        )
+        for i in remainders[: n_slots - sum(slots_per_node)]:
+            slots_per_node[i] += 1
+
+        slots = []
+        for cpus, n in zip(nodes, slots_per_node):
+            for i in range(n):
+                share = cpus[i * len(cpus) // n : (i + 1) * len(cpus) // n]
+                slots.append(CPUBudget(len(share), share))
+        return slots
+
+    def get_environment(self):
+        return {variable: str(self.threads) for variable in THREAD_VARIABLES}
+
+    def pin(self):
+        if self.cpus is not None:
+            sched_setaffinity(0, self.cpus)
+
+    def __repr__(self):
+        return "CPUBudget({}, {})".format(self.threads, self.cpus)
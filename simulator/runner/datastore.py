@@ -1,38 +1,146 @@
-from os.path import basename, exists, join
+from enum import Enum
+import logging
+from os import link, remove, stat, symlink
+from os.path import (
+    abspath,
+    basename,
+    dirname,
+    exists,
+    getsize,
+    islink,
+    join,
+    lexists,
+    realpath,
+)
 from shutil import copyfile
-from tempfile import TemporaryDirectory
 
-import nibabel as nib
 import numpy as np
 
 from simulator.factory import SimulationFactory
+from .reader import read_simulation_parameters
+from .volumes import Volume, VolumeWriter, get_extension
+
+
+logger = logging.getLogger(basename(__file__).split(".")[0])
+
+_KSPACE_ARTIFACTS = [
+    "addaliasing",
+    "addeddycurrents",
+    "addghosts",
+    "addringing",
+    "addspikes",
+    "doAddDistortions",
+    "doAddMotion",
+]
+
+
+def get_unit_fraction_approximations(simulation_infos):
+    """
+    Tells whether a simulation draws noise, which must be added after
+    recombining its compartment signals, and lists what makes that recombination
+    approximate : Fiberfox outputs magnitude images, which k-space and random
+    artifacts and partial Fourier take out of phase.
+    """
+    parameters = read_simulation_parameters(
+        join(simulation_infos["file_path"], simulation_infos["param_file"])
+    )
+    artifacts = parameters["artifacts"]
+    approximations = [a for a in _KSPACE_ARTIFACTS if artifacts.get(a)]
+    if parameters["acquisition"].get("partialfourier", 1) < 1:
+        approximations.append("partialfourier")
+    return bool(artifacts.get("addnoise")), approximations
 
 
 class Datastore:
+    class StagingMode(Enum):
+        """Ways of making a file available in a simulation folder"""
+
+        COPY = "copy"
+        HARDLINK = "hardlink"
+        SYMLINK = "symlink"
+        AUTO = "auto"
+
     def __init__(
         self,
         simulation_path,
         fibers,
         compartment_ids,
         inter_axonal_fraction=None,
+        staging_mode=StagingMode.AUTO,
+        map_dtype="float32",
+        compress_level=1,
+        chunk_size=2 ** 26,
     ):
         self.fibers = fibers
         self.compartments = []
         self.ids = compartment_ids
         self.stage_path = simulation_path
         self.iaf = inter_axonal_fraction
-        self._temp = TemporaryDirectory()
+        self.staging_mode = staging_mode
+        self.map_dtype = np.dtype(map_dtype)
+        self.compress_level = compress_level
+        self.chunk_size = chunk_size
+        self.staging_stats = {
+            mode.value: 0
+            for mode in Datastore.StagingMode
+            if mode is not Datastore.StagingMode.AUTO
+        }
+        self._symlinked = []
 
     def unload(self):
         self.compartments = []
-        self._temp.cleanup()
+        self._symlinked = []
 
     def get_bind_paths(self, bind_compartments=True):
         return [self.fibers] + (
-            self.compartments if bind_compartments else list()
+            self.compartments if bind_compartments else self._symlinked
+        )
+
+    def get_saved_bytes(self):
+        return sum(
+            size
+            for mode, size in self.staging_stats.items()
+            if mode != Datastore.StagingMode.COPY.value
         )
 
-    def load_compartments(self, input_folder, run_name, use_nifti=True):
+    @staticmethod
+    def stage_file(source, destination, mode=StagingMode.AUTO):
+        """
+        Makes a file available under a new name, hardlinked or symlinked in AUTO
+        mode depending on the filesystems, and copied if linking fails or in
+        COPY mode. Returns the mode that was used.
+        """
+        if lexists(destination):
+            remove(destination)
+
+        if mode is Datastore.StagingMode.AUTO:
+            same_device = (
+                stat(source).st_dev
+                == stat(dirname(abspath(destination))).st_dev
+            )
+            mode = (
+                Datastore.StagingMode.HARDLINK
+                if same_device
+                else Datastore.StagingMode.SYMLINK
+            )
+
+        try:
+            if mode is Datastore.StagingMode.HARDLINK:
+                link(source, destination)
+                return mode
+            if mode is Datastore.StagingMode.SYMLINK:
+                symlink(abspath(source), destination)
+                return mode
+        except OSError:
+            pass
+
+        copyfile(source, destination)
+        return Datastore.StagingMode.COPY
+
+    def load_compartments(
+        self, input_folder, run_name, use_nifti=True, stage_name=None
+    ):
+        stage_name = stage_name if stage_name else run_name
         extension = "nii.gz" if use_nifti else "nrrd"
         fiber_fraction = join(
             input_folder,
@@ -45,14 +153,14 @@ class Datastore:
 
         if inter_id in self.ids:
             assert self.iaf is not None
-            self.generate_inter_axonal_fraction(run_name, fiber_fraction)
+            self.generate_inter_axonal_fraction(stage_name, fiber_fraction)
         else:
             self.add_compartment(fiber_fraction)
 
         if extra1_id in self.ids or extra2_id in self.ids:
             ellipses = join(
                 input_folder,
-                "{}_mergedEllipsesMaps.{}".format(run_name, extension),
+                "{}_phantom_mergedEllipsesMaps.{}".format(run_name, extension),
             )
             if exists(ellipses):
                 self.add_compartment(ellipses)
@@ -67,68 +175,148 @@ class Datastore:
             )
 
             if "generate" in self.compartments:
-                self.generate_extra_axonal_fraction(run_name)
+                self.generate_extra_axonal_fraction(stage_name)
+
+    def load_unit_fractions(
+        self,
+        input_folder,
+        run_name,
+        compartment_id,
+        use_nifti=True,
+        stage_name=None,
+    ):
+        """
+        Stages fraction maps simulating a single compartment over the whole
+        image, ones for it and zeros for the others, on the grid of the fiber
+        fraction map of the phantom
+        """
+        stage_name = stage_name if stage_name else run_name
+        extension = "nii.gz" if use_nifti else "nrrd"
+        reference = Volume(
+            join(
+                input_folder,
+                "{}_phantom_mergedBundlesMaps.{}".format(run_name, extension),
+            )
+        )
+
+        step = reference.slab_step(self.chunk_size, self.map_dtype.itemsize)
+        for cmp_id in self.ids:
+            staged = self.get_staged_path(stage_name, cmp_id, extension)
+            with VolumeWriter(
+                staged,
+                reference.shape,
+                self.map_dtype,
+                reference,
+                self.compress_level,
+            ) as writer:
+                for start in range(0, reference.shape[-1], step):
+                    stop = min(start + step, reference.shape[-1])
+                    writer.write(
+                        np.full(
+                            reference.shape[:-1] + (stop - start,),
+                            1 if cmp_id == compartment_id else 0,
+                            self.map_dtype,
+                        )
+                    )
+            self.add_compartment(staged)
 
     def add_compartment(self, filepath):
         self.compartments.append(filepath)
 
+    def get_staged_path(self, run_name, cmp_id, extension):
+        return join(
+            self.stage_path,
+            "{}_simulation.ffp_VOLUME{}.{}".format(run_name, cmp_id, extension),
+        )
+
+    def get_staged_paths(self, run_name):
+        extension = get_extension(self.compartments[0])
+        return [
+            self.get_staged_path(run_name, cmp_id, extension)
+            for cmp_id in self.ids
+        ]
+
+    def load_staged(self, run_name, use_nifti=True):
+        extension = "nii.gz" if use_nifti else "nrrd"
+        self.compartments = [
+            self.get_staged_path(run_name, cmp_id, extension)
+            for cmp_id in self.ids
+        ]
+        self._symlinked = [realpath(c) for c in self.compartments if islink(c)]
+
     def stage_compartments(self, run_name):
-        extension = ".".join(basename(self.compartments[0]).split(".")[1:])
+        extension = get_extension(self.compartments[0])
         for m, cmp_id in zip(self.compartments, self.ids):
-            copyfile(
-                m,
-                join(
-                    self.stage_path,
-                    "{}_simulation.ffp_VOLUME{}.{}".format(
-                        run_name, cmp_id, extension
-                    ),
-                ),
-            )
+            destination = self.get_staged_path(run_name, cmp_id, extension)
+            if abspath(m) == abspath(destination):
+                continue
+
+            mode = self.stage_file(m, destination, self.staging_mode)
+            self.staging_stats[mode.value] += getsize(m)
+            if mode is Datastore.StagingMode.SYMLINK:
+                self._symlinked.append(m)
+
+        return self.staging_stats
 
     def generate_inter_axonal_fraction(self, run_name, fiber_fraction):
-        img = nib.load(fiber_fraction)
-        fraction = img.get_fdata()
-        inter_fraction = self.iaf * fraction
-        intra_fraction = fraction - inter_fraction
-
-        nib.save(
-            nib.Nifti1Image(inter_fraction, img.affine, img.header),
-            join(self._get_temp(), "{}_inter.nii.gz".format(run_name)),
-        )
-        nib.save(
-            nib.Nifti1Image(intra_fraction, img.affine, img.header),
-            join(self._get_temp(), "{}_intra.nii.gz".format(run_name)),
-        )
+        fraction = Volume(fiber_fraction)
+        intra, inter = [
+            self.get_staged_path(
+                run_name,
+                self.ids[len(self.compartments) + i],
+                fraction.extension,
+            )
+            for i in range(2)
+        ]
 
-        self.add_compartment(
-            join(self._get_temp(), "{}_intra.nii.gz".format(run_name))
-        )
-        self.add_compartment(
-            join(self._get_temp(), "{}_inter.nii.gz".format(run_name))
+        step = fraction.slab_step(
+            self.chunk_size, 8 + 2 * self.map_dtype.itemsize
         )
+        with VolumeWriter(
+            intra, fraction.shape, self.map_dtype, fraction, self.compress_level
+        ) as intra_writer, VolumeWriter(
+            inter, fraction.shape, self.map_dtype, fraction, self.compress_level
+        ) as inter_writer:
+            for _, _, data in fraction.iter_slabs(step):
+                inter_fraction = np.multiply(
+                    data, self.iaf, dtype=self.map_dtype
+                )
+                intra_writer.write(
+                    np.subtract(data, inter_fraction, dtype=self.map_dtype)
+                )
+                inter_writer.write(inter_fraction)
 
-    def generate_extra_axonal_fraction(self, run_name):
-        other_fractions = list(
-            filter(lambda c: c != "generate", self.compartments)
-        )
+        self.add_compartment(intra)
+        self.add_compartment(inter)
 
-        ref = nib.load(other_fractions[0])
-        data = np.concatenate(
-            [ref[..., None]]
-            + [nib.load(f).get_fdata()[..., None] for f in other_fractions[1:]],
-            axis=-1,
-        )
-        extra = np.ones(ref.shape) - np.sum(data, axis=-1)
+    def generate_extra_axonal_fraction(self, run_name):
+        fractions = [
+            Volume(c)
+            for c in filter(lambda c: c != "generate", self.compartments)
+        ]
+        ref = fractions[0]
+        index = self.compartments.index("generate")
+        extra = self.get_staged_path(run_name, self.ids[index], ref.extension)
 
-        nib.save(
-            nib.Nifti1Image(extra, ref.affine, ref.header),
-            join(self._get_temp(), "{}_extra.nii.gz".format(run_name)),
-        )
+        step = ref.slab_step(self.chunk_size, 8 * (len(fractions) + 1))
+        n_clipped = 0
+        with VolumeWriter(
+            extra, ref.shape, self.map_dtype, ref, self.compress_level
+        ) as writer:
+            for slabs in zip(*[f.iter_slabs(step) for f in fractions]):
+                fraction = np.ones(slabs[0][2].shape, self.map_dtype)
+                for _, _, data in slabs:
+                    fraction -= data
+                n_clipped += int(np.count_nonzero(fraction < 0))
+                np.clip(fraction, 0, None, out=fraction)
+                writer.write(fraction)
 
-        self.add_compartment(
-            join(self._get_temp(), "{}_extra.nii.gz".format(run_name))
-        )
+        if n_clipped:
+            logger.warning(
+                "{} : the compartment fractions sum over 1 in {} voxels, the "
+                "extra axonal fraction is clipped to 0 in them".format(
+                    run_name, n_clipped
+                )
+            )
 
-    def _get_temp(self):
-        assert self._temp is not None
-        return self._temp
+        self.compartments[index] = extra
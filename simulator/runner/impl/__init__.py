@@ -0,0 +1,39 @@
+from .runner_backend import RunnerBackend
+from .runner_dry import DryRunBackend
+from .runner_local import LocalBackend
+from .runner_singularity import SingularityBackend
+
+
+_backends = {
+    "singularity": SingularityBackend,
+    "local": LocalBackend,
+    "dry_run": DryRunBackend,
+}
+
+
+def get_backend(config):
+    """
+    Creates the backend selected by the "backend" key of the configuration
+
+    Parameters
+    ----------
+    config : dict
+        Configuration of the simulator (see config.json). Its "backend" key
+        is one of "singularity", "local" or "dry_run",
+        default : "singularity"
+
+    Returns
+    -------
+    RunnerBackend
+        Backend configured
+
+    """
+    backend = config.get("backend", "singularity")
+    if backend not in _backends:
+        raise ValueError(
+            "Unknown runner backend {}, choose from {}".format(
+                backend, ", ".join(_backends)
+            )
+        )
+
+    return _backends[backend].from_config(config)
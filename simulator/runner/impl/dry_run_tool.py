@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+"""
+Stand-in for voxsim and Fiberfox, used by the DryRunBackend and by the
+stand-in executables of the test helpers. It accepts the arguments given to
+the tools and writes outputs of the right name, shape and format, holding a
+synthetic signal, without simulating anything. It can also emulate the
+running time, memory and log output of the tools. It only depends on numpy,
+nibabel, pynrrd and lxml, so that it starts fast.
+
+Usage : dry_run_tool.py [--sleep S] [--memory B] [--log-lines N]
+                        {voxsim,fiberfox} <arguments of the tool>
+"""
+
+import argparse
+import time
+
+from lxml import etree
+import nibabel as nib
+import nrrd
+import numpy as np
+
+
+_N_STREAMLINES = 16
+_N_POINTS = 20
+
+
+def _save(data, name, use_nifti):
+    if use_nifti:
+        nib.save(nib.Nifti1Image(data, np.eye(4)), name + ".nii.gz")
+    else:
+        nrrd.write(name + ".nrrd", data)
+
+
+def _get_bundle_map(resolution):
+    grid = np.meshgrid(
+        *[np.linspace(-1, 1, r) for r in resolution[1:]], indexing="ij"
+    )
+    radius = sum(g ** 2 for g in grid)
+    bundle = 0.8 * np.exp(-radius / 0.18).astype(np.float32)
+    return np.broadcast_to(bundle, resolution).copy()
+
+
+def _write_fibers(name, resolution, spacing):
+    rng = np.random.default_rng(0)
+    extent = np.array(resolution) * np.array(spacing)
+    x = np.linspace(0, extent[0], _N_POINTS)
+    lines = []
+    for center in rng.normal(0.5, 0.1, (_N_STREAMLINES, 2)):
+        y, z = np.clip(center, 0, 1) * extent[1:]
+        lines.append(np.stack([x, np.full_like(x, y), np.full_like(x, z)], 1))
+
+    points = np.concatenate(lines)
+    with open(name, "w+") as f:
+        f.write("# vtk DataFile Version 3.0\nfibers\nASCII\n")
+        f.write("DATASET POLYDATA\n")
+        f.write("POINTS {} float\n".format(len(points)))
+        np.savetxt(f, points, fmt="%.4f")
+        f.write(
+            "LINES {} {}\n".format(_N_STREAMLINES, len(points) + len(lines))
+        )
+        for i in range(_N_STREAMLINES):
+            indexes = range(i * _N_POINTS, (i + 1) * _N_POINTS)
+            f.write(
+                "{} {}\n".format(_N_POINTS, " ".join(str(j) for j in indexes))
+            )
+
+
+def voxsim(args):
+    parser = argparse.ArgumentParser("voxsim")
+    parser.add_argument("-f", required=True)
+    parser.add_argument("-r", required=True)
+    parser.add_argument("-s", required=True)
+    parser.add_argument("-o", required=True)
+    parser.add_argument("--comp-map", choices=["rel", "abs"], default="rel")
+    parser.add_argument("--nii", action="store_true")
+    args, _ = parser.parse_known_args(args)
+
+    resolution = [int(r) for r in args.r.split(",")]
+    spacing = [float(s) for s in args.s.split(",")]
+    _write_fibers("{}_merged_bundles.fib".format(args.o), resolution, spacing)
+
+    bundles = _get_bundle_map(resolution)
+    ellipses = np.zeros_like(bundles)
+    ellipses[..., resolution[2] // 2 :] = 0.5
+    ellipses *= 1.0 - bundles
+    _save(bundles, "{}_mergedBundlesMaps".format(args.o), args.nii)
+    _save(ellipses, "{}_mergedEllipsesMaps".format(args.o), args.nii)
+
+
+def fiberfox(args):
+    parser = argparse.ArgumentParser("fiberfox")
+    parser.add_argument("-p", required=True)
+    parser.add_argument("-i", required=True)
+    parser.add_argument("-o", required=True)
+    args, _ = parser.parse_known_args(args)
+
+    image = etree.parse(args.p).getroot().find("image")
+    resolution = [int(image.find("basic/size/" + a).text) for a in "xyz"]
+    bvalue = float(image.find("bvalue").text)
+    gradients = image.find("gradients")
+    directions = np.array(
+        [[float(d.find(a).text) for a in "xyz"] for d in gradients]
+    ).reshape((-1, 3))
+    bvals = np.sum(directions ** 2, axis=1) * bvalue
+
+    bundles = _get_bundle_map(resolution)[..., None]
+    norms = np.linalg.norm(directions, axis=1)
+    cosines = np.divide(
+        directions[:, 0], norms, out=np.zeros_like(norms), where=norms > 0
+    )
+    signal = bundles * np.exp(-bvals * 1.7e-3 * cosines ** 2) + (
+        1.0 - bundles
+    ) * np.exp(-bvals * 1e-3)
+
+    use_nifti = args.o.endswith(".nii.gz")
+    stem = args.o[: -len(".nii.gz")] if use_nifti else args.o[: -len(".nrrd")]
+    _save((100.0 * signal).astype(np.float32), stem, use_nifti)
+
+    if use_nifti:
+        np.savetxt(stem + ".bvals", bvals[None], fmt="%g")
+        np.savetxt(stem + ".bvecs", directions.T, fmt="%g")
+
+
+def emulate_profile(sleep=0.0, memory=0, log_lines=0):
+    """
+    Holds up to memory bytes, allocated progressively over sleep seconds,
+    while writing log_lines lines, each holding the time at which it was
+    written, spread over the same period.
+    """
+    memory = int(memory)
+    steps = max(log_lines, 10 if memory or sleep else 0)
+    chunks = []
+    for i in range(steps):
+        if memory:
+            size = memory * (i + 1) // steps - memory * i // steps
+            chunks.append(np.ones(size, dtype=np.uint8))
+        if i < log_lines:
+            print("[STUB] line {} at {!r}".format(i, time.time()), flush=True)
+        if sleep:
+            time.sleep(sleep / steps)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("dry_run_tool")
+    parser.add_argument("--sleep", type=float, default=0.0)
+    parser.add_argument("--memory", type=float, default=0)
+    parser.add_argument("--log-lines", type=int, default=0)
+    parser.add_argument("tool", choices=["voxsim", "fiberfox"])
+    parser.add_argument("arguments", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    emulate_profile(args.sleep, args.memory, args.log_lines)
+    {"voxsim": voxsim, "fiberfox": fiberfox}[args.tool](args.arguments)
@@ -0,0 +1,69 @@
+class RunnerBackend:
+    """
+    Builds the commands launching the simulation tools for a runner, and
+    holds the resources they need while the runner is active. Commands are
+    built for two steps : "phantom", which runs voxsim, and "diffusion mri",
+    which runs Fiberfox.
+    """
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Creates the backend from the configuration of the simulator
+
+        Parameters
+        ----------
+        config : dict
+            Configuration of the simulator (see config.json)
+
+        Returns
+        -------
+        RunnerBackend
+            Backend configured
+
+        """
+        raise NotImplementedError()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def get_environment(self, variables):
+        """
+        Environment variables to set for the tools to see the given ones
+
+        Parameters
+        ----------
+        variables : dict
+            Variables the tools should see
+
+        Returns
+        -------
+        dict
+            Variables to add to the environment of the commands
+
+        """
+        return dict(variables)
+
+    def get_command(self, step, bind_paths, arguments):
+        """
+        Builds the command running the tool of a step
+
+        Parameters
+        ----------
+        step : str
+            Step to run, either "phantom" or "diffusion mri"
+        bind_paths : list(str)
+            Folders holding the inputs and outputs of the command
+        arguments : str
+            Arguments given to the tool
+
+        Returns
+        -------
+        str
+            Command to execute
+
+        """
+        raise NotImplementedError()
@@ -0,0 +1,35 @@
+from os import path
+import sys
+
+from .runner_backend import RunnerBackend
+
+
+class DryRunBackend(RunnerBackend):
+    """
+    Replaces the simulation tools by a stand-in (see dry_run_tool.py) that
+    writes synthetic outputs of the right name and shape. Runs go through all
+    the orchestration (processes, logging, staging, merging) without
+    simulating anything, which measures its cost on its own.
+    """
+
+    tool = path.join(path.dirname(__file__), "dry_run_tool.py")
+    _tools = {"phantom": "voxsim", "diffusion mri": "fiberfox"}
+
+    def __init__(self, python_exec=sys.executable):
+        """
+        Parameters
+        ----------
+        python_exec : str, optional
+            Python interpreter running the stand-in,
+            default : the current interpreter
+        """
+        self._python = python_exec
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get("python_exec", sys.executable))
+
+    def get_command(self, step, bind_paths, arguments):
+        return "{} {} {} {}".format(
+            self._python, self.tool, self._tools[step], arguments
+        )
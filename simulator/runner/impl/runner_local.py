@@ -0,0 +1,34 @@
+from .runner_backend import RunnerBackend
+
+
+class LocalBackend(RunnerBackend):
+    """
+    Runs the simulation tools installed natively on the machine, without
+    going through a container. Bind paths are ignored, the tools reach the
+    files directly.
+    """
+
+    def __init__(self, voxsim_exec="voxsim", fiberfox_exec="MitkFiberfox"):
+        """
+        Parameters
+        ----------
+        voxsim_exec : str, optional
+            Command launching voxsim, which may contain a launcher and its
+            arguments (e.g. "mpirun -n 4 voxsim"), default : "voxsim"
+        fiberfox_exec : str, optional
+            Command launching Fiberfox, default : "MitkFiberfox"
+        """
+        self._executables = {
+            "phantom": voxsim_exec,
+            "diffusion mri": fiberfox_exec,
+        }
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config.get("voxsim_exec", "voxsim"),
+            config.get("fiberfox_exec", "MitkFiberfox"),
+        )
+
+    def get_command(self, step, bind_paths, arguments):
+        return "{} {}".format(self._executables[step], arguments)
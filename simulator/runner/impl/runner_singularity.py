@@ -0,0 +1,79 @@
+from os import path
+
+from .runner_backend import RunnerBackend
+from ..instances import InstancePool
+
+
+class SingularityBackend(RunnerBackend):
+    """
+    Runs the simulation tools through the apps of the simulator's
+    Singularity image. Commands whose paths are all bound in the instances
+    of an InstancePool run in them, the others start a new container.
+    """
+
+    _apps = {"phantom": "launch_voxsim", "diffusion mri": "launch_mitk"}
+
+    def __init__(
+        self, image, singularity_exec="singularity", instance_pool=None
+    ):
+        """
+        Parameters
+        ----------
+        image : str
+            Singularity image of the simulator
+        singularity_exec : str, optional
+            Singularity executable, default : "singularity"
+        instance_pool : InstancePool, optional
+            Instances of the image in which to run the commands,
+            default : None
+        """
+        self._image = image
+        self._exec = singularity_exec
+        self._instance_pool = instance_pool
+
+    @classmethod
+    def from_config(cls, config):
+        image = path.join(
+            config["singularity_path"], config["singularity_name"]
+        )
+        singularity_exec = config.get("singularity_exec", "singularity")
+        instance_pool = None
+        if "instance_pool" in config:
+            instance_pool = InstancePool(
+                singularity_exec, image, **config["instance_pool"]
+            )
+
+        return cls(image, singularity_exec, instance_pool)
+
+    @property
+    def instance_pool(self):
+        return self._instance_pool
+
+    def start(self):
+        if self._instance_pool is not None:
+            self._instance_pool.start()
+
+    def stop(self):
+        if self._instance_pool is not None:
+            self._instance_pool.stop()
+
+    def get_environment(self, variables):
+        environment = dict(variables)
+        environment.update(
+            {"SINGULARITYENV_{}".format(k): v for k, v in variables.items()}
+        )
+        return environment
+
+    def get_command(self, step, bind_paths, arguments):
+        if self._instance_pool is not None and self._instance_pool.covers(
+            bind_paths
+        ):
+            return self._instance_pool.get_command(self._apps[step], arguments)
+
+        return "{} run -B {} --app {} {} {}".format(
+            self._exec,
+            ",".join(bind_paths),
+            self._apps[step],
+            self._image,
+            arguments,
+        )
@@ -0,0 +1,149 @@
+import atexit
+from os import getpid, path, sep
+from random import randrange
+from subprocess import PIPE, run
+from threading import Lock
+
+from ..exceptions import SimulationRunnerException
+
+
+class InstancePool:
+    """
+    Long-lived Singularity instances of an image, in which commands are run
+    instead of starting a new container for each of them. The instances are
+    started on first use, with a fixed set of bind roots, and commands are
+    dealt to them in turn. Only commands whose paths all lie under the bind
+    roots can run in the instances.
+
+    Only the process that created the pool starts and stops the instances,
+    at the latest when it exits. Copies of the pool sent to other processes
+    run their commands in the instances started before the copy, and have
+    none otherwise.
+    """
+
+    def __init__(self, singularity_exec, image, bind_roots, size=1, name=None):
+        """
+        Parameters
+        ----------
+        singularity_exec : str
+            Singularity executable
+        image : str
+            Image from which to start the instances
+        bind_roots : list(str)
+            Folders bound in the instances, which must contain every input
+            and output of the commands run in them
+        size : int, optional
+            Number of instances to start, default : 1
+        name : str, optional
+            Prefix of the names of the instances,
+            default : simulator_<pid of the process starting them>
+        """
+        self._exec = singularity_exec
+        self._image = image
+        self._bind_roots = [path.abspath(r) for r in bind_roots]
+        self._size = size
+        self._name = name
+        self._instances = []
+        self._next = 0
+        self._lock = Lock()
+        self._owner = getpid()
+        self._exit_handler = False
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_lock")
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = Lock()
+        self._next = randrange(self._size)
+
+    @property
+    def instances(self):
+        return list(self._instances)
+
+    @property
+    def is_owner(self):
+        return getpid() == self._owner
+
+    def covers(self, paths):
+        """
+        Tells if paths all lie under the bind roots. A copy of the pool that has
+        no instances covers no path.
+        """
+        if not self._instances and not self.is_owner:
+            return False
+
+        return all(
+            any(
+                p == root or p.startswith(root.rstrip(sep) + sep)
+                for root in self._bind_roots
+            )
+            for p in [path.abspath(p) for p in paths if p]
+        )
+
+    def start(self):
+        with self._lock:
+            if self._instances or not self.is_owner:
+                return
+
+            if not self._exit_handler:
+                atexit.register(self.stop)
+                self._exit_handler = True
+
+            name = self._name if self._name else "simulator_{}".format(getpid())
+            for i in range(self._size):
+                instance = "{}_{}".format(name, i)
+                process = run(
+                    [
+                        self._exec,
+                        "instance",
+                        "start",
+                        "-B",
+                        ",".join(self._bind_roots),
+                        self._image,
+                        instance,
+                    ],
+                    stdout=PIPE,
+                    stderr=PIPE,
+                )
+                if not process.returncode == 0:
+                    self._stop_instances()
+                    raise SimulationRunnerException(
+                        "Could not start singularity instance {} : {}".format(
+                            instance, process.stderr.decode().strip()
+                        ),
+                        SimulationRunnerException.ExceptionType.Initialization,
+                        process.returncode,
+                    )
+                self._instances.append(instance)
+
+    def get_command(self, app, arguments):
+        """Command running an app of the image in the next instance"""
+        self.start()
+        with self._lock:
+            instance = self._instances[self._next % len(self._instances)]
+            self._next += 1
+
+        return "{0} exec --app {1} instance://{2} {3} {4}".format(
+            self._exec,
+            app,
+            instance,
+            "/scif/apps/{}/scif/runscript".format(app),
+            arguments,
+        )
+
+    def stop(self):
+        with self._lock:
+            if self.is_owner:
+                self._stop_instances()
+
+    def _stop_instances(self):
+        for instance in self._instances:
+            run(
+                [self._exec, "instance", "stop", instance],
+                stdout=PIPE,
+                stderr=PIPE,
+            )
+        self._instances = []
@@ -1,16 +1,19 @@
 from asyncio import get_event_loop, new_event_loop, set_event_loop
 import logging
 from multiprocessing import Process
-from os import makedirs, path
+from os import killpg, makedirs, path
 from os.path import basename, exists
 from shutil import copyfile
-from subprocess import PIPE, Popen
+import signal
+from subprocess import PIPE, Popen, TimeoutExpired
 
 import nibabel as nib
 from numpy import ones_like, sum
 import nrrd
 
 from config import get_config
+from .datastore import Datastore
+from .impl import get_backend
 from ..exceptions import SimulationRunnerException
 from ..utils.logging import RTLogging
 
@@ -19,6 +22,8 @@ logger = logging.getLogger(basename(__file__).split(".")[0])
 
 
 class SimulationRunner:
+    _kill_grace = 10.0
+
     def __init__(
         self,
         base_naming,
@@ -26,6 +31,8 @@ class SimulationRunner:
         simulation_infos=None,
         singularity_conf=get_config(),
         output_nifti=False,
+        staging_mode=Datastore.StagingMode.AUTO,
+        timeouts=None,
     ):
         self._geometry_path = geometry_infos["file_path"]
         self._geometry_base_file = geometry_infos["base_file"]
@@ -42,20 +49,21 @@ class SimulationRunner:
         singularity_conf = (
             singularity_conf if singularity_conf else get_config()
         )
-        self._singularity = path.join(
-            singularity_conf["singularity_path"],
-            singularity_conf["singularity_name"],
-        )
-        self._singularity_exec = (
-            singularity_conf["singularity_exec"]
-            if "singularity_exec" in singularity_conf
-            else "singularity"
-        )
+        self._backend = get_backend(singularity_conf)
+        self._timeouts = dict(singularity_conf.get("timeouts", {}))
+        self._timeouts.update(timeouts if timeouts else {})
 
         self._run_simulation = True if simulation_infos else False
         self._extension = "nii.gz" if output_nifti else "nrrd"
         self._fib_extension_arg = " --nii" if output_nifti else ""
 
+        self._staging_mode = staging_mode
+        self.staging_stats = {
+            mode.value: 0
+            for mode in Datastore.StagingMode
+            if mode is not Datastore.StagingMode.AUTO
+        }
+
         self._load_image = self._load_nifti if output_nifti else self._load_nrrd
         self._save_image = self._save_nifti if output_nifti else self._save_nrrd
         self._event_loop = new_event_loop()
@@ -76,13 +84,10 @@ class SimulationRunner:
         if not path.exists(simulation_output_folder):
             makedirs(simulation_output_folder, exist_ok=True)
 
-        simulation_command = (
-            "{} run -B {} --app launch_mitk {} -p {} -i {} -o {} {}".format(
-                self._singularity_exec,
-                ",".join(
-                    [simulation_infos["file_path"], simulation_output_folder]
-                ),
-                self._singularity,
+        simulation_command = self._backend.get_command(
+            "diffusion mri",
+            [simulation_infos["file_path"], simulation_output_folder],
+            "-p {} -i {} -o {} {}".format(
                 path.join(
                     simulation_output_folder,
                     "{}_simulation.ffp".format(self._base_naming),
@@ -93,7 +98,7 @@ class SimulationRunner:
                     "{}.{}".format(self._base_naming, self._extension),
                 ),
                 "-v" if test_mode else "",
-            )
+            ),
         )
 
         copyfile(
@@ -113,7 +118,10 @@ class SimulationRunner:
         logger.info("Simulating DWI signal")
         return_code, log = async_loop.run_until_complete(
             self._launch_command(
-                simulation_command, log_file, "[RUNNING FIBERFOX]"
+                simulation_command,
+                log_file,
+                "[RUNNING FIBERFOX]",
+                self._timeouts.get("diffusion mri"),
             )
         )
         if not return_code == 0:
@@ -151,17 +159,14 @@ class SimulationRunner:
         if not path.exists(simulation_output_folder):
             makedirs(simulation_output_folder, exist_ok=True)
 
-        simulation_command = (
-            "{} run -B {} --app launch_mitk {} -p {} -i {} -o {} {}".format(
-                self._singularity_exec,
-                ",".join(
-                    [
-                        geometry_folder,
-                        simulation_infos["file_path"],
-                        simulation_output_folder,
-                    ]
-                ),
-                self._singularity,
+        simulation_command = self._backend.get_command(
+            "diffusion mri",
+            [
+                geometry_folder,
+                simulation_infos["file_path"],
+                simulation_output_folder,
+            ],
+            "-p {} -i {} -o {} {}".format(
                 path.join(
                     simulation_output_folder,
                     "{}_simulation.ffp".format(base_naming),
@@ -173,7 +178,7 @@ class SimulationRunner:
                     "{}.{}".format(base_naming, self._extension),
                 ),
                 "-v" if test_mode else "",
-            )
+            ),
         )
 
         copyfile(
@@ -196,11 +201,15 @@ class SimulationRunner:
             simulation_output_folder,
             base_naming,
         )
+        logger.info("Staged compartments : {}".format(self.staging_stats))
 
         logger.info("Simulating DWI signal")
         return_code, log = async_loop.run_until_complete(
             self._launch_command(
-                simulation_command, log_file, "[RUNNING FIBERFOX]"
+                simulation_command,
+                log_file,
+                "[RUNNING FIBERFOX]",
+                self._timeouts.get("diffusion mri"),
             )
         )
         if not return_code == 0:
@@ -235,32 +244,28 @@ class SimulationRunner:
             if not path.exists(simulation_output_folder):
                 makedirs(simulation_output_folder, exist_ok=True)
 
-        geometry_command = (
-            "singularity run -B {} --app launch_voxsim {} -f {} -r {} "
-            "-s {} -o {} --comp-map {} --quiet{}".format(
-                ",".join([self._geometry_path, geometry_output_folder]),
-                self._singularity,
+        geometry_command = self._backend.get_command(
+            "phantom",
+            [self._geometry_path, geometry_output_folder],
+            "-f {} -r {} -s {} -o {} --comp-map {} --quiet{}".format(
                 path.join(self._geometry_path, self._geometry_base_file),
                 ",".join([str(r) for r in self._geometry_resolution]),
                 ",".join([str(s) for s in self._geometry_spacing]),
                 path.join(geometry_output_folder, self._geometry_base_naming),
                 "rel" if relative_fiber_compartment else "abs",
                 self._fib_extension_arg,
-            )
+            ),
         )
 
         if self._run_simulation:
-            simulation_command = (
-                "singularity run -B {} --app launch_mitk {} "
+            simulation_command = self._backend.get_command(
+                "diffusion mri",
+                [
+                    self._simulation_path,
+                    geometry_output_folder,
+                    simulation_output_folder,
+                ],
                 "-p {} -i {} -o {} {}".format(
-                    ",".join(
-                        [
-                            self._simulation_path,
-                            geometry_output_folder,
-                            simulation_output_folder,
-                        ]
-                    ),
-                    self._singularity,
                     path.join(
                         simulation_output_folder,
                         "{}_simulation.ffp".format(self._base_naming),
@@ -274,7 +279,7 @@ class SimulationRunner:
                         "{}.{}".format(self._base_naming, self._extension),
                     ),
                     "-v" if test_mode else "",
-                )
+                ),
             )
 
             copyfile(
@@ -291,17 +296,26 @@ class SimulationRunner:
 
         logger.info("Generating simulation geometry")
         async_loop.run_until_complete(
-            self._launch_command(geometry_command, log_file, "[RUNNING VOXSIM]")
+            self._launch_command(
+                geometry_command,
+                log_file,
+                "[RUNNING VOXSIM]",
+                self._timeouts.get("phantom"),
+            )
         )
         if self._run_simulation:
             self._rename_and_copy_compartments(
                 geometry_output_folder, simulation_output_folder
             )
+            logger.info("Staged compartments : {}".format(self.staging_stats))
             logger.info("Simulating DWI signal")
             if self._run_simulation:
                 return_code, log = async_loop.run_until_complete(
                     self._launch_command(
-                        simulation_command, log_file, "[RUNNING FIBERFOX]"
+                        simulation_command,
+                        log_file,
+                        "[RUNNING FIBERFOX]",
+                        self._timeouts.get("diffusion mri"),
                     )
                 )
                 if not return_code == 0:
@@ -327,7 +341,7 @@ class SimulationRunner:
         simulation_output_folder,
         base_naming,
     ):
-        copyfile(
+        self._stage_compartment(
             path.join(
                 geometry_output_folder,
                 self._geometry_base_naming
@@ -359,7 +373,7 @@ class SimulationRunner:
                 )
             )
             if merged_maps:
-                copyfile(
+                self._stage_compartment(
                     path.join(
                         geometry_output_folder,
                         self._geometry_base_naming
@@ -375,7 +389,7 @@ class SimulationRunner:
                     ),
                 )
             elif base_map:
-                copyfile(
+                self._stage_compartment(
                     path.join(
                         geometry_output_folder,
                         self._geometry_base_naming
@@ -422,7 +436,7 @@ class SimulationRunner:
     def _rename_and_copy_compartments(
         self, geometry_output_folder, simulation_output_folder
     ):
-        copyfile(
+        self._stage_compartment(
             path.join(
                 geometry_output_folder,
                 self._geometry_base_naming
@@ -452,7 +466,7 @@ class SimulationRunner:
                 )
             )
             if merged_maps:
-                copyfile(
+                self._stage_compartment(
                     path.join(
                         geometry_output_folder,
                         self._geometry_base_naming
@@ -468,7 +482,7 @@ class SimulationRunner:
                     ),
                 )
             elif base_map:
-                copyfile(
+                self._stage_compartment(
                     path.join(
                         geometry_output_folder,
                         self._geometry_base_naming
@@ -508,6 +522,10 @@ class SimulationRunner:
                     SimulationRunnerException.ExceptionType.Parameters,
                 )
 
+    def _stage_compartment(self, source, destination):
+        mode = Datastore.stage_file(source, destination, self._staging_mode)
+        self.staging_stats[mode.value] += path.getsize(source)
+
     def _load_nifti(self, name):
         img = nib.load("{}.nii.gz".format(name))
         return img.get_fdata(), (img.affine, img.header)
@@ -582,11 +600,32 @@ class SimulationRunner:
         if self._event_loop.is_closed():
             self._event_loop = new_event_loop()
 
-    async def _launch_command(self, command, log_file, log_tag):
-        process = Popen(command.split(" "), stdout=PIPE, stderr=PIPE)
+    async def _launch_command(self, command, log_file, log_tag, timeout=None):
+        process = Popen(
+            command.split(" "),
+            stdout=PIPE,
+            stderr=PIPE,
+            start_new_session=timeout is not None,
+        )
 
         logger = RTLogging(process, log_file, log_tag)
         logger.start()
-        logger.join()
+        if not logger.join(timeout):
+            for sig in [signal.SIGTERM, signal.SIGKILL]:
+                try:
+                    killpg(process.pid, sig)
+                    process.wait(self._kill_grace)
+                    break
+                except ProcessLookupError:
+                    break
+                except TimeoutExpired:
+                    continue
+            logger.join()
+            raise SimulationRunnerException(
+                "{} timed out after {}s".format(log_tag, timeout),
+                SimulationRunnerException.ExceptionType.Timeout,
+                process.returncode,
+                (log_file,),
+            )
 
         return process.returncode, log_file
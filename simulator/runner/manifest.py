@@ -0,0 +1,160 @@
+from enum import Enum
+import fcntl
+from hashlib import sha256
+import json
+from os import path, stat
+import time
+
+from .cache import hash_file, hash_geometry
+
+
+class Manifest:
+    """
+    Persistent record of the stages completed by the runs of a campaign,
+    stored as a json-lines file. Each record holds the key of the inputs of
+    a stage and the size and modification time of its outputs, along with
+    their checksum if requested. A stage is complete if it was recorded with
+    the same input key and its outputs are still as recorded, which lets an
+    interrupted campaign resume after its last verified stage.
+    """
+
+    class Stage(Enum):
+        """Stages of a run, in order of execution"""
+
+        GEOMETRY = "geometry"
+        PHANTOM = "phantom"
+        STAGING = "staging"
+        SIMULATION = "simulation"
+
+    def __init__(self, manifest_path, verify_checksums=False):
+        """
+        Parameters
+        ----------
+        manifest_path : str
+            Json-lines file in which to record the stages
+        verify_checksums : bool, optional
+            Record the checksum of the outputs of stages, and verify them
+            by recomputing it instead of comparing their size and
+            modification time. Outputs recorded without a checksum are
+            still verified by size and modification time, default : False
+        """
+        self.path = manifest_path
+        self.verify_checksums = verify_checksums
+
+    @staticmethod
+    def get_key(*inputs):
+        return sha256(json.dumps([str(i) for i in inputs]).encode()).hexdigest()
+
+    @staticmethod
+    def get_stage_keys(
+        phantom_infos,
+        simulation_infos,
+        output_folder,
+        output_nifti=True,
+        relative_fiber_fraction=True,
+        inter_axonal_fraction=None,
+    ):
+        """
+        Input keys of the stages of a run. The key of a stage depends on the one
+        of the stage before it, so that changing the inputs of a stage
+        invalidates all the stages that follow.
+        """
+        Stage = Manifest.Stage
+        keys = {
+            Stage.GEOMETRY: Manifest.get_key(
+                hash_geometry(phantom_infos), path.abspath(output_folder)
+            )
+        }
+        keys[Stage.PHANTOM] = Manifest.get_key(
+            keys[Stage.GEOMETRY],
+            phantom_infos["resolution"],
+            phantom_infos["spacing"],
+            relative_fiber_fraction,
+            output_nifti,
+        )
+        keys[Stage.STAGING] = Manifest.get_key(
+            keys[Stage.PHANTOM],
+            simulation_infos["compartment_ids"],
+            inter_axonal_fraction,
+        )
+        keys[Stage.SIMULATION] = Manifest.get_key(
+            keys[Stage.STAGING],
+            hash_file(
+                path.join(
+                    simulation_infos["file_path"],
+                    simulation_infos["param_file"],
+                )
+            ).hexdigest(),
+        )
+        return keys
+
+    def record(self, run_name, stage, key, outputs):
+        """Records a stage of a run as complete, along with its outputs"""
+        entry = {
+            "run": run_name,
+            "stage": stage.value,
+            "key": key,
+            "outputs": {
+                path.abspath(o): self._describe(o, self.verify_checksums)
+                for o in outputs
+            },
+            "time": time.time(),
+        }
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+    def is_complete(self, run_name, stage, key):
+        """
+        Tells if a stage of a run was completed with the same input key and if
+        its outputs are still as recorded
+        """
+        entry = self._load().get((run_name, stage.value))
+        if entry is None or not entry["key"] == key:
+            return False
+
+        for output, recorded in entry["outputs"].items():
+            if not path.exists(output):
+                return False
+            checksum = self.verify_checksums and "sha256" in recorded
+            fields = ["size", "sha256" if checksum else "mtime"]
+            description = self._describe(output, checksum)
+            if any(description[f] != recorded[f] for f in fields):
+                return False
+
+        return True
+
+    def get_last_complete(self, run_name, keys):
+        """
+        Last complete stage of a run, after which it can resume, None if no
+        stage is complete
+        """
+        for stage in reversed(list(Manifest.Stage)):
+            if self.is_complete(run_name, stage, keys[stage]):
+                return stage
+
+        return None
+
+    def _describe(self, output, checksum):
+        status = stat(output)
+        description = {"size": status.st_size, "mtime": status.st_mtime_ns}
+        if checksum:
+            description["sha256"] = hash_file(output).hexdigest()
+        return description
+
+    def _load(self):
+        entries = {}
+        if not path.exists(self.path):
+            return entries
+
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                entries[(entry["run"], entry["stage"])] = entry
+
+        return entries
@@ -0,0 +1,177 @@
+from contextlib import contextmanager
+import json
+from os import getpid
+import resource
+import threading
+import time
+
+
+_IO_FIELDS = {
+    "rchar": "read_chars",
+    "wchar": "write_chars",
+    "read_bytes": "read_bytes",
+    "write_bytes": "write_bytes",
+}
+
+
+def read_process_io():
+    """
+    I/O counters of the process from /proc/self/io, which include the ones of
+    the children it waited for, None if they are not available
+    """
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(":") for line in f if ":" in line)
+    except OSError:
+        return None
+
+    return {
+        name: int(counters[field])
+        for field, name in _IO_FIELDS.items()
+        if field in counters
+    }
+
+
+def get_reuses(metrics):
+    """
+    Tells whether the phantom of a run was loaded from the cache (cache_hit),
+    whether the outputs of a previous run were reused (reused) and which stages
+    were resumed from a previous attempt (resumed_stages)
+    """
+    stages = {stage["name"]: stage for stage in metrics["stages"]}
+    return {
+        "cache_hit": stages.get("generate_phantom", {}).get("cache_hit", False),
+        "reused": "reuse_run" in stages,
+        "resumed_stages": metrics.get("resumed_stages", []),
+    }
+
+
+def _get_usage():
+    return (
+        time.time(),
+        time.perf_counter(),
+        resource.getrusage(resource.RUSAGE_SELF),
+        read_process_io(),
+    )
+
+
+def _cpu_time(usage):
+    return usage.ru_utime + usage.ru_stime
+
+
+class RunMetrics:
+    """
+    Resources used by the stages of a run. Every stage records its wall time,
+    the CPU time of the process, the CPU time and peak resident memory of the
+    tools run during the stage, collected from each of them as it ends, and the
+    I/O of the process. The CPU time and I/O of the process include the ones of
+    the other runs it executes at the same time.
+    """
+
+    def __init__(self, run_name):
+        """
+        Parameters
+        ----------
+        run_name : str
+            Name of the run measured
+        """
+        self.run_name = run_name
+        self.stages = []
+        self.attributes = {}
+        self._start = time.time()
+        self._children = []
+
+    @contextmanager
+    def stage(self, name, **attributes):
+        """
+        Measures the resources used by the block it wraps, which can add values
+        to the attributes of the stage
+        """
+        start, n_children = _get_usage(), len(self._children)
+        status = "failed"
+        try:
+            yield attributes
+            status = "complete"
+        finally:
+            self.stages.append(
+                self._measure(
+                    name,
+                    start,
+                    _get_usage(),
+                    self._children[n_children:],
+                    status,
+                    attributes,
+                )
+            )
+
+    def add_child(self, usage):
+        """
+        Records the resource usage of a tool that ended, as returned by os.wait4
+        """
+        self._children.append(usage)
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def to_dict(self):
+        return {
+            "run_name": self.run_name,
+            "start": self._start,
+            "wall_time": sum(s["wall_time"] for s in self.stages),
+            "children_max_rss": max(
+                [s["children_max_rss"] for s in self.stages], default=0
+            ),
+            "stages": self.stages,
+            **self.attributes,
+        }
+
+    def dump(self, metrics_file):
+        with open(metrics_file, "w+") as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+    def dump_chrome_trace(self, trace_file):
+        """
+        Exports the stages in the Chrome trace event format, which
+        chrome://tracing and Perfetto can display
+        """
+        events = [
+            {
+                "name": stage["name"],
+                "cat": self.run_name,
+                "ph": "X",
+                "ts": int(stage["start"] * 1e6),
+                "dur": int(stage["wall_time"] * 1e6),
+                "pid": stage["pid"],
+                "tid": stage["thread"],
+                "args": {
+                    k: v
+                    for k, v in stage.items()
+                    if k not in ["name", "start", "wall_time", "pid", "thread"]
+                },
+            }
+            for stage in self.stages
+        ]
+        with open(trace_file, "w+") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def _measure(self, name, start, end, children, status, attributes):
+        wall, perf, own, io = start
+        _, perf_end, own_end, io_end = end
+        measures = {
+            "name": name,
+            "status": status,
+            "start": wall,
+            "wall_time": perf_end - perf,
+            "cpu_time": _cpu_time(own_end) - _cpu_time(own),
+            "children_cpu_time": sum(_cpu_time(c) for c in children),
+            "max_rss": own_end.ru_maxrss * 1024,
+            "children_max_rss": max(
+                [c.ru_maxrss * 1024 for c in children], default=0
+            ),
+            "pid": getpid(),
+            "thread": threading.get_ident(),
+        }
+        if io is not None and io_end is not None:
+            measures.update({k: io_end[k] - io[k] for k in io})
+        measures.update(attributes)
+        return measures
@@ -0,0 +1,198 @@
+from copy import copy
+from os import sched_getaffinity
+import resource
+import socket
+import time
+
+from mpi4py import MPI
+
+from .batch import BatchJob, execute_job
+from .cpu import CPUBudget
+from .scheduler import FootprintModel
+
+
+_TASK_TAG = 1
+_RESULT_TAG = 2
+
+
+class MPICampaign:
+    """
+    Distributes simulation jobs over the ranks of an MPI communicator. Rank
+    0 holds the queue of jobs, sorted from the largest to the smallest
+    estimated footprint, and hands the next one to whichever worker rank
+    reports back, so that ranks drawing large jobs do not hold back the
+    others. Every worker runs its jobs with a local copy of the runner.
+
+    The worker ranks placed on a same node share its cpus : when the launcher
+    did not bind them to distinct cpus, the cpus of the node are split
+    between them, so that their tools do not run more threads than there
+    are cpus.
+    """
+
+    def __init__(
+        self,
+        runner,
+        comm=None,
+        model=None,
+        cpu_budget=True,
+        pin_cpus=False,
+        runtime_model=None,
+    ):
+        """
+        Parameters
+        ----------
+        runner : SimulationRunner
+            Runner used as template for every job
+        comm : mpi4py.MPI.Comm, optional
+            Communicator over which to distribute the jobs,
+            default : MPI.COMM_WORLD
+        model : FootprintModel, optional
+            Model used to order the jobs by size, default : FootprintModel()
+        cpu_budget : bool, optional
+            Limit the threads of the tools of every worker rank to its share
+            of the cpus of its node, default : True
+        pin_cpus : bool, optional
+            Pin the tools of every worker rank to its share of the cpus,
+            default : False
+        runtime_model : RuntimeModel, optional
+            If given, order the jobs by estimated running time instead of
+            by footprint, updating the model and the order of the remaining
+            jobs as their results come back, default : None
+        """
+        self._runner = runner
+        self._comm = comm if comm else MPI.COMM_WORLD
+        self._model = model if model else FootprintModel()
+        self._cpu_budget = cpu_budget
+        self._pin_cpus = pin_cpus
+        self._runtime_model = runtime_model
+
+    @property
+    def is_root(self):
+        return self._comm.Get_rank() == 0
+
+    def run(self, jobs=None):
+        """
+        Run a campaign. Must be called by every rank of the communicator,
+        only rank 0 needs to be given the jobs.
+
+        Parameters
+        ----------
+        jobs : list, optional
+            List of BatchJob, or of tuples and dicts describing them
+
+        Returns
+        -------
+        list(BatchResult) or None
+            On rank 0, the results of the jobs in the order of the jobs
+            list. Their metrics hold the rank and host that ran them, their
+            wall time and the peak memory of the containers run by that
+            rank so far. None on the other ranks.
+
+        """
+        if self._cpu_budget:
+            self._runner.cpu_budget = self._get_cpu_budget()
+
+        if not self.is_root:
+            self._work()
+            return None
+
+        jobs = [BatchJob.from_any(job) for job in jobs]
+        if self._comm.Get_size() == 1:
+            return [self._execute(index, job) for index, job in enumerate(jobs)]
+
+        results = self._dispatch(self._order(jobs))
+        return [results[index] for index in range(len(jobs))]
+
+    def _get_cpu_budget(self):
+        node = self._comm.Split_type(MPI.COMM_TYPE_SHARED)
+        try:
+            affinity = sorted(sched_getaffinity(0))
+            affinities = node.allgather((self._comm.Get_rank(), affinity))
+        finally:
+            node.Free()
+
+        if any(cpus != affinity for _, cpus in affinities):
+            return CPUBudget(
+                len(affinity), affinity if self._pin_cpus else None
+            )
+
+        budget = CPUBudget.available(self._pin_cpus)
+        workers = sorted(rank for rank, _ in affinities if rank != 0)
+        if self.is_root or not workers:
+            return budget
+        return budget.split(len(workers))[workers.index(self._comm.Get_rank())]
+
+    def _order(self, jobs):
+        if self._runtime_model is not None:
+            self._runtime_features = [
+                self._runtime_model.get_job_features(job) for job in jobs
+            ]
+            estimates = [
+                self._runtime_model.estimate(features)
+                for features in self._runtime_features
+            ]
+        else:
+            estimates = [
+                self._model.estimate(
+                    self._model.get_features(job.phantom_infos)
+                )
+                for job in jobs
+            ]
+        return sorted(
+            enumerate(jobs), key=lambda task: estimates[task[0]], reverse=True
+        )
+
+    def _dispatch(self, tasks):
+        results, status = {}, MPI.Status()
+        active = self._comm.Get_size() - 1
+        while active:
+            result = self._comm.recv(
+                source=MPI.ANY_SOURCE, tag=_RESULT_TAG, status=status
+            )
+            if result is not None:
+                results[result.index] = result
+                self._learn(result, tasks)
+
+            task = tasks.pop(0) if tasks else None
+            self._comm.send(task, dest=status.Get_source(), tag=_TASK_TAG)
+            if task is None:
+                active -= 1
+
+        return results
+
+    def _learn(self, result, tasks):
+        model = self._runtime_model
+        if model is None or not result.computed:
+            return
+
+        features = self._runtime_features
+        model.update(features[result.index], result.metrics["run_time"])
+        tasks.sort(
+            key=lambda task: model.estimate(features[task[0]]), reverse=True
+        )
+
+    def _work(self):
+        result = None
+        while True:
+            self._comm.send(result, dest=0, tag=_RESULT_TAG)
+            task = self._comm.recv(source=0, tag=_TASK_TAG)
+            if task is None:
+                self._runner.stop()
+                return
+            result = self._execute(*task)
+
+    def _execute(self, index, job):
+        start = time.time()
+        result = execute_job(copy(self._runner), index, job)
+        result.metrics.update(
+            {
+                "rank": self._comm.Get_rank(),
+                "host": socket.gethostname(),
+                "wall_time": time.time() - start,
+                "max_rss": resource.getrusage(
+                    resource.RUSAGE_CHILDREN
+                ).ru_maxrss
+                * 1024,
+            }
+        )
+        return result
@@ -0,0 +1,330 @@
+from os import path
+
+from lxml import etree
+import numpy as np
+
+from .volumes import Volume, get_extension
+
+
+_IGNORED_IMAGE_TAGS = [
+    "basic",
+    "gradients",
+    "artifacts",
+    "compartments",
+    "outpath",
+    "showadvanced",
+    "signalmodelstring",
+    "artifactmodelstring",
+]
+
+
+def _parse_value(text):
+    text = (text if text else "").strip()
+    if text.lower() in ["true", "false"]:
+        return text.lower() == "true"
+    for cast in [int, float]:
+        try:
+            return cast(text)
+        except ValueError:
+            pass
+    return text
+
+
+def _parse_element(element):
+    if len(element) == 0:
+        return _parse_value(element.text)
+    return {child.tag: _parse_element(child) for child in element}
+
+
+def read_simulation_parameters(param_file):
+    """
+    Reads the parameters of a simulation from its Fiberfox parameter file (ffp),
+    with the values of its fields converted to booleans and numbers
+    """
+    image = etree.parse(param_file).getroot().find("image")
+    basic = _parse_element(image.find("basic"))
+    return {
+        "size": [basic["size"][a] for a in "xyz"],
+        "spacing": [basic["spacing"][a] for a in "xyz"],
+        "origin": [basic["origin"][a] for a in "xyz"],
+        "gradients": [
+            [_parse_value(d.find(a).text) for a in "xyz"]
+            for d in image.find("gradients")
+        ],
+        "acquisition": {
+            child.tag: _parse_element(child)
+            for child in image
+            if child.tag not in _IGNORED_IMAGE_TAGS
+        },
+        "artifacts": _parse_element(image.find("artifacts")),
+        "compartments": [_parse_element(c) for c in image.find("compartments")],
+    }
+
+
+def read_gradient_table(param_file):
+    """
+    Reads the b-values and unit b-vectors simulated by a Fiberfox parameter file
+    (ffp), whose gradient directions are scaled by the square root of their
+    b-value relative to the nominal one
+    """
+    image = etree.parse(param_file).getroot().find("image")
+    gradients = np.array(
+        [
+            [float(d.find(a).text) for a in "xyz"]
+            for d in image.find("gradients")
+        ]
+    ).reshape((-1, 3))
+
+    norms = np.linalg.norm(gradients, axis=1)
+    bvals = float(image.find("bvalue").text) * norms ** 2
+    bvecs = np.divide(
+        gradients,
+        norms[:, None],
+        out=np.zeros_like(gradients),
+        where=norms[:, None] > 0,
+    )
+    return bvals, bvecs
+
+
+class OutputReader:
+    """
+    Lazy access to the diffusion weighted image output by a simulation,
+    paired with the gradient table of its parameter file. Volumes, shells
+    and slabs are read only for the bytes they need from uncompressed
+    images. Compressed images are decompressed in a single pass for every
+    access, a volume at a time, so that only the data requested is ever
+    held in memory.
+
+    The volumes are always along the last axis of the data read, including
+    for nrrd images storing the gradients along their first axis, as MITK
+    does, which are decompressed a chunk of voxels at a time instead.
+    """
+
+    def __init__(
+        self,
+        image_path,
+        param_file=None,
+        b0_threshold=50.0,
+        shell_tolerance=100.0,
+    ):
+        """
+        Parameters
+        ----------
+        image_path : str
+            Diffusion weighted image output by Fiberfox (nii, nii.gz or
+            nrrd)
+        param_file : str, optional
+            Fiberfox parameter file of the simulation, default : the ffp
+            file named after the image, next to it
+        b0_threshold : float, optional
+            B-value under which volumes are considered b0, default : 50
+        shell_tolerance : float, optional
+            Largest difference between the b-values of volumes of a same
+            shell, default : 100
+        """
+        self.image = Volume(image_path)
+        if param_file is None:
+            param_file = "{}.ffp".format(
+                image_path[: -len(get_extension(image_path)) - 1]
+            )
+        self.param_file = param_file
+        self.bvals, self.bvecs = read_gradient_table(param_file)
+        self.b0_threshold = b0_threshold
+        self.shell_tolerance = shell_tolerance
+
+        if not len(self.bvals) == self.image.shape[-1]:
+            raise ValueError(
+                "{} has {} volumes, but {} simulates {}".format(
+                    image_path,
+                    self.image.shape[-1],
+                    param_file,
+                    len(self.bvals),
+                )
+            )
+
+    @classmethod
+    def from_run(cls, output_folder, run_name, output_nifti=True, **kwargs):
+        """
+        Opens the output of a run of the SimulationRunner
+
+        Parameters
+        ----------
+        output_folder : str
+            Output folder of the run
+        run_name : str
+            Name of the run
+        output_nifti : bool, optional
+            The run output nifti images instead of nrrd, default : True
+        kwargs :
+            Other arguments given to the reader
+
+        Returns
+        -------
+        OutputReader
+            Reader of the diffusion weighted image of the run
+
+        """
+        return cls(
+            path.join(
+                output_folder,
+                "simulation",
+                "{}_simulation.{}".format(
+                    run_name, "nii.gz" if output_nifti else "nrrd"
+                ),
+            ),
+            **kwargs
+        )
+
+    @property
+    def shape(self):
+        return self.image.shape
+
+    @property
+    def n_volumes(self):
+        return self.image.shape[-1]
+
+    @property
+    def shells(self):
+        """
+        B-values of the shells of the acquisition, 0 for the b0 volumes,
+        each the mean of the b-values of its volumes
+        """
+        bvals = np.sort(self.bvals[self.bvals > self.b0_threshold])
+        shells = [0.0] if np.any(self.bvals <= self.b0_threshold) else []
+        groups = np.split(
+            bvals, np.flatnonzero(np.diff(bvals) > self.shell_tolerance) + 1
+        )
+        return shells + [float(g.mean()) for g in groups if len(g)]
+
+    def shell_indexes(self, bvalue, tolerance=None):
+        """
+        Indexes of the volumes of a shell
+
+        Parameters
+        ----------
+        bvalue : float
+            B-value of the shell, under the b0 threshold for the b0 volumes
+        tolerance : float, optional
+            Largest difference between the b-values of the volumes and the
+            one of the shell, default : the tolerance of the reader
+
+        Returns
+        -------
+        numpy.ndarray
+            Indexes of the volumes of the shell
+
+        """
+        if bvalue <= self.b0_threshold:
+            return np.flatnonzero(self.bvals <= self.b0_threshold)
+
+        tolerance = self.shell_tolerance if tolerance is None else tolerance
+        return np.flatnonzero(
+            (np.abs(self.bvals - bvalue) <= tolerance)
+            & (self.bvals > self.b0_threshold)
+        )
+
+    def by_shell(self, bvalue, tolerance=None):
+        """
+        Reads the volumes of a shell
+
+        Parameters
+        ----------
+        bvalue : float
+            B-value of the shell, under the b0 threshold for the b0 volumes
+        tolerance : float, optional
+            Largest difference between the b-values of the volumes and the
+            one of the shell, default : the tolerance of the reader
+
+        Returns
+        -------
+        tuple(numpy.ndarray, numpy.ndarray, numpy.ndarray)
+            Volumes of the shell, stacked along the last axis, with their
+            b-values and b-vectors
+
+        """
+        indexes = self.shell_indexes(bvalue, tolerance)
+        if not len(indexes):
+            raise ValueError(
+                "No volumes in shell b={:g} of {}".format(
+                    bvalue, self.image.path
+                )
+            )
+        return (
+            self.image.take(indexes),
+            self.bvals[indexes],
+            self.bvecs[indexes],
+        )
+
+    def by_volume(self, indexes):
+        """
+        Reads volumes of the image
+
+        Parameters
+        ----------
+        indexes : int or list(int)
+            Index of the volume, or indexes of the volumes, to read
+
+        Returns
+        -------
+        numpy.ndarray
+            Volume, or volumes stacked along the last axis
+
+        """
+        if np.ndim(indexes) == 0:
+            return self.image.take([indexes])[..., 0]
+        return self.image.take(indexes)
+
+    def slab(self, z0, z1, volumes=None):
+        """
+        Reads the slices [z0, z1) along the third axis of the image
+
+        Parameters
+        ----------
+        z0 : int
+            Index of the first slice
+        z1 : int
+            Index following the last slice
+        volumes : list(int), optional
+            Indexes of the volumes to read, default : all of them
+
+        Returns
+        -------
+        numpy.ndarray
+            Slab of the image, of shape (x, y, z1 - z0, n_volumes)
+
+        """
+        volumes = range(self.n_volumes) if volumes is None else volumes
+        return self.image.take(
+            volumes, (slice(None), slice(None), slice(z0, z1))
+        )
+
+    def iter_chunks(self, max_bytes=2 ** 26, volumes=None):
+        """
+        Iterates over the image in chunks of voxels, slabs along its third
+        axis holding all the requested volumes, for streaming analysis. A
+        compressed image is decompressed once per chunk.
+
+        Parameters
+        ----------
+        max_bytes : int, optional
+            Memory budget of a chunk, default : 64 MiB
+        volumes : list(int), optional
+            Indexes of the volumes to read, default : all of them
+
+        Returns
+        -------
+        generator(tuple(int, int, numpy.ndarray))
+            Start and stop indexes of the chunks along the third axis, and
+            their data
+
+        """
+        volumes = list(range(self.n_volumes) if volumes is None else volumes)
+        plane_bytes = (
+            int(np.prod(self.shape[:2]))
+            * len(volumes)
+            * self.image.dtype.itemsize
+        )
+        step = max(1, int(max_bytes // plane_bytes))
+        for z0 in range(0, self.shape[2], step):
+            z1 = min(z0 + step, self.shape[2])
+            yield z0, z1, self.slab(z0, z1, volumes)
@@ -0,0 +1,406 @@
+from contextlib import contextmanager
+from hashlib import sha256
+import json
+from os import makedirs, path
+import socket
+import sqlite3
+import time
+
+from .cache import get_geometry_files, hash_geometry, materialize
+from .reader import read_simulation_parameters
+from .scheduler import get_phantom_maps
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_name TEXT NOT NULL,
+    output_folder TEXT NOT NULL,
+    key TEXT NOT NULL,
+    geometry_key TEXT NOT NULL,
+    simulation_key TEXT NOT NULL,
+    gradients_key TEXT NOT NULL,
+    status TEXT NOT NULL,
+    parameters TEXT NOT NULL,
+    outputs TEXT,
+    metrics TEXT,
+    error TEXT,
+    reused_from INTEGER,
+    host TEXT,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS runs_key ON runs (key, status);
+CREATE INDEX IF NOT EXISTS runs_name ON runs (run_name);
+CREATE INDEX IF NOT EXISTS runs_geometry ON runs (geometry_key);
+CREATE INDEX IF NOT EXISTS runs_simulation ON runs (simulation_key);
+"""
+
+_JSON_COLUMNS = ["parameters", "outputs", "metrics"]
+
+
+def _get_digest(value):
+    return sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+
+def get_geometry_parameters(phantom_infos):
+    """
+    Parameters defining the phantom generated from a geometry configuration,
+    independently of the name and location of its files : digest of the files,
+    resolution, spacing, counts of maps, fibres and fibre samples, clusters and
+    spheres
+    """
+    geometry_files = get_geometry_files(phantom_infos)
+    with open(geometry_files[0]) as f:
+        base = json.load(f)
+
+    clusters = []
+    for cluster_file in geometry_files[1:]:
+        with open(cluster_file) as f:
+            cluster = json.load(f)
+        clusters.append(
+            {
+                "meta": cluster["meta"],
+                "bundles": [
+                    {k: v for k, v in bundle.items() if not k == "anchors"}
+                    for bundle in cluster["data"]
+                ],
+            }
+        )
+
+    return {
+        "key": hash_geometry(phantom_infos),
+        "resolution": list(phantom_infos["resolution"]),
+        "spacing": list(phantom_infos["spacing"]),
+        "n_maps": get_phantom_maps(phantom_infos),
+        "fibres": sum(c["meta"]["density"] for c in clusters),
+        "samples": sum(
+            c["meta"]["density"] * sum(b["sampling"] for b in c["bundles"])
+            for c in clusters
+        ),
+        "clusters": clusters,
+        "spheres": [s for s in base.get("structures", []) if "names" not in s],
+    }
+
+
+def get_simulation_parameters(simulation_infos):
+    """
+    Parameters of a simulation configuration, read from its Fiberfox parameter
+    file, with a digest of its gradient directions
+    """
+    parameters = read_simulation_parameters(
+        path.join(simulation_infos["file_path"], simulation_infos["param_file"])
+    )
+    directions = parameters["gradients"]
+    parameters["gradients"] = {
+        "count": len(directions),
+        "key": _get_digest(directions),
+    }
+    return parameters
+
+
+class RunRegistry:
+    """
+    Index of the runs of the simulator, stored in a SQLite database. Every
+    run is recorded with the normalised parameters of its geometry and of
+    its simulation, its options, status, outputs and metrics, and a key
+    identifying its inputs. Runs can be queried by status, name, key or by
+    any parameter, and a finished run can be found by key and its outputs
+    reused by a run with identical inputs.
+    """
+
+    def __init__(self, db_path, timeout=30.0):
+        """
+        Parameters
+        ----------
+        db_path : str
+            SQLite database holding the registry, created if missing
+        timeout : float, optional
+            Seconds to wait for the lock of the database when other
+            processes are writing to it, default : 30
+        """
+        self.path = path.abspath(db_path)
+        self.timeout = timeout
+        makedirs(path.dirname(self.path), exist_ok=True)
+        with self._connect() as db:
+            db.executescript(_SCHEMA)
+
+    @staticmethod
+    def describe(
+        phantom_infos,
+        simulation_infos,
+        output_nifti=True,
+        relative_fiber_fraction=True,
+        inter_axonal_fraction=None,
+    ):
+        """
+        Computes the key and the normalised parameters of a run
+
+        Parameters
+        ----------
+        phantom_infos : GeometryInfos or dict
+            Geometry configuration generated by the GeometryHandler
+        simulation_infos : SimulationInfos or dict
+            Simulation configuration generated by the SimulationHandler
+        output_nifti : bool, optional
+            Outputs written as nifti instead of nrrd, default : True
+        relative_fiber_fraction : bool, optional
+            Fiber fraction computed relatively, default : True
+        inter_axonal_fraction : float, optional
+            Fraction of the fibers volume given to the inter-axonal
+            compartment, default : None
+
+        Returns
+        -------
+        tuple(str, dict)
+            Key of the run, and its geometry, simulation and options
+            parameters
+
+        """
+        parameters = {
+            "geometry": get_geometry_parameters(phantom_infos),
+            "simulation": get_simulation_parameters(simulation_infos),
+            "options": {
+                "output_nifti": output_nifti,
+                "relative_fiber_fraction": relative_fiber_fraction,
+                "inter_axonal_fraction": inter_axonal_fraction,
+            },
+        }
+        return _get_digest(parameters), parameters
+
+    def register(self, run_name, output_folder, key, parameters):
+        """
+        Records the start of a run
+
+        Parameters
+        ----------
+        run_name : str
+            Name of the run
+        output_folder : str
+            Folder in which the outputs of the run are written
+        key : str
+            Key of the run, as returned by describe
+        parameters : dict
+            Parameters of the run, as returned by describe
+
+        Returns
+        -------
+        int
+            Identifier of the run in the registry
+
+        """
+        with self._connect() as db:
+            return db.execute(
+                "INSERT INTO runs (run_name, output_folder, key, "
+                "geometry_key, simulation_key, gradients_key, status, "
+                "parameters, host, started) "
+                "VALUES (?, ?, ?, ?, ?, ?, 'running', ?, ?, ?)",
+                (
+                    run_name,
+                    path.abspath(output_folder),
+                    key,
+                    parameters["geometry"]["key"],
+                    _get_digest(parameters["simulation"]),
+                    parameters["simulation"]["gradients"]["key"],
+                    json.dumps(parameters),
+                    socket.gethostname(),
+                    time.time(),
+                ),
+            ).lastrowid
+
+    def complete(self, run_id, outputs, metrics=None, reused_from=None):
+        """
+        Records a run as complete
+
+        Parameters
+        ----------
+        run_id : int
+            Identifier of the run, as returned by register
+        outputs : dict
+            Outputs of the run, holding the path of the simulated image
+            under "simulation" and all the files produced under "files"
+        metrics : dict, optional
+            Metrics of the run (see RunMetrics), default : None
+        reused_from : int, optional
+            Identifier of the run whose outputs were reused,
+            default : None
+        """
+        with self._connect() as db:
+            db.execute(
+                "UPDATE runs SET status = 'complete', outputs = ?, "
+                "metrics = ?, reused_from = ?, finished = ? WHERE id = ?",
+                (
+                    json.dumps(outputs),
+                    json.dumps(metrics),
+                    reused_from,
+                    time.time(),
+                    run_id,
+                ),
+            )
+
+    def fail(self, run_id, error, metrics=None):
+        """
+        Records a run as failed
+
+        Parameters
+        ----------
+        run_id : int
+            Identifier of the run, as returned by register
+        error : Exception or str
+            Error that made the run fail
+        metrics : dict, optional
+            Metrics of the run (see RunMetrics), default : None
+        """
+        with self._connect() as db:
+            db.execute(
+                "UPDATE runs SET status = 'failed', error = ?, metrics = ?, "
+                "finished = ? WHERE id = ?",
+                (str(error), json.dumps(metrics), time.time(), run_id),
+            )
+
+    def get(self, run_id):
+        runs = self.query(id=run_id)
+        return runs[0] if runs else None
+
+    def query(self, parameters=None, limit=None, **columns):
+        """
+        Finds the runs matching the given criteria, most recent first
+
+        Parameters
+        ----------
+        parameters : dict, optional
+            Values of parameters the runs must have, indexed by their path
+            in the parameters of the run (e.g. "simulation.acquisition.tEcho"
+            or "geometry.resolution[0]"), default : None
+        limit : int, optional
+            Maximum number of runs returned, default : None
+        columns :
+            Values of the columns the runs must have (id, run_name,
+            output_folder, key, geometry_key, simulation_key, gradients_key,
+            status, host)
+
+        Returns
+        -------
+        list(dict)
+            Runs matching the criteria, with their parameters, outputs and
+            metrics decoded
+
+        """
+        conditions, values = [], []
+        for column, value in columns.items():
+            if column not in [
+                "id",
+                "run_name",
+                "output_folder",
+                "key",
+                "geometry_key",
+                "simulation_key",
+                "gradients_key",
+                "status",
+                "host",
+            ]:
+                raise ValueError("Unknown column {}".format(column))
+            conditions.append("{} = ?".format(column))
+            values.append(value)
+
+        for name, value in (parameters if parameters else {}).items():
+            conditions.append("json_extract(parameters, ?) = ?")
+            values += ["$." + name, value]
+
+        statement = "SELECT * FROM runs"
+        if conditions:
+            statement += " WHERE " + " AND ".join(conditions)
+        statement += " ORDER BY id DESC"
+        if limit:
+            statement += " LIMIT {:d}".format(limit)
+
+        with self._connect() as db:
+            return [self._decode(row) for row in db.execute(statement, values)]
+
+    def find_reusable(self, key, output_folder=None):
+        """
+        Finds the most recent complete run with the given key whose outputs
+        are all still present
+
+        Parameters
+        ----------
+        key : str
+            Key of the run, as returned by describe
+        output_folder : str, optional
+            Folder of the run looking for outputs to reuse, whose own runs
+            are not offered, default : None
+
+        Returns
+        -------
+        dict or None
+            Run found, None if there is none
+
+        """
+        folder = path.abspath(output_folder) if output_folder else None
+        for run in self.query(key=key, status="complete"):
+            if run["output_folder"] == folder:
+                continue
+            if run["outputs"] and all(
+                path.exists(f) for f in run["outputs"]["files"]
+            ):
+                return run
+
+        return None
+
+    @staticmethod
+    def reuse(run, run_name, output_folder):
+        """
+        Materializes the outputs of a run for another run, renaming them
+        after it, without copying their data when possible
+
+        Parameters
+        ----------
+        run : dict
+            Run whose outputs are reused, as returned by query
+        run_name : str
+            Name of the run reusing them
+        output_folder : str
+            Folder in which to write the outputs of that run
+
+        Returns
+        -------
+        dict
+            Outputs of the run reusing them, as given to complete
+
+        """
+        source_folder = run["output_folder"]
+        files = {}
+        for source in run["outputs"]["files"]:
+            relative = path.relpath(source, source_folder)
+            folder, name = path.split(relative)
+            if name.startswith(run["run_name"]):
+                name = run_name + name[len(run["run_name"]) :]
+            files[source] = path.join(output_folder, folder, name)
+
+        for source, destination in files.items():
+            if path.realpath(source) == path.realpath(destination):
+                continue
+            makedirs(path.dirname(destination), exist_ok=True)
+            materialize(source, destination)
+
+        return {
+            "simulation": files[run["outputs"]["simulation"]],
+            "files": list(files.values()),
+        }
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=self.timeout)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _decode(self, row):
+        run = dict(row)
+        for column in _JSON_COLUMNS:
+            if run[column] is not None:
+                run[column] = json.loads(run[column])
+        return run
@@ -0,0 +1,89 @@
+import time
+
+from ..exceptions import SimulationRunnerException
+
+
+class RetryPolicy:
+    """
+    Number of times a failed run is attempted again, depending on the type
+    of its error. Errors in the parameters of a run are never retried, as
+    they would fail the same way every time.
+    """
+
+    _never = [SimulationRunnerException.ExceptionType.Parameters]
+
+    def __init__(self, retries=None, default=0, delay=0.0, backoff=2.0):
+        """
+        Parameters
+        ----------
+        retries : dict, optional
+            Maximum number of retries of a run, indexed by the
+            SimulationRunnerException.ExceptionType (or its name) of the
+            error that made it fail, default : None
+        default : int, optional
+            Maximum number of retries for the other errors, including the
+            ones that are not a SimulationRunnerException, default : 0
+        delay : float, optional
+            Seconds to wait before the first retry, default : 0
+        backoff : float, optional
+            Factor by which the delay grows at every retry, default : 2
+        """
+        ExceptionType = SimulationRunnerException.ExceptionType
+        self.retries = {}
+        for err_type, n in (retries if retries else {}).items():
+            if not isinstance(err_type, ExceptionType):
+                err_type = ExceptionType[err_type]
+            self.retries[err_type] = n
+        self.default = default
+        self.delay = delay
+        self.backoff = backoff
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Creates the policy from a dict of its parameters, such as the
+        "retry_policy" key of the configuration, where the retries are
+        indexed by the name of the error types
+
+        Parameters
+        ----------
+        config : dict
+            Parameters of the policy
+
+        Returns
+        -------
+        RetryPolicy
+            Policy configured
+
+        """
+        return cls(**config)
+
+    def get_retries(self, exception):
+        if not isinstance(exception, SimulationRunnerException):
+            return self.default
+        if exception.err_type in self._never:
+            return 0
+        return self.retries.get(exception.err_type, self.default)
+
+    def should_retry(self, exception, attempt):
+        """
+        Tells if a run should be attempted again after failing
+
+        Parameters
+        ----------
+        exception : Exception
+            Error that made the run fail
+        attempt : int
+            Number of attempts of the run so far, starting at 1
+
+        Returns
+        -------
+        bool
+            True if the run should be attempted again
+
+        """
+        return attempt <= self.get_retries(exception)
+
+    def wait(self, attempt):
+        if self.delay:
+            time.sleep(self.delay * self.backoff ** (attempt - 1))
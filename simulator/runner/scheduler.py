@@ -0,0 +1,517 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from copy import copy
+import json
+from os import path, sysconf
+import resource
+
+from lxml import etree
+import numpy as np
+from scipy.optimize import nnls
+
+from simulator.factory.geometry_factory.handlers import GeometryHandler
+from simulator.factory.simulation_factory.parameters import GradientProfile
+from .batch import BatchExecutor, BatchJob, execute_job
+from .cache import get_geometry_files
+from .metrics import get_reuses
+
+
+def get_available_memory():
+    """Memory in bytes available without swapping, as reported by the kernel"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return sysconf("SC_AVPHYS_PAGES") * sysconf("SC_PAGE_SIZE")
+
+
+def _load_clusters(phantom_infos):
+    for cluster_file in get_geometry_files(phantom_infos)[1:]:
+        with open(cluster_file) as f:
+            yield json.load(f)
+
+
+def get_phantom_maps(phantom_infos):
+    """
+    Number of maps of a phantom, one for the fibres and one per sphere.
+    Configurations written by hand, without the count, are counted from their
+    base json file.
+    """
+    if "n_maps" in phantom_infos:
+        return phantom_infos["n_maps"]
+
+    base_file = path.join(
+        phantom_infos["file_path"], phantom_infos["base_file"]
+    )
+    with open(base_file) as f:
+        base = json.load(f)
+
+    return 1 + sum(
+        1
+        for structure in base.get("structures", [])
+        if "names" not in structure
+    )
+
+
+def get_geometry_size(geometry):
+    """
+    Number of fibre samples (fibres of every bundle times the bundle sampling)
+    and of voxels over all the maps of the phantom generated from a geometry
+    handler or configuration
+    """
+    if isinstance(geometry, GeometryHandler):
+        clusters = [json.loads(c.serialize()) for c in geometry.get_clusters()]
+        n_maps = len(geometry.get_spheres()) + 1
+        resolution = geometry.get_resolution()
+    else:
+        clusters = _load_clusters(geometry)
+        n_maps = get_phantom_maps(geometry)
+        resolution = geometry["resolution"]
+
+    samples = sum(
+        cluster["meta"]["density"]
+        * sum(bundle["sampling"] for bundle in cluster["data"])
+        for cluster in clusters
+    )
+    return samples, int(np.prod(resolution)) * n_maps
+
+
+def get_simulation_size(simulation, resolution=None):
+    """
+    Number of voxels and of volumes of the image of a simulation, read from its
+    parameter file, or from a gradient profile and the resolution
+    """
+    if isinstance(simulation, GradientProfile):
+        return int(np.prod(resolution)), len(simulation.get_bvals())
+
+    image = (
+        etree.parse(
+            path.join(simulation["file_path"], simulation["param_file"])
+        )
+        .getroot()
+        .find("image")
+    )
+    resolution = [int(image.find("basic/size/" + a).text) for a in "xyz"]
+    return int(np.prod(resolution)), len(image.find("gradients"))
+
+
+def _execute_measured_job(runner, index, job):
+    result = execute_job(runner, index, job)
+    peak = sum(
+        resource.getrusage(who).ru_maxrss
+        for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]
+    )
+    return result, peak * 1024
+
+
+class FootprintModel:
+    """
+    Estimates the peak memory of a simulation from the size of its geometry.
+    The fibre samples (fibres of every bundle times the bundle sampling)
+    dominate, at ~900 bytes each (~90 kB per fibre at 100 samples), followed
+    by the maps generated over the voxels of the phantom. The estimate is
+    scaled by a correction learned from the peak memory of completed jobs.
+    """
+
+    def __init__(
+        self,
+        bytes_per_sample=900,
+        bytes_per_voxel=32,
+        base_bytes=2 ** 28,
+        margin=1.2,
+        learning_rate=0.5,
+    ):
+        """
+        Parameters
+        ----------
+        bytes_per_sample : float, optional
+            Memory used per fibre sample, default : 900
+        bytes_per_voxel : float, optional
+            Memory used per voxel of each phantom map, default : 32
+        base_bytes : int, optional
+            Memory used by a simulation regardless of its size,
+            default : 256 MiB
+        margin : float, optional
+            Factor applied to the estimates as a safety margin, default : 1.2
+        learning_rate : float, optional
+            Weight given to each new observation in the correction,
+            between 0 and 1, default : 0.5
+        """
+        self.bytes_per_sample = bytes_per_sample
+        self.bytes_per_voxel = bytes_per_voxel
+        self.base_bytes = base_bytes
+        self.margin = margin
+        self.learning_rate = learning_rate
+        self.correction = 1.0
+
+    def get_features(self, geometry):
+        """
+        Computes the quantities on which the memory of a simulation depends
+
+        Parameters
+        ----------
+        geometry : GeometryHandler, GeometryInfos or dict
+            Geometry of the simulation, either as a handler or as the
+            configuration it generated
+
+        Returns
+        -------
+        tuple(int, int)
+            Number of fibre samples and of voxels over all phantom maps
+
+        """
+        return get_geometry_size(geometry)
+
+    def _raw_estimate(self, features):
+        samples, voxels = features
+        return (
+            self.base_bytes
+            + self.bytes_per_sample * samples
+            + self.bytes_per_voxel * voxels
+        )
+
+    def estimate(self, features):
+        """
+        Estimates the peak memory of a simulation
+
+        Parameters
+        ----------
+        features : tuple(int, int)
+            Features of the simulation, as returned by get_features
+
+        Returns
+        -------
+        int
+            Estimated peak memory in bytes
+
+        """
+        return int(self._raw_estimate(features) * self.correction * self.margin)
+
+    def update(self, features, peak_memory):
+        """
+        Corrects the model from the peak memory observed for a simulation
+
+        Parameters
+        ----------
+        features : tuple(int, int)
+            Features of the simulation, as returned by get_features
+        peak_memory : int
+            Peak memory used by the simulation, in bytes
+
+        """
+        if peak_memory <= 0:
+            return
+
+        ratio = peak_memory / self._raw_estimate(features)
+        self.correction += self.learning_rate * (ratio - self.correction)
+
+
+class RuntimeModel:
+    """
+    Estimates the running time of a simulation as a linear combination of
+    its size : a fixed cost, the fibre samples and the voxels of the
+    phantom generated by voxsim, and the voxels times the volumes of the
+    image simulated by Fiberfox. The weights start from rough defaults,
+    scaled by the ratio of the observed running times to the estimated
+    ones until enough simulations have been observed to fit every weight
+    by non-negative least squares.
+    """
+
+    def __init__(
+        self,
+        base_seconds=10.0,
+        seconds_per_sample=2e-5,
+        seconds_per_voxel=1e-6,
+        seconds_per_dwi_voxel=1e-4,
+        max_observations=1000,
+    ):
+        """
+        Parameters
+        ----------
+        base_seconds : float, optional
+            Running time of a simulation regardless of its size,
+            default : 10
+        seconds_per_sample : float, optional
+            Running time per fibre sample, default : 2e-5
+        seconds_per_voxel : float, optional
+            Running time per voxel of each phantom map, default : 1e-6
+        seconds_per_dwi_voxel : float, optional
+            Running time per voxel of each simulated volume, default : 1e-4
+        max_observations : int, optional
+            Number of most recent observations kept to fit the weights,
+            default : 1000
+        """
+        self.prior = np.array(
+            [
+                base_seconds,
+                seconds_per_sample,
+                seconds_per_voxel,
+                seconds_per_dwi_voxel,
+            ]
+        )
+        self.weights = self.prior.copy()
+        self.max_observations = max_observations
+        self._observations = []
+
+    def get_features(self, geometry, simulation):
+        """
+        Computes the quantities on which the running time of a simulation
+        depends
+
+        Parameters
+        ----------
+        geometry : GeometryHandler, GeometryInfos or dict
+            Geometry of the simulation, either as a handler or as the
+            configuration it generated
+        simulation : SimulationInfos, dict or GradientProfile
+            Configuration of the simulation, or its gradient profile, in
+            which case the image is taken to have the resolution of the
+            geometry
+
+        Returns
+        -------
+        tuple(int, int, int)
+            Number of fibre samples, of voxels over all phantom maps and
+            of voxels over all simulated volumes
+
+        """
+        samples, voxels = get_geometry_size(geometry)
+        resolution = (
+            geometry.get_resolution()
+            if isinstance(geometry, GeometryHandler)
+            else geometry["resolution"]
+        )
+        dwi_voxels, volumes = get_simulation_size(simulation, resolution)
+        return samples, voxels, dwi_voxels * volumes
+
+    def get_job_features(self, job):
+        return self.get_features(job.phantom_infos, job.simulation_infos)
+
+    def estimate(self, features):
+        """
+        Estimates the running time of a simulation
+
+        Parameters
+        ----------
+        features : tuple(int, int, int)
+            Features of the simulation, as returned by get_features
+
+        Returns
+        -------
+        float
+            Estimated running time in seconds
+
+        """
+        return float(np.dot(self.weights, (1,) + tuple(features)))
+
+    def update(self, features, runtime):
+        """
+        Refits the model with the running time observed for a simulation
+
+        Parameters
+        ----------
+        features : tuple(int, int, int)
+            Features of the simulation, as returned by get_features
+        runtime : float
+            Running time of the simulation, in seconds
+
+        """
+        if runtime <= 0:
+            return
+
+        self._observations.append(((1,) + tuple(features), runtime))
+        del self._observations[: -self.max_observations]
+        self._fit()
+
+    def learn_from_metrics(self, jobs):
+        """
+        Updates the model with the metrics recorded by the previous runs of
+        jobs (see SimulationRunner.run), skipping the jobs that have none,
+        that failed, that were resumed from a previous attempt or whose
+        phantom was not generated, but reused or loaded from the cache
+
+        Parameters
+        ----------
+        jobs : list
+            List of BatchJob, or of tuples and dicts describing them
+
+        Returns
+        -------
+        int
+            Number of runs learned from
+
+        """
+        learned = 0
+        for job in [BatchJob.from_any(job) for job in jobs]:
+            metrics_file = path.join(
+                job.output_folder, "{}_metrics.json".format(job.run_name)
+            )
+            if not path.exists(metrics_file):
+                continue
+
+            with open(metrics_file) as f:
+                metrics = json.load(f)
+
+            stages = [stage["name"] for stage in metrics["stages"]]
+            if (
+                "simulate_diffusion_mri" not in stages
+                or "generate_phantom" not in stages
+                or any(get_reuses(metrics).values())
+                or any(
+                    stage["status"] != "complete" for stage in metrics["stages"]
+                )
+            ):
+                continue
+
+            self.update(self.get_job_features(job), metrics["wall_time"])
+            learned += 1
+
+        return learned
+
+    def _fit(self):
+        terms = np.array([t for t, _ in self._observations]) * self.prior
+        times = np.array([t for _, t in self._observations])
+        if len(times) < len(self.prior):
+            self.weights = self.prior * times.sum() / terms.sum(axis=1).sum()
+            return
+
+        # Non-negative least squares over weights relative to the prior, so
+        # that the terms are of the same magnitude
+        scales, _ = nnls(terms, times)
+        self.weights = self.prior * scales
+
+
+class MemoryScheduler(BatchExecutor):
+    """
+    Executes simulation jobs concurrently while the sum of their estimated
+    peak memory stays under a budget. Jobs are admitted in order, skipping
+    the ones that do not fit yet, and a job larger than the whole budget
+    runs alone. Every job runs in a fresh process, from which the peak
+    memory of its containers is measured to correct the footprint model.
+    When given a runtime model, the jobs are considered for admission
+    longest estimated first.
+    """
+
+    def __init__(
+        self,
+        runner,
+        memory_budget=None,
+        max_workers=None,
+        model=None,
+        cpu_budget=None,
+        runtime_model=None,
+    ):
+        """
+        Parameters
+        ----------
+        runner : SimulationRunner
+            Runner used as template for every job
+        memory_budget : int, optional
+            Memory in bytes that the running jobs may use together,
+            default : memory available on the machine
+        max_workers : int, optional
+            Maximum number of jobs running at the same time,
+            default : number of cpus on the machine
+        model : FootprintModel, optional
+            Model used to estimate the memory of the jobs,
+            default : FootprintModel()
+        cpu_budget : CPUBudget, optional
+            Cpus shared by the running jobs, default : None
+        runtime_model : RuntimeModel, optional
+            Model used to admit the longest jobs first, default : None
+        """
+        super().__init__(runner, max_workers, True, cpu_budget, runtime_model)
+        self.memory_budget = (
+            memory_budget if memory_budget else get_available_memory()
+        )
+        self.model = model if model else FootprintModel()
+
+    def map(self, jobs, ordered=True):
+        """
+        Run all the jobs and yield their results
+
+        Parameters
+        ----------
+        jobs : list
+            List of BatchJob, or of tuples and dicts describing them
+        ordered : bool, optional
+            Yield the results in the order of the jobs list instead of in
+            their order of completion, default : True
+
+        Returns
+        -------
+        generator(BatchResult)
+            Results of the jobs, one per job
+
+        """
+        jobs = [BatchJob.from_any(job) for job in jobs]
+        features = [self.model.get_features(job.phantom_infos) for job in jobs]
+        runtime_features = (
+            [self.runtime_model.get_job_features(job) for job in jobs]
+            if self.runtime_model is not None
+            else None
+        )
+        pending, running, results = list(range(len(jobs))), {}, {}
+        next_index = 0
+        self._free_budgets = list(self._cpu_budgets or [])
+
+        try:
+            while pending or running:
+                if runtime_features is not None:
+                    pending.sort(
+                        key=lambda i: self.runtime_model.estimate(
+                            runtime_features[i]
+                        ),
+                        reverse=True,
+                    )
+                self._admit(jobs, features, pending, running)
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    index, _, pool, budget = running.pop(future)
+                    pool.shutdown()
+                    if budget is not None:
+                        self._free_budgets.append(budget)
+                    result, peak_memory = future.result()
+                    if result.succeeded and not result.reused:
+                        self.model.update(features[index], peak_memory)
+                    if runtime_features is not None and result.computed:
+                        self.runtime_model.update(
+                            runtime_features[index], result.metrics["run_time"]
+                        )
+                    results[index] = result
+
+                if not ordered:
+                    for index in list(results):
+                        yield results.pop(index)
+                while next_index in results:
+                    yield results.pop(next_index)
+                    next_index += 1
+        finally:
+            for _, _, pool, _ in running.values():
+                pool.shutdown()
+
+    def _admit(self, jobs, features, pending, running):
+        used = sum(estimate for _, estimate, _, _ in running.values())
+        for index in list(pending):
+            if len(running) >= self._max_workers:
+                return
+
+            estimate = self.model.estimate(features[index])
+            if running and used + estimate > self.memory_budget:
+                continue
+
+            runner, budget = copy(self._runner), None
+            if self._free_budgets:
+                budget = self._free_budgets.pop(0)
+                runner.cpu_budget = budget
+
+            pool = ProcessPoolExecutor(1)
+            future = pool.submit(
+                _execute_measured_job, runner, index, jobs[index]
+            )
+            running[future] = (index, estimate, pool, budget)
+            pending.remove(index)
+            used += estimate
@@ -1,79 +1,522 @@
 import logging
 
-from asyncio import get_event_loop, new_event_loop, set_event_loop
-from os import makedirs, path
+from asyncio import (
+    Queue,
+    StreamReader,
+    StreamReaderProtocol,
+    ensure_future,
+    gather,
+    get_event_loop,
+    get_running_loop,
+    new_event_loop,
+    set_event_loop,
+    shield,
+    wait,
+)
+from os import (
+    environ,
+    killpg,
+    listdir,
+    makedirs,
+    path,
+    remove,
+    wait4,
+    waitstatus_to_exitcode,
+)
 from os.path import basename
+from shutil import copyfile
+import signal
 from subprocess import PIPE, Popen
+from threading import Thread
+import time
+
+import numpy as np
 
 from config import get_config
-from .datastore import Datastore
-from ..utils.logging import RTLogging
+from .batch import BatchExecutor
+from .cache import PhantomCache, get_geometry_files
+from .cpu import CPUBudget
+from .datastore import Datastore, get_unit_fraction_approximations
+from .impl import get_backend
+from .manifest import Manifest
+from .metrics import RunMetrics
+from .registry import RunRegistry
+from .retry import RetryPolicy
+from .scheduler import MemoryScheduler, RuntimeModel
+from .volumes import merge_volumes
+from ..exceptions import SimulationRunnerException
 
 
 logger = logging.getLogger(basename(__file__).split(".")[0])
 
 
+class _ChildProcess:
+    """
+    Command running in a child process, reaped with wait4 by a thread of its
+    own to collect its resource usage, which the asyncio child watchers
+    discard
+    """
+
+    def __init__(self, process):
+        self.pid = process.pid
+        self.usage = None
+        self.stdout = self.stderr = None
+        self._process = process
+        self._exit = get_running_loop().create_future()
+        Thread(
+            target=self._reap, args=(get_running_loop(),), daemon=True
+        ).start()
+
+    @classmethod
+    async def spawn(cls, command, **kwargs):
+        child = cls(
+            Popen(command.split(" "), stdout=PIPE, stderr=PIPE, **kwargs)
+        )
+        child.stdout = await cls._read_pipe(child._process.stdout)
+        child.stderr = await cls._read_pipe(child._process.stderr)
+        return child
+
+    @staticmethod
+    async def _read_pipe(pipe):
+        stream = StreamReader()
+        await get_running_loop().connect_read_pipe(
+            lambda: StreamReaderProtocol(stream), pipe
+        )
+        return stream
+
+    def _reap(self, loop):
+        try:
+            _, status, usage = wait4(self.pid, 0)
+            return_code = waitstatus_to_exitcode(status)
+        except ChildProcessError:
+            return_code, usage = 255, None
+        loop.call_soon_threadsafe(self._set_exit, return_code, usage)
+
+    def _set_exit(self, return_code, usage):
+        self._process.returncode = return_code
+        self.usage = usage
+        self._exit.set_result(return_code)
+
+    async def wait(self):
+        return await shield(self._exit)
+
+
 class AsyncRunner:
-    def __init__(self):
+    _read_size = 2 ** 16
+    _kill_grace = 10.0
+
+    def __init__(
+        self, max_concurrent_commands=None, output_timeout=None, cpu_budget=None
+    ):
         self._event_loop = new_event_loop()
+        self._max_concurrent_commands = max_concurrent_commands
+        self._output_timeout = output_timeout
+        self.cpu_budget = cpu_budget
+        self._metrics = None
 
     def start(self):
         self._start_loop_if_closed()
 
     def stop(self):
+        self._close_loop()
+
+    def _close_loop(self):
         if not self._event_loop.is_closed():
             self._event_loop.close()
 
-    def _run_command(self, command, log_file, log_tag):
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_event_loop")
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._event_loop = new_event_loop()
+
+    def _run_command(self, command, log_file, log_tag, timeout=None):
+        return self._run_commands(
+            [(command, log_file, log_tag)], timeout=timeout
+        )[0]
+
+    def _run_commands(self, commands, max_concurrent=None, timeout=None):
+        self._start_loop_if_closed()
         set_event_loop(self._event_loop)
         async_loop = get_event_loop()
-        async_loop.run_until_complete(
-            self._run_async(command, log_file, log_tag)
+        results = async_loop.run_until_complete(
+            self._run_all_async(commands, max_concurrent, timeout)
         )
-        async_loop.close()
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+        return results
 
     def _start_loop_if_closed(self):
         if self._event_loop.is_closed():
             self._event_loop = new_event_loop()
 
-    async def _run_async(self, command, log_file, log_tag):
-        process = Popen(command.split(" "), stdout=PIPE, stderr=PIPE)
+    async def _run_all_async(self, commands, max_concurrent=None, timeout=None):
+        max_concurrent = (
+            max_concurrent if max_concurrent else self._max_concurrent_commands
+        )
+        n_slots = len(commands)
+        if max_concurrent:
+            n_slots = max(1, min(n_slots, max_concurrent))
+
+        slots = Queue()
+        for budget in (
+            self.cpu_budget.split(n_slots)
+            if self.cpu_budget is not None
+            else [None] * n_slots
+        ):
+            slots.put_nowait(budget)
+
+        return await gather(
+            *[
+                self._run_async(command, log_file, log_tag, slots, timeout)
+                for command, log_file, log_tag in commands
+            ],
+            return_exceptions=True
+        )
+
+    async def _run_async(
+        self, command, log_file, log_tag, slots=None, timeout=None, budget=None
+    ):
+        if slots is not None:
+            budget = await slots.get()
+            try:
+                return await self._run_async(
+                    command, log_file, log_tag, timeout=timeout, budget=budget
+                )
+            finally:
+                slots.put_nowait(budget)
+
+        watched = bool(timeout or self._output_timeout)
+        process = await _ChildProcess.spawn(
+            command,
+            start_new_session=watched,
+            env=self._get_environment(budget),
+            preexec_fn=budget.pin if budget and budget.cpus else None,
+        )
+
+        activity = [time.monotonic()]
+        with open(log_file, "a+") as log:
+            pump = ensure_future(
+                gather(
+                    self._log_stream(
+                        process.stdout, log, log_tag, "STD", activity
+                    ),
+                    self._log_stream(
+                        process.stderr, log, log_tag, "ERR", activity
+                    ),
+                )
+            )
+            execution = ensure_future(gather(pump, process.wait()))
+            reason = None
+            if watched:
+                reason = await self._watch(execution, activity, timeout)
+            if reason is None:
+                await execution
+            else:
+                log.write(
+                    "{}[WATCHDOG] {}, killing process group {}\n".format(
+                        log_tag, reason, process.pid
+                    )
+                )
+                log.flush()
+                await self._kill_process_group(process)
+                await wait([pump], timeout=self._kill_grace)
+                execution.cancel()
+
+        return_code = await process.wait()
+        if self._metrics is not None and process.usage is not None:
+            self._metrics.add_child(process.usage)
+        if reason is not None:
+            raise SimulationRunnerException(
+                "{} {}".format(log_tag, reason),
+                SimulationRunnerException.ExceptionType.Timeout,
+                return_code,
+                (log_file,),
+            )
 
-        logger = RTLogging(process, log_file, log_tag)
-        logger.start()
-        logger.join()
+        return return_code, log_file
 
-        return process.returncode, log_file
+    def _get_environment(self, budget):
+        if budget is None:
+            return None
+        return dict(environ, **budget.get_environment())
+
+    async def _watch(self, execution, activity, timeout=None):
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            now, silence = time.monotonic(), None
+            if deadline is not None and now >= deadline:
+                return "timed out after {}s".format(timeout)
+            if self._output_timeout:
+                silence = activity[0] + self._output_timeout
+                if now >= silence:
+                    return "produced no output for {}s".format(
+                        self._output_timeout
+                    )
+
+            limits = [d for d in [deadline, silence] if d is not None]
+            done, _ = await wait(
+                [execution], timeout=min(limits) - now if limits else None
+            )
+            if done:
+                return None
+
+    async def _kill_process_group(self, process):
+        for sig in [signal.SIGTERM, signal.SIGKILL]:
+            try:
+                killpg(process.pid, sig)
+            except ProcessLookupError:
+                return
+            done, _ = await wait(
+                [ensure_future(shield(process.wait()))],
+                timeout=self._kill_grace,
+            )
+            if done:
+                return
+
+    async def _log_stream(self, stream, log, log_tag, stream_tag, activity):
+        remainder = b""
+        while True:
+            chunk = await stream.read(self._read_size)
+            activity[0] = time.monotonic()
+            lines = (remainder + chunk).split(b"\n")
+            remainder = lines.pop() if chunk else b""
+            self._write_log_lines(log, log_tag, stream_tag, lines)
+            if not chunk:
+                return
+
+    def _write_log_lines(self, log, log_tag, stream_tag, lines):
+        lines = [
+            ln.decode("utf-8", "replace").strip() for ln in lines if ln.strip()
+        ]
+        if lines:
+            log.write(
+                "".join(
+                    "{}[{}] {}\n".format(log_tag, stream_tag, ln)
+                    for ln in lines
+                )
+            )
+            log.flush()
 
 
 class SimulationRunner(AsyncRunner):
-    _apps = {"phantom": "launch_voxsim", "diffusion mri": "launch_mitk"}
+    def __init__(
+        self,
+        singularity_conf=get_config(),
+        max_concurrent_commands=None,
+        phantom_cache=None,
+        staging_mode=Datastore.StagingMode.AUTO,
+        backend=None,
+        chrome_trace=False,
+        timeouts=None,
+        output_timeout=None,
+        retry_policy=None,
+        cpu_budget=None,
+        registry=None,
+        reuse_runs=True,
+    ):
+        if output_timeout is None:
+            output_timeout = singularity_conf.get("output_timeout", None)
+        super().__init__(max_concurrent_commands, output_timeout, cpu_budget)
+        self._timeouts = dict(singularity_conf.get("timeouts", {}))
+        self._timeouts.update(timeouts if timeouts else {})
+
+        self.retry_policy = retry_policy
+        if retry_policy is None and "retry_policy" in singularity_conf:
+            self.retry_policy = RetryPolicy.from_config(
+                singularity_conf["retry_policy"]
+            )
+
+        self._staging_mode = staging_mode
+        self._chrome_trace = chrome_trace
+        self._phantom_cache = phantom_cache
+        if phantom_cache is None and "phantom_cache" in singularity_conf:
+            self._phantom_cache = PhantomCache(
+                **singularity_conf["phantom_cache"]
+            )
+
+        self._backend = backend if backend else get_backend(singularity_conf)
+
+        self._registry = registry
+        if isinstance(registry, str):
+            self._registry = RunRegistry(registry)
+        elif registry is None and "run_registry" in singularity_conf:
+            self._registry = RunRegistry(**singularity_conf["run_registry"])
+        self._reuse_runs = reuse_runs
+        self.last_metrics = None
+
+    @property
+    def backend(self):
+        return self._backend
+
+    @property
+    def registry(self):
+        return self._registry
 
-    def __init__(self, singularity_conf=get_config()):
-        self._singularity = path.join(
-            singularity_conf["singularity_path"],
-            singularity_conf["singularity_name"],
+    def stop(self):
+        super().stop()
+        self._backend.stop()
+
+    def _get_environment(self, budget):
+        if budget is None:
+            return None
+        return dict(
+            environ, **self._backend.get_environment(budget.get_environment())
         )
-        super().__init__()
 
-        self._singularity_exec = "singularity"
-        if "singularity_exec" in singularity_conf:
-            self._singularity_exec = singularity_conf["singularity_exec"]
+    def _create_outputs(self, folder):
+        if not path.exists(folder):
+            makedirs(folder, exist_ok=True)
 
-    def _bind_singularity(self, step, paths, arguments):
-        return "{} run -B {} --app {} {} {}".format(
-            self._singularity_exec,
-            paths,
-            self._apps[step],
-            self._singularity,
-            arguments,
+        return folder
+
+    def _raise_on_error(self, return_code, log_file, step, err_type):
+        if not return_code == 0:
+            raise SimulationRunnerException(
+                "{} ended in error".format(step),
+                err_type,
+                return_code,
+                (log_file,),
+            )
+
+    def _log_staging(self, run_name, output_folder, datastore, metrics=None):
+        message = "Staged compartments : {} | {} bytes of copy avoided".format(
+            ", ".join(
+                "{} {} bytes".format(mode, size)
+                for mode, size in datastore.staging_stats.items()
+            ),
+            datastore.get_saved_bytes(),
         )
+        logger.info("{} : {}".format(run_name, message))
+        with open(
+            path.join(output_folder, "{}.log".format(run_name)), "a+"
+        ) as log:
+            log.write("[STAGING] {}\n".format(message))
+
+        if metrics is not None:
+            staging = metrics.attributes.setdefault("staging", {})
+            staging[run_name] = {
+                "bytes": dict(datastore.staging_stats),
+                "saved_bytes": datastore.get_saved_bytes(),
+            }
+
+    def _dump_metrics(self, metrics, output_folder):
+        if not metrics.stages:
+            return
+
+        name = path.join(output_folder, metrics.run_name)
+        metrics.dump("{}_metrics.json".format(name))
+        if self._chrome_trace:
+            metrics.dump_chrome_trace("{}_trace.json".format(name))
+
+    def _log_resume(self, run_name, output_folder, stages):
+        if not stages:
+            return
+
+        message = "Stages already complete : {}".format(
+            ", ".join(stage.value for stage in stages)
+        )
+        logger.info("{} : {}".format(run_name, message))
+        self._create_outputs(output_folder)
+        with open(
+            path.join(output_folder, "{}.log".format(run_name)), "a+"
+        ) as log:
+            log.write("[MANIFEST] {}\n".format(message))
+
+    def _record_stage(self, manifest, run_name, stage, keys, outputs):
+        if manifest is not None:
+            manifest.record(run_name, stage, keys[stage], outputs)
+
+    def _get_simulation_output(self, run_name, output_folder, output_nifti):
+        return path.join(
+            output_folder,
+            "simulation",
+            "{}_simulation.{}".format(
+                run_name, "nii.gz" if output_nifti else "nrrd"
+            ),
+        )
+
+    def run_batch(
+        self,
+        jobs,
+        max_workers=None,
+        ordered=True,
+        processes=True,
+        memory_budget=None,
+        cpu_budget=True,
+        pin_cpus=False,
+        runtime_model=None,
+    ):
+        """
+        Run many simulations concurrently, each with its own copy of this
+        runner. A failing job does not stop the others, its exception is
+        returned in its result instead.
+
+        Parameters
+        ----------
+        jobs : list
+            List of BatchJob, or of (run_name, phantom_infos,
+            simulation_infos, output_folder) tuples
+        max_workers : int, optional
+            Maximum number of simulations running at the same time,
+            default : number of cpus on the machine
+        ordered : bool, optional
+            Yield the results in the order of the jobs instead of in
+            their order of completion, default : True
+        processes : bool, optional
+            Use a pool of processes instead of a pool of threads,
+            default : True
+        memory_budget : int or str, optional
+            If given, admit jobs only while the sum of their estimated peak
+            memory fits in this many bytes, running them in processes. Use
+            "auto" for the memory available on the machine, default : None
+        cpu_budget : bool or CPUBudget, optional
+            Share the cpus of the machine, or the given budget, equally
+            between the jobs running at the same time, telling their tools
+            how many threads to use, default : True
+        pin_cpus : bool, optional
+            Pin the tools of every job to its share of the cpus, keeping
+            the shares within NUMA nodes when possible, default : False
+        runtime_model : bool or RuntimeModel, optional
+            Run the jobs longest estimated first, using the given model or,
+            if True, a RuntimeModel learned from the metrics of previous
+            runs of the jobs, default : None
 
-    def _create_outputs(self, path):
-        if not path.exists(path):
-            makedirs(path, exist_ok=True)
+        Returns
+        -------
+        generator(BatchResult)
+            Results of the jobs, one per job
 
-        return path
+        """
+        self._backend.start()
+
+        if cpu_budget is True:
+            cpu_budget = CPUBudget.available(pin_cpus)
+        if runtime_model is True:
+            runtime_model = RuntimeModel()
+            runtime_model.learn_from_metrics(jobs)
+
+        if memory_budget is not None:
+            return MemoryScheduler(
+                self,
+                None if memory_budget == "auto" else memory_budget,
+                max_workers,
+                cpu_budget=cpu_budget if cpu_budget else None,
+                runtime_model=runtime_model if runtime_model else None,
+            ).map(jobs, ordered)
+
+        return BatchExecutor(
+            self,
+            max_workers,
+            processes,
+            cpu_budget if cpu_budget else None,
+            runtime_model if runtime_model else None,
+        ).map(jobs, ordered)
 
     def run(
         self,
@@ -84,47 +527,537 @@ class SimulationRunner(AsyncRunner):
         output_nifti=True,
         relative_fiber_fraction=True,
         inter_axonal_fraction=None,
+        manifest=None,
     ):
-        self.start()
-
-        self.generate_phantom(
+        metrics = RunMetrics(run_name)
+        run_id, reusable = self._register_run(
             run_name,
             phantom_infos,
+            simulation_infos,
             output_folder,
-            relative_fiber_fraction,
             output_nifti,
-            loop_managed=True,
+            relative_fiber_fraction,
+            inter_axonal_fraction,
         )
+        try:
+            self._metrics = metrics
+            if reusable is not None:
+                with metrics.stage("reuse_run", reused_from=reusable["id"]):
+                    outputs = self._registry.reuse(
+                        reusable, run_name, output_folder
+                    )
+                simulation = outputs["simulation"]
+            else:
+                simulation = self._run_stages(
+                    metrics,
+                    run_name,
+                    phantom_infos,
+                    simulation_infos,
+                    output_folder,
+                    output_nifti,
+                    relative_fiber_fraction,
+                    inter_axonal_fraction,
+                    manifest,
+                )
+                outputs = self._get_run_outputs(
+                    run_name, output_folder, simulation
+                )
+        except Exception as e:
+            if run_id is not None:
+                self._registry.fail(run_id, e, metrics.to_dict())
+            raise
+        finally:
+            self._metrics = None
+            self.last_metrics = metrics.to_dict()
+            self._dump_metrics(metrics, output_folder)
 
-        datastore = Datastore(
-            path.join(output_folder, "simulation"),
-            path.join(
-                output_folder,
-                "phantom",
-                "{}_phantom_merged_bundles.fib".format(run_name),
-            ),
-            simulation_infos["compartment_ids"],
+        if run_id is not None:
+            self._registry.complete(
+                run_id,
+                outputs,
+                metrics.to_dict(),
+                reusable["id"] if reusable is not None else None,
+            )
+        return simulation
+
+    def _register_run(
+        self,
+        run_name,
+        phantom_infos,
+        simulation_infos,
+        output_folder,
+        output_nifti,
+        relative_fiber_fraction,
+        inter_axonal_fraction,
+    ):
+        if self._registry is None:
+            return None, None
+
+        key, parameters = self._registry.describe(
+            phantom_infos,
+            simulation_infos,
+            output_nifti,
+            relative_fiber_fraction,
             inter_axonal_fraction,
         )
+        reusable = (
+            self._registry.find_reusable(key, output_folder)
+            if self._reuse_runs
+            else None
+        )
+        if reusable is not None:
+            logger.info(
+                "{} : reusing the outputs of run {} in {}".format(
+                    run_name, reusable["run_name"], reusable["output_folder"]
+                )
+            )
+        run_id = self._registry.register(
+            run_name, output_folder, key, parameters
+        )
+        return run_id, reusable
+
+    def _get_run_outputs(self, run_name, output_folder, simulation):
+        files = []
+        for folder, prefix in [
+            ("phantom", "{}_phantom".format(run_name)),
+            ("simulation", "{}_simulation".format(run_name)),
+        ]:
+            folder = path.abspath(path.join(output_folder, folder))
+            if path.isdir(folder):
+                files += [
+                    path.join(folder, f)
+                    for f in sorted(listdir(folder))
+                    if f.startswith(prefix)
+                ]
+
+        return {"simulation": path.abspath(simulation), "files": files}
 
-        datastore.load_compartments(
-            path.join(output_folder, "phantom"), run_name, output_nifti
+    def _run_stages(
+        self,
+        metrics,
+        run_name,
+        phantom_infos,
+        simulation_infos,
+        output_folder,
+        output_nifti,
+        relative_fiber_fraction,
+        inter_axonal_fraction,
+        manifest,
+    ):
+        Stage = Manifest.Stage
+        manifest = Manifest(manifest) if isinstance(manifest, str) else manifest
+        keys, resume = None, 0
+        if manifest is not None:
+            keys = Manifest.get_stage_keys(
+                phantom_infos,
+                simulation_infos,
+                output_folder,
+                output_nifti,
+                relative_fiber_fraction,
+                inter_axonal_fraction,
+            )
+            last = manifest.get_last_complete(run_name, keys)
+            resume = 0 if last is None else list(Stage).index(last) + 1
+            self._log_resume(run_name, output_folder, list(Stage)[:resume])
+            if resume:
+                metrics.set(
+                    "resumed_stages",
+                    [stage.value for stage in list(Stage)[:resume]],
+                )
+
+        simulation = self._get_simulation_output(
+            run_name, output_folder, output_nifti
         )
-        datastore.stage_compartments(run_name)
+        if resume > list(Stage).index(Stage.SIMULATION):
+            return simulation
 
-        self.simulate_diffusion_mri(
-            run_name,
-            simulation_infos,
-            output_folder,
-            datastore.fibers,
-            datastore.compartments,
-            datastore.get_bind_paths(False),
-            output_nifti,
-            loop_managed=True,
-            compartments_staged=True,
+        self.start()
+        datastore = None
+        try:
+            phantom_folder = path.join(output_folder, "phantom")
+            if resume <= list(Stage).index(Stage.GEOMETRY):
+                self._record_stage(
+                    manifest,
+                    run_name,
+                    Stage.GEOMETRY,
+                    keys,
+                    get_geometry_files(phantom_infos),
+                )
+            if resume <= list(Stage).index(Stage.PHANTOM):
+                with metrics.stage("generate_phantom") as stage:
+                    stage["cache_hit"] = self.generate_phantom(
+                        run_name,
+                        phantom_infos,
+                        output_folder,
+                        relative_fiber_fraction,
+                        output_nifti,
+                        loop_managed=True,
+                    )
+                self._record_stage(
+                    manifest,
+                    run_name,
+                    Stage.PHANTOM,
+                    keys,
+                    [
+                        path.join(phantom_folder, f)
+                        for f in listdir(phantom_folder)
+                        if f.startswith("{}_phantom".format(run_name))
+                    ],
+                )
+
+            datastore = Datastore(
+                self._create_outputs(path.join(output_folder, "simulation")),
+                path.join(
+                    phantom_folder,
+                    "{}_phantom_merged_bundles.fib".format(run_name),
+                ),
+                simulation_infos["compartment_ids"],
+                inter_axonal_fraction,
+                self._staging_mode,
+            )
+
+            if resume <= list(Stage).index(Stage.STAGING):
+                with metrics.stage("load_compartments"):
+                    datastore.load_compartments(
+                        phantom_folder, run_name, output_nifti
+                    )
+                with metrics.stage("stage_compartments"):
+                    datastore.stage_compartments(run_name)
+                self._log_staging(run_name, output_folder, datastore, metrics)
+                self._record_stage(
+                    manifest,
+                    run_name,
+                    Stage.STAGING,
+                    keys,
+                    datastore.get_staged_paths(run_name),
+                )
+            else:
+                datastore.load_staged(run_name, output_nifti)
+
+            with metrics.stage(
+                "simulate_diffusion_mri",
+                shards=len(simulation_infos.get("shards", [])),
+            ):
+                self.simulate_diffusion_mri(
+                    run_name,
+                    simulation_infos,
+                    output_folder,
+                    datastore.fibers,
+                    datastore.compartments,
+                    datastore.get_bind_paths(False),
+                    output_nifti,
+                    loop_managed=True,
+                    compartments_staged=True,
+                )
+            self._record_stage(
+                manifest, run_name, Stage.SIMULATION, keys, [simulation]
+            )
+        finally:
+            self._close_loop()
+            if datastore is not None:
+                datastore.unload()
+
+        return simulation
+
+    def run_simulations(
+        self,
+        run_name,
+        phantom_infos,
+        simulations,
+        output_folder,
+        output_nifti=True,
+        relative_fiber_fraction=True,
+        inter_axonal_fraction=None,
+        max_concurrent=None,
+    ):
+        """
+        Generates a phantom once, then runs many simulations on it
+        concurrently. Each simulation gets its own output folder, named
+        after it, in which its compartment maps are staged.
+
+        Parameters
+        ----------
+        run_name : str
+            Name given to the phantom outputs
+        phantom_infos : GeometryInfos or dict
+            Geometry configuration generated by the GeometryHandler
+        simulations : dict
+            Simulation configurations generated by the SimulationHandler,
+            sharded or not, indexed by the name given to their outputs
+        output_folder : str
+            Folder in which to write the outputs
+        output_nifti : bool, optional
+            Output images in nifti format instead of nrrd, default : True
+        relative_fiber_fraction : bool, optional
+            Generate relative fiber fraction maps, default : True
+        inter_axonal_fraction : float, optional
+            Fraction of the fiber compartment given to the inter axonal
+            compartment, required if it is simulated
+        max_concurrent : int, optional
+            Maximum number of simulations running at the same time,
+            default : the runner's max_concurrent_commands
+
+        Returns
+        -------
+        dict
+            Simulation outputs indexed by simulation name
+
+        """
+        metrics = RunMetrics(run_name)
+        self._metrics = metrics
+        try:
+            return self._run_simulations(
+                metrics,
+                run_name,
+                phantom_infos,
+                simulations,
+                output_folder,
+                output_nifti,
+                relative_fiber_fraction,
+                inter_axonal_fraction,
+                max_concurrent,
+            )
+        finally:
+            self._metrics = None
+            self._dump_metrics(metrics, output_folder)
+
+    def _run_simulations(
+        self,
+        metrics,
+        run_name,
+        phantom_infos,
+        simulations,
+        output_folder,
+        output_nifti,
+        relative_fiber_fraction,
+        inter_axonal_fraction,
+        max_concurrent,
+    ):
+        self.start()
+        datastores, prepared, outputs = [], [], {}
+        try:
+            with metrics.stage("generate_phantom") as stage:
+                stage["cache_hit"] = self.generate_phantom(
+                    run_name,
+                    phantom_infos,
+                    output_folder,
+                    relative_fiber_fraction,
+                    output_nifti,
+                    loop_managed=True,
+                )
+
+            phantom_folder = path.join(output_folder, "phantom")
+            fibers = path.join(
+                phantom_folder, "{}_phantom_merged_bundles.fib".format(run_name)
+            )
+
+            for name, simulation_infos in simulations.items():
+                simulation_folder = path.join(output_folder, name)
+                datastore = Datastore(
+                    self._create_outputs(
+                        path.join(simulation_folder, "simulation")
+                    ),
+                    fibers,
+                    simulation_infos["compartment_ids"],
+                    inter_axonal_fraction,
+                    self._staging_mode,
+                )
+                datastores.append(datastore)
+                with metrics.stage("load_compartments", simulation=name):
+                    datastore.load_compartments(
+                        phantom_folder, run_name, output_nifti, name
+                    )
+                with metrics.stage("stage_compartments", simulation=name):
+                    datastore.stage_compartments(name)
+                self._log_staging(name, simulation_folder, datastore, metrics)
+
+                commands, outputs[name], shards = self._prepare_simulation(
+                    name,
+                    simulation_infos,
+                    simulation_folder,
+                    datastore.fibers,
+                    datastore.compartments,
+                    datastore.get_bind_paths(False),
+                    output_nifti,
+                )
+                prepared.append(
+                    (
+                        name,
+                        simulation_infos,
+                        simulation_folder,
+                        commands,
+                        shards,
+                    )
+                )
+
+            with metrics.stage(
+                "simulate_diffusion_mri", simulations=len(prepared)
+            ):
+                self._run_prepared_simulations(prepared, max_concurrent)
+        finally:
+            self._close_loop()
+            for datastore in datastores:
+                datastore.unload()
+
+        return outputs
+
+    def simulate_compartment_signals(
+        self,
+        run_name,
+        phantom_infos,
+        simulation_infos,
+        output_folder,
+        output_nifti=True,
+        relative_fiber_fraction=True,
+        max_concurrent=None,
+    ):
+        """
+        Generates a phantom once, then simulates the signal of each of
+        its compartments alone, with a unit fraction map, concurrently.
+        Any configuration of the compartment fractions (inter axonal
+        fraction, split of the extra axonal compartments, ...) can then be
+        synthesised from these signals with a CompartmentRecombiner (see
+        simulator/signal/recombination.py), without simulating again. Each
+        compartment gets its own output folder, named after the run and
+        its identifier (e.g. run_compartment1).
+
+        The recombination is exact only for simulations without k-space
+        or random artifacts, which are logged as approximations. Noise
+        must be added afterwards, on the recombined signal.
+
+        Parameters
+        ----------
+        run_name : str
+            Name given to the phantom outputs
+        phantom_infos : GeometryInfos or dict
+            Geometry configuration generated by the GeometryHandler
+        simulation_infos : SimulationInfos or dict
+            Simulation configuration generated by the SimulationHandler,
+            sharded or not, without noise
+        output_folder : str
+            Folder in which to write the outputs
+        output_nifti : bool, optional
+            Output images in nifti format instead of nrrd, default : True
+        relative_fiber_fraction : bool, optional
+            Generate relative fiber fraction maps, default : True
+        max_concurrent : int, optional
+            Maximum number of simulations running at the same time,
+            default : the runner's max_concurrent_commands
+
+        Returns
+        -------
+        dict
+            Signal of every compartment, indexed by compartment identifier
+
+        """
+        noise, approximations = get_unit_fraction_approximations(
+            simulation_infos
         )
+        if noise:
+            raise SimulationRunnerException(
+                "Compartment signals must be simulated without noise, "
+                "noise has to be added to the recombined signal",
+                SimulationRunnerException.ExceptionType.Parameters,
+            )
+        if approximations:
+            logger.warning(
+                "{} : recombining compartment signals only approximates "
+                "simulations with {}".format(
+                    run_name, ", ".join(approximations)
+                )
+            )
+
+        metrics = RunMetrics(run_name)
+        self._metrics = metrics
+        try:
+            return self._simulate_compartment_signals(
+                metrics,
+                run_name,
+                phantom_infos,
+                simulation_infos,
+                output_folder,
+                output_nifti,
+                relative_fiber_fraction,
+                max_concurrent,
+            )
+        finally:
+            self._metrics = None
+            self._dump_metrics(metrics, output_folder)
+
+    def _simulate_compartment_signals(
+        self,
+        metrics,
+        run_name,
+        phantom_infos,
+        simulation_infos,
+        output_folder,
+        output_nifti,
+        relative_fiber_fraction,
+        max_concurrent,
+    ):
+        self.start()
+        datastores, prepared, outputs = [], [], {}
+        try:
+            with metrics.stage("generate_phantom") as stage:
+                stage["cache_hit"] = self.generate_phantom(
+                    run_name,
+                    phantom_infos,
+                    output_folder,
+                    relative_fiber_fraction,
+                    output_nifti,
+                    loop_managed=True,
+                )
+
+            phantom_folder = path.join(output_folder, "phantom")
+            fibers = path.join(
+                phantom_folder, "{}_phantom_merged_bundles.fib".format(run_name)
+            )
 
-        self.stop()
+            for cmp_id in simulation_infos["compartment_ids"]:
+                name = "{}_compartment{}".format(run_name, cmp_id)
+                compartment_folder = path.join(output_folder, name)
+                datastore = Datastore(
+                    self._create_outputs(
+                        path.join(compartment_folder, "simulation")
+                    ),
+                    fibers,
+                    simulation_infos["compartment_ids"],
+                )
+                datastores.append(datastore)
+                with metrics.stage("load_compartments", compartment=cmp_id):
+                    datastore.load_unit_fractions(
+                        phantom_folder, run_name, cmp_id, output_nifti, name
+                    )
+
+                commands, outputs[cmp_id], shards = self._prepare_simulation(
+                    name,
+                    simulation_infos,
+                    compartment_folder,
+                    datastore.fibers,
+                    datastore.compartments,
+                    datastore.get_bind_paths(False),
+                    output_nifti,
+                )
+                prepared.append(
+                    (
+                        name,
+                        simulation_infos,
+                        compartment_folder,
+                        commands,
+                        shards,
+                    )
+                )
+
+            with metrics.stage(
+                "simulate_diffusion_mri", simulations=len(prepared)
+            ):
+                self._run_prepared_simulations(prepared, max_concurrent)
+        finally:
+            self._close_loop()
+            for datastore in datastores:
+                datastore.unload()
+
+        return outputs
 
     def generate_phantom(
         self,
@@ -150,9 +1083,7 @@ class SimulationRunner(AsyncRunner):
         resolution = ",".join([str(r) for r in phantom_infos["resolution"]])
         spacing = ",".join([str(s) for s in phantom_infos["spacing"]])
         fiber_fraction = "rel" if relative_fiber_fraction else "abs"
-        out_name = path.join(
-            output_folder, "phantom, " "{}_phantom".format(run_name)
-        )
+        out_name = path.join(output_folder, "{}_phantom".format(run_name))
 
         arguments = "-f {} -r {} -s {} -o {} --comp-map {} --quiet".format(
             phantom_def, resolution, spacing, out_name, fiber_fraction
@@ -161,12 +1092,43 @@ class SimulationRunner(AsyncRunner):
         if output_nifti:
             arguments += " --nii"
 
-        bind_paths = ",".join([phantom_infos["file_path"], output_folder])
-        command = self._bind_singularity("phantom", bind_paths, arguments)
         log_file = path.join(base_output_folder, "{}.log".format(run_name))
-        self._run_command(command, log_file, "[PHANTOM]")
+        prefix = "{}_phantom".format(run_name)
+
+        cache_key = None
+        if self._phantom_cache is not None:
+            cache_key = self._phantom_cache.get_key(
+                phantom_infos, resolution, spacing, fiber_fraction, output_nifti
+            )
+            if self._phantom_cache.fetch(cache_key, output_folder, prefix):
+                logger.info("Phantom {} loaded from cache".format(run_name))
+                with open(log_file, "a+") as log:
+                    log.write(
+                        "[PHANTOM] Loaded from cache {}\n".format(cache_key)
+                    )
+                loop_managed or self._close_loop()
+                return True
+
+        command = self._backend.get_command(
+            "phantom", [phantom_infos["file_path"], output_folder], arguments
+        )
+        return_code, log = self._run_command(
+            command, log_file, "[PHANTOM]", self._timeouts.get("phantom")
+        )
 
-        loop_managed or self.stop()
+        loop_managed or self._close_loop()
+
+        self._raise_on_error(
+            return_code,
+            log,
+            "Phantom generation",
+            SimulationRunnerException.ExceptionType.Voxsim,
+        )
+
+        if cache_key is not None:
+            self._phantom_cache.store(cache_key, output_folder, prefix)
+
+        return False
 
     def simulate_diffusion_mri(
         self,
@@ -182,7 +1144,222 @@ class SimulationRunner(AsyncRunner):
     ):
         loop_managed or self.start()
 
-        bind_paths = [] if bind_paths is None else bind_paths
+        if "shards" in simulation_infos:
+            out_name = self._simulate_shards(
+                run_name,
+                simulation_infos,
+                output_folder,
+                fibers_file,
+                compartment_maps,
+                bind_paths,
+                output_nifti,
+            )
+            loop_managed or self._close_loop()
+            return out_name
+
+        command, out_name = self._prepare_diffusion_mri(
+            run_name,
+            simulation_infos,
+            output_folder,
+            fibers_file,
+            compartment_maps,
+            bind_paths,
+            output_nifti,
+            compartments_staged,
+        )
+        return_code, log = self._run_command(
+            *command, timeout=self._timeouts.get("diffusion mri")
+        )
+
+        loop_managed or self._close_loop()
+
+        self._raise_on_error(
+            return_code,
+            log,
+            "Simulation",
+            SimulationRunnerException.ExceptionType.Fiberfox,
+        )
+
+        return out_name
+
+    def _simulate_shards(
+        self,
+        run_name,
+        simulation_infos,
+        output_folder,
+        fibers_file,
+        compartment_maps=None,
+        bind_paths=None,
+        output_nifti=True,
+    ):
+        commands, outputs = self._prepare_shards(
+            run_name,
+            simulation_infos,
+            output_folder,
+            fibers_file,
+            compartment_maps,
+            bind_paths,
+            output_nifti,
+        )
+        for return_code, log in self._run_commands(
+            commands, timeout=self._timeouts.get("diffusion mri")
+        ):
+            self._raise_on_error(
+                return_code,
+                log,
+                "Simulation",
+                SimulationRunnerException.ExceptionType.Fiberfox,
+            )
+
+        return self._merge_shards(
+            run_name, simulation_infos, output_folder, outputs
+        )
+
+    def _prepare_shards(
+        self,
+        run_name,
+        simulation_infos,
+        output_folder,
+        fibers_file,
+        compartment_maps=None,
+        bind_paths=None,
+        output_nifti=True,
+    ):
+        if not output_nifti:
+            raise SimulationRunnerException(
+                "Sharded simulations require nifti outputs",
+                SimulationRunnerException.ExceptionType.Parameters,
+            )
+
+        log_file = path.join(output_folder, "{}.log".format(run_name))
+        commands, outputs = [], []
+        for i, shard in enumerate(simulation_infos["shards"]):
+            (command, _, _), out_name = self._prepare_diffusion_mri(
+                "{}_shard{}".format(run_name, i),
+                {
+                    "file_path": simulation_infos["file_path"],
+                    "param_file": shard["param_file"],
+                    "compartment_ids": simulation_infos["compartment_ids"],
+                },
+                output_folder,
+                fibers_file,
+                compartment_maps,
+                bind_paths,
+                output_nifti,
+                compartments_staged=False,
+            )
+            commands.append((command, log_file, "[DIFFUSION MRI {}]".format(i)))
+            outputs.append(out_name)
+
+        return commands, outputs
+
+    def _merge_shards(self, run_name, simulation_infos, output_folder, outputs):
+        shards = simulation_infos["shards"]
+        out_name = self._get_simulation_output(run_name, output_folder, True)
+        volumes = [shard["volumes"] for shard in shards]
+        merge_volumes(outputs, volumes, out_name)
+        self._merge_gradient_tables(outputs, volumes, out_name)
+
+        simulation_folder = path.dirname(out_name)
+        copyfile(
+            path.join(
+                simulation_infos["file_path"], simulation_infos["param_file"]
+            ),
+            path.join(simulation_folder, "{}_simulation.ffp".format(run_name)),
+        )
+        for i in range(len(shards)):
+            prefix = "{}_shard{}_simulation".format(run_name, i)
+            for f in listdir(simulation_folder):
+                if f.startswith(prefix) and not f == prefix + ".ffp":
+                    remove(path.join(simulation_folder, f))
+
+        return out_name
+
+    def _prepare_simulation(
+        self,
+        run_name,
+        simulation_infos,
+        output_folder,
+        fibers_file,
+        compartment_maps,
+        bind_paths,
+        output_nifti,
+    ):
+        if "shards" not in simulation_infos:
+            command, out_name = self._prepare_diffusion_mri(
+                run_name,
+                simulation_infos,
+                output_folder,
+                fibers_file,
+                compartment_maps,
+                bind_paths,
+                output_nifti,
+            )
+            return [command], out_name, None
+
+        commands, outputs = self._prepare_shards(
+            run_name,
+            simulation_infos,
+            output_folder,
+            fibers_file,
+            compartment_maps,
+            bind_paths,
+            output_nifti,
+        )
+        out_name = self._get_simulation_output(run_name, output_folder, True)
+        return commands, out_name, outputs
+
+    def _run_prepared_simulations(self, prepared, max_concurrent):
+        results = self._run_commands(
+            [c for _, _, _, commands, _ in prepared for c in commands],
+            max_concurrent,
+            self._timeouts.get("diffusion mri"),
+        )
+        for return_code, log in results:
+            self._raise_on_error(
+                return_code,
+                log,
+                "Simulation",
+                SimulationRunnerException.ExceptionType.Fiberfox,
+            )
+
+        for run_name, simulation_infos, output_folder, _, shards in prepared:
+            if shards is not None:
+                self._merge_shards(
+                    run_name, simulation_infos, output_folder, shards
+                )
+
+    def _merge_gradient_tables(self, shard_outputs, volumes, out_name):
+        n_volumes = max(max(v) for v in volumes) + 1
+        for table, n_rows in [("bvals", 1), ("bvecs", 3)]:
+            tables = [
+                "{}.{}".format(o[: -len(".nii.gz")], table)
+                for o in shard_outputs
+            ]
+            if not all(path.exists(t) for t in tables):
+                continue
+
+            merged = np.zeros((n_rows, n_volumes))
+            for t, indexes in zip(tables, volumes):
+                merged[:, indexes] = np.loadtxt(t, ndmin=2)
+            np.savetxt(
+                "{}.{}".format(out_name[: -len(".nii.gz")], table),
+                merged,
+                fmt="%g",
+            )
+
+    def _prepare_diffusion_mri(
+        self,
+        run_name,
+        simulation_infos,
+        output_folder,
+        fibers_file,
+        compartment_maps=None,
+        bind_paths=None,
+        output_nifti=True,
+        compartments_staged=True,
+    ):
+        bind_paths = [] if bind_paths is None else list(bind_paths)
         base_output_folder = output_folder
         output_folder = self._create_outputs(
             path.join(output_folder, "simulation")
@@ -191,12 +1368,16 @@ class SimulationRunner(AsyncRunner):
         name = "{}_simulation".format(run_name)
 
         bind_paths += [simulation_infos["file_path"], output_folder]
-        bind_paths = ",".join(bind_paths)
-        ffp_file = path.join(
-            simulation_infos["file_path"], simulation_infos["param_file"]
+        ffp_file = path.join(output_folder, "{}.ffp".format(name))
+        copyfile(
+            path.join(
+                simulation_infos["file_path"], simulation_infos["param_file"]
+            ),
+            ffp_file,
+        )
+        out_name = self._get_simulation_output(
+            run_name, base_output_folder, output_nifti
         )
-        extension = "nii.gz" if output_nifti else "nrrd"
-        out_name = path.join(output_folder, "{}.{}".format(name, extension))
 
         if not compartments_staged and compartment_maps is not None:
             datastore = Datastore(
@@ -210,8 +1391,9 @@ class SimulationRunner(AsyncRunner):
 
         arguments = "-p {} -i {} -o {}".format(ffp_file, fibers_file, out_name)
 
-        command = self._bind_singularity("diffusion mri", bind_paths, arguments)
+        command = self._backend.get_command(
+            "diffusion mri", bind_paths, arguments
+        )
         log_file = path.join(base_output_folder, "{}.log".format(run_name))
-        self._run_command(command, log_file, "[DIFFUSION MRI]")
 
-        loop_managed or self.stop()
+        return (command, log_file, "[DIFFUSION MRI]"), out_name
@@ -0,0 +1,565 @@
+import gzip
+from os import remove
+from os.path import basename, lexists
+import re
+
+import nibabel as nib
+import numpy as np
+
+
+_EXTENSIONS = ["nii.gz", "nii", "nrrd"]
+_NRRD_TYPES = {
+    "f4": ["float"],
+    "f8": ["double"],
+    "i1": ["signed char", "int8", "int8_t"],
+    "u1": ["uchar", "unsigned char", "uint8", "uint8_t"],
+    "i2": ["short", "short int", "signed short", "int16", "int16_t"],
+    "u2": ["ushort", "unsigned short", "uint16", "uint16_t"],
+    "i4": ["int", "signed int", "int32", "int32_t"],
+    "u4": ["uint", "unsigned int", "uint32", "uint32_t"],
+    "i8": ["longlong", "long long", "int64", "int64_t"],
+    "u8": ["ulonglong", "unsigned long long", "uint64", "uint64_t"],
+}
+_NRRD_TYPE_OF_DTYPE = {
+    "f4": "float",
+    "f8": "double",
+    "i1": "int8",
+    "u1": "uint8",
+    "i2": "int16",
+    "u2": "uint16",
+    "i4": "int32",
+    "u4": "uint32",
+    "i8": "int64",
+    "u8": "uint64",
+}
+_NRRD_PER_AXIS_FIELDS = [
+    "kinds",
+    "centers",
+    "centerings",
+    "labels",
+    "units",
+    "spacings",
+    "thicknesses",
+    "axis mins",
+    "axismins",
+    "axis maxs",
+    "axismaxs",
+]
+_NRRD_DOMAIN_KINDS = ["domain", "space", "time", "none", "???"]
+_NRRD_DATA_FIELDS = [
+    "type",
+    "dimension",
+    "sizes",
+    "encoding",
+    "endian",
+    "data file",
+    "datafile",
+    "line skip",
+    "lineskip",
+    "byte skip",
+    "byteskip",
+]
+
+
+def get_extension(file_path):
+    """Returns the image extension of a file (nii, nii.gz or nrrd)"""
+    for extension in _EXTENSIONS:
+        if file_path.endswith("." + extension):
+            return extension
+
+    return ".".join(basename(file_path).split(".")[1:])
+
+
+def _read_nrrd_header(file_path):
+    fields, keys = {}, []
+    with open(file_path, "rb") as f:
+        magic = f.readline()
+        if not magic.startswith(b"NRRD"):
+            raise ValueError("{} is not a NRRD file".format(file_path))
+
+        line = f.readline()
+        while line.strip():
+            line = line.decode("ascii").rstrip("\r\n")
+            if not line.startswith("#"):
+                if ":=" in line:
+                    keys.append(line)
+                else:
+                    field, value = line.split(":", 1)
+                    fields[field.strip().lower()] = value.strip()
+            line = f.readline()
+
+        return fields, keys, f.tell()
+
+
+def _split_nrrd_axes(value):
+    return re.findall(r'"[^"]*"|\([^)]*\)|\S+', value)
+
+
+def _get_nrrd_volume_axis(fields, file_path):
+    kinds = _split_nrrd_axes(fields.get("kinds", ""))
+    axes = [
+        i for i, k in enumerate(kinds) if k.lower() not in _NRRD_DOMAIN_KINDS
+    ]
+    if len(axes) > 1:
+        raise ValueError(
+            "NRRD images with more than one non spatial axis are not "
+            "supported : {} has kinds {}".format(file_path, fields["kinds"])
+        )
+    return axes[0] if axes else None
+
+
+def _move_nrrd_axis(fields, axis, ndim):
+    fields = dict(fields)
+    for field in _NRRD_PER_AXIS_FIELDS + ["space directions"]:
+        if field in fields:
+            values = _split_nrrd_axes(fields[field])
+            if len(values) == ndim:
+                values.append(values.pop(axis))
+                fields[field] = " ".join(values)
+    return fields
+
+
+def _nrrd_dtype(fields):
+    for code, names in _NRRD_TYPES.items():
+        if fields["type"].lower() in names:
+            endian = ">" if fields.get("endian", "little") == "big" else "<"
+            return np.dtype(endian + code)
+
+    raise ValueError("Unsupported NRRD type {}".format(fields["type"]))
+
+
+class Volume:
+    """
+    Lazy access to a NIfTI or NRRD image. The data is never loaded
+    fully in memory, only the portions that are sliced from it or
+    iterated over with iter_slabs.
+
+    The volumes of an image are along its last axis. NRRD images whose
+    kinds put them along another axis, such as the diffusion weighted
+    images of MITK, which store the gradients first, are presented with
+    that axis moved last, their header reordered to match. The key/value
+    lines of their header ("key:=value"), such as the gradient table of
+    diffusion weighted images, are kept apart in key_values.
+    """
+
+    def __init__(self, file_path):
+        """
+        Parameters
+        ----------
+        file_path : str
+            Path to a nii, nii.gz or nrrd image
+        """
+        self.path = file_path
+        self.extension = get_extension(file_path)
+        self.compressed = False
+        self._interleaved = False
+
+        if self.extension == "nrrd":
+            self._init_nrrd()
+        else:
+            self._init_nifti()
+
+    def _init_nifti(self):
+        self.format = "nifti"
+        self._image = nib.load(self.path)
+        self.dataobj = self._image.dataobj
+        self.shape = tuple(self._image.shape)
+        self.dtype = self.dataobj.dtype
+        self.header = self._image.header
+        self.key_values = []
+        self.affine = self._image.affine
+        self.compressed = self.extension.endswith("gz")
+        self._offset = self.dataobj.offset
+        self._slope = self.dataobj.slope
+        self._inter = self.dataobj.inter
+
+    def _init_nrrd(self):
+        self.format = "nrrd"
+        self.header, self.key_values, self._offset = _read_nrrd_header(
+            self.path
+        )
+        self.affine = None
+        file_shape = tuple(int(s) for s in self.header["sizes"].split())
+        self.shape = file_shape
+        self.dtype = _nrrd_dtype(self.header)
+        self._slope, self._inter = 1.0, 0.0
+
+        if "data file" in self.header or "datafile" in self.header:
+            raise ValueError(
+                "Detached NRRD headers are not supported : {}".format(self.path)
+            )
+
+        axis = _get_nrrd_volume_axis(self.header, self.path)
+        if axis is not None and axis < len(file_shape) - 1:
+            self.shape = file_shape[:axis] + file_shape[axis + 1 :]
+            self.shape += (file_shape[axis],)
+            self.header = _move_nrrd_axis(self.header, axis, len(file_shape))
+            self._interleaved = True
+
+        encoding = self.header["encoding"].lower()
+        if encoding in ["gz", "gzip"]:
+            if self._interleaved and axis > 0:
+                raise ValueError(
+                    "Compressed NRRD images are supported with their volumes "
+                    "along the first or last axis only, not axis {} : "
+                    "{}".format(axis, self.path)
+                )
+            self.compressed = True
+            self.dataobj = None
+        elif encoding == "raw":
+            self.dataobj = np.memmap(
+                self.path,
+                self.dtype,
+                "r",
+                self._offset,
+                file_shape,
+                order="F",
+            )
+            if self._interleaved:
+                self.dataobj = np.moveaxis(self.dataobj, axis, -1)
+        else:
+            raise ValueError(
+                "Unsupported NRRD encoding {} : {}".format(encoding, self.path)
+            )
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def slab_step(self, max_bytes, itemsize=8):
+        """Number of slices along the last axis that fit in max_bytes"""
+        slice_bytes = int(np.prod(self.shape[:-1])) * itemsize
+        return max(1, int(max_bytes // slice_bytes))
+
+    def read(self, start, stop):
+        """
+        Reads the slices [start, stop) along the last axis. For compressed
+        images, prefer iter_slabs, which decompresses the file only once.
+        """
+        if self.dataobj is not None:
+            return np.asarray(self.dataobj[..., start:stop])
+        if self._interleaved:
+            return self._read_interleaved(np.arange(start, stop))
+
+        with self._open_stream() as stream:
+            stream.seek(self._offset + self._slice_nbytes() * start)
+            return self._read_slab(stream, stop - start)
+
+    def take(self, indexes, region=()):
+        """
+        Reads slices along the last axis, in any order, restricted to a region
+        of the leading axes. Uncompressed images are read only for the bytes
+        needed, compressed ones in a single pass up to the last slice needed.
+        """
+        n_slices = self.shape[-1]
+        indexes = np.asarray(indexes, int).reshape(-1)
+        if not len(indexes):
+            raise ValueError("No slices to read from {}".format(self.path))
+        if np.any((indexes < -n_slices) | (indexes >= n_slices)):
+            raise IndexError(
+                "Slices out of range for {} slices : {}".format(
+                    n_slices, self.path
+                )
+            )
+
+        indexes = indexes % n_slices
+        region = tuple(region) + (slice(None),) * (self.ndim - 1 - len(region))
+        unique = np.unique(indexes)
+        runs = np.split(unique, np.flatnonzero(np.diff(unique) > 1) + 1)
+
+        if not self.compressed:
+            parts = [
+                np.asarray(self.dataobj[region + (slice(r[0], r[-1] + 1),)])
+                for r in runs
+            ]
+        elif self._interleaved:
+            parts = [self._read_interleaved(unique)[region]]
+        else:
+            parts = []
+            with self._open_stream() as stream:
+                for run in runs:
+                    stream.seek(self._offset + self._slice_nbytes() * run[0])
+                    parts += [self._read_slab(stream, 1)[region] for _ in run]
+
+        data = np.concatenate(parts, axis=-1)
+        return data[..., np.searchsorted(unique, indexes)]
+
+    def iter_slabs(self, step):
+        """
+        Yields (start, stop, data) slabs of step slices along the last axis.
+        Compressed images are decompressed once, or once per slab when their
+        volumes are interleaved.
+        """
+        if not self.compressed or self._interleaved:
+            for start in range(0, self.shape[-1], step):
+                stop = min(start + step, self.shape[-1])
+                yield start, stop, self.read(start, stop)
+            return
+
+        with self._open_stream() as stream:
+            stream.seek(self._offset)
+            for start in range(0, self.shape[-1], step):
+                stop = min(start + step, self.shape[-1])
+                yield start, stop, self._read_slab(stream, stop - start)
+
+    def _open_stream(self):
+        if self.format == "nifti":
+            return gzip.open(self.path, "rb")
+
+        f = open(self.path, "rb")
+        return _OffsetGzipStream(f, self._offset)
+
+    def _read_interleaved(self, indexes, chunk_bytes=2 ** 24):
+        # The volumes of every voxel are contiguous in the file, a chunk of
+        # voxels is decompressed at a time, keeping only the volumes needed
+        n_volumes = self.shape[-1]
+        n_voxels = int(np.prod(self.shape[:-1]))
+        voxel_bytes = n_volumes * self.dtype.itemsize
+        step = max(1, chunk_bytes // voxel_bytes)
+        data = np.empty((n_voxels, len(indexes)), self.dtype)
+        with self._open_stream() as stream:
+            stream.seek(self._offset)
+            for start in range(0, n_voxels, step):
+                stop = min(start + step, n_voxels)
+                chunk = np.frombuffer(
+                    stream.read((stop - start) * voxel_bytes), self.dtype
+                ).reshape((stop - start, n_volumes))
+                data[start:stop] = chunk[:, indexes]
+
+        return data.reshape(self.shape[:-1] + (len(indexes),), order="F")
+
+    def _slice_nbytes(self):
+        return int(np.prod(self.shape[:-1])) * self.dtype.itemsize
+
+    def _read_slab(self, stream, n_slices):
+        data = np.frombuffer(
+            stream.read(self._slice_nbytes() * n_slices), self.dtype
+        ).reshape(self.shape[:-1] + (n_slices,), order="F")
+
+        if self._slope not in [None, 1.0] or self._inter not in [None, 0.0]:
+            slope = 1.0 if self._slope is None else self._slope
+            inter = 0.0 if self._inter is None else self._inter
+            return data * slope + inter
+
+        return data
+
+
+class _OffsetGzipStream:
+    """Gzip stream starting after the header of a NRRD file"""
+
+    def __init__(self, fileobj, offset):
+        self._file = fileobj
+        self._file.seek(offset)
+        self._offset = offset
+        self._stream = gzip.GzipFile(fileobj=self._file, mode="rb")
+
+    def seek(self, position):
+        self._stream.seek(position - self._offset)
+
+    def read(self, size):
+        return self._stream.read(size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._stream.close()
+        self._file.close()
+
+
+class VolumeWriter:
+    """
+    Writes an image incrementally, in slabs along its last axis, so that
+    it never has to be held fully in memory. The format is chosen from the
+    extension of the file (nii, nii.gz or nrrd) and the spatial metadata
+    is taken from a reference volume of the same format. An existing file
+    is replaced rather than truncated, leaving any hardlink to it intact.
+    """
+
+    def __init__(
+        self,
+        file_path,
+        shape,
+        dtype,
+        reference=None,
+        compress_level=1,
+        keys=None,
+    ):
+        """
+        Parameters
+        ----------
+        file_path : str
+            Path of the image to write
+        shape : tuple(int)
+            Shape of the image
+        dtype : numpy.dtype or str
+            Data type of the image
+        reference : Volume, optional
+            Volume from which to copy the spatial metadata
+        compress_level : int, optional
+            Gzip compression level used for nii.gz and nrrd images. 0 stores
+            the data uncompressed, default : 1
+        keys : list(str), optional
+            Key/value lines ("key:=value") of a nrrd header, replacing the
+            ones of the reference, default : None
+        """
+        self.path = file_path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._written = 0
+
+        extension = get_extension(file_path)
+        if reference is not None and (extension == "nrrd") != (
+            reference.format == "nrrd"
+        ):
+            raise ValueError(
+                "Reference {} and output {} formats differ".format(
+                    reference.path, file_path
+                )
+            )
+
+        if lexists(file_path):
+            remove(file_path)
+        self._file = open(file_path, "wb")
+        if extension == "nrrd":
+            self._file.write(self._nrrd_header(reference, compress_level, keys))
+            self._stream = (
+                gzip.GzipFile(
+                    fileobj=self._file, mode="wb", compresslevel=compress_level
+                )
+                if compress_level
+                else self._file
+            )
+        else:
+            self._stream = (
+                gzip.GzipFile(
+                    fileobj=self._file,
+                    mode="wb",
+                    compresslevel=compress_level,
+                )
+                if extension.endswith("gz")
+                else self._file
+            )
+            self._nifti_header(reference).write_to(self._stream)
+
+    def _nifti_header(self, reference):
+        header = reference.header.copy() if reference is not None else None
+        affine = reference.affine if reference is not None else np.eye(4)
+        header = nib.Nifti1Image(
+            np.zeros((1,) * len(self.shape), self.dtype), affine, header
+        ).header
+        header.set_data_shape(self.shape)
+        header.set_data_dtype(self.dtype)
+        header.set_slope_inter(1.0, 0.0)
+        header["vox_offset"] = 0
+        return header
+
+    def _nrrd_header(self, reference, compress_level, keys=None):
+        fields = (
+            dict(reference.header) if reference is not None else {"space": ""}
+        )
+        if keys is None:
+            keys = reference.key_values if reference is not None else []
+        ref_ndim = reference.ndim if reference is not None else len(self.shape)
+
+        for field in _NRRD_DATA_FIELDS:
+            fields.pop(field, None)
+        if not ref_ndim == len(self.shape):
+            for field in _NRRD_PER_AXIS_FIELDS:
+                fields.pop(field, None)
+            if "space directions" in fields:
+                directions = fields["space directions"].split()
+                directions += ["none"] * len(self.shape)
+                fields["space directions"] = " ".join(
+                    directions[: len(self.shape)]
+                )
+        if not fields.get("space"):
+            fields.pop("space", None)
+
+        lines = [
+            "NRRD0004",
+            "type: {}".format(_NRRD_TYPE_OF_DTYPE[self.dtype.str[1:]]),
+            "dimension: {}".format(len(self.shape)),
+            "sizes: {}".format(" ".join(str(s) for s in self.shape)),
+            "endian: {}".format(
+                "big" if self.dtype.byteorder == ">" else "little"
+            ),
+            "encoding: {}".format("gzip" if compress_level else "raw"),
+        ]
+        lines += ["{}: {}".format(k, v) for k, v in fields.items()]
+        lines += keys
+
+        return ("\n".join(lines) + "\n\n").encode("ascii")
+
+    def write(self, slab):
+        """
+        Appends a slab of slices along the last axis of the image
+
+        Parameters
+        ----------
+        slab : numpy.ndarray
+            Data of the slab, of shape shape[:-1] + (n_slices,)
+
+        """
+        slab = np.asarray(slab, self.dtype)
+        assert slab.shape[:-1] == self.shape[:-1]
+        self._stream.write(slab.tobytes(order="F"))
+        self._written += slab.shape[-1]
+
+    def close(self):
+        if self._stream is not self._file:
+            self._stream.close()
+        self._file.close()
+        assert (
+            self._written == self.shape[-1]
+        ), "Volume {} is incomplete, {} of {} slices written".format(
+            self.path, self._written, self.shape[-1]
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            if self._stream is not self._file:
+                self._stream.close()
+            self._file.close()
+
+
+def merge_volumes(sources, volumes, destination, compress_level=1):
+    """
+    Merges 4D images holding subsets of the volumes of an acquisition, at the
+    indexes given for each in volumes, into a single image. The images are read
+    a volume at a time, and a volume present in many images is taken from the
+    first one.
+    """
+    sources = [Volume(source) for source in sources]
+    ref = sources[0]
+    owners = {}
+    for source, indexes in reversed(list(zip(sources, volumes))):
+        assert len(indexes) == source.shape[-1]
+        owners.update({index: source for index in indexes})
+
+    slabs = [
+        zip(indexes, source.iter_slabs(1))
+        for source, indexes in zip(sources, volumes)
+    ]
+    n_volumes = max(owners) + 1
+    assert sorted(owners) == list(range(n_volumes))
+
+    with VolumeWriter(
+        destination,
+        ref.shape[:-1] + (n_volumes,),
+        ref.dtype,
+        ref,
+        compress_level,
+    ) as writer:
+        heads = [next(s, None) for s in slabs]
+        for index in range(n_volumes):
+            for i, head in enumerate(heads):
+                if head is not None and head[0] == index:
+                    if sources[i] is owners[index]:
+                        writer.write(head[1][2])
+                    heads[i] = next(slabs[i], None)
@@ -0,0 +1,8 @@
+from .noise import NoiseEngine, NoiseType, add_noise
+from .preview import PreviewEngine, get_orientation_field, read_fibers
+from .recombination import (
+    CompartmentRecombiner,
+    get_phantom_fractions,
+    load_fractions,
+)
+from .subsampling import GradientSubsampler, load_gradient_table
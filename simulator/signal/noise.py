@@ -0,0 +1,231 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+import json
+from os import cpu_count, makedirs, path
+
+import numpy as np
+
+from simulator.factory.simulation_factory import SimulationFactory
+from simulator.runner.cache import materialize
+from simulator.runner.volumes import Volume, VolumeWriter, get_extension
+
+
+NoiseType = SimulationFactory.NoiseType
+
+
+def add_noise(signal, noise_type, variance, rng):
+    """
+    Adds noise to noise-free magnitude images
+
+    Parameters
+    ----------
+    signal : numpy.ndarray
+        Noise-free images, whose first two axes are the in-plane axes of
+        the acquisition
+    noise_type : NoiseType
+        Noise to add. Rician noise is added in image space, to the real and
+        imaginary channels of the signal. Complex gaussian noise is added
+        in k-space, to the 2D Fourier transform of every slice, as Fiberfox
+        does, the transform being orthonormal
+    variance : float
+        Variance of the noise on each channel
+    rng : numpy.random.Generator
+        Generator from which to draw the noise
+
+    Returns
+    -------
+    numpy.ndarray
+        Magnitude of the noisy images
+
+    """
+    sigma = np.sqrt(variance)
+    real = rng.standard_normal(signal.shape)
+    real *= sigma
+    imaginary = rng.standard_normal(signal.shape)
+    imaginary *= sigma
+
+    if noise_type is NoiseType.RICIAN:
+        real += signal
+        return np.hypot(real, imaginary, out=real)
+
+    kspace = np.fft.fft2(signal, axes=(0, 1), norm="ortho")
+    kspace.real += real
+    kspace.imag += imaginary
+    return np.abs(np.fft.ifft2(kspace, axes=(0, 1), norm="ortho"))
+
+
+class NoiseEngine:
+    """
+    Draws noise realisations from the noise-free output of a simulation,
+    instead of simulating the acquisition again for every noise level and
+    every seed. The image is read once, a slab of volumes at a time, and
+    every slab is dispatched to the realisations, computed in parallel
+    and written as they go, so that the image is never held fully in
+    memory. The noise of a volume is drawn from its own seed, derived from
+    the seed of the engine, the noise level, the realisation and the index
+    of the volume, which makes the realisations independent of the size of
+    the slabs and of the number of workers.
+    """
+
+    def __init__(
+        self, image_path, max_workers=None, chunk_bytes=2 ** 26, seed=None
+    ):
+        """
+        Parameters
+        ----------
+        image_path : str
+            Noise-free image output by Fiberfox (nii, nii.gz or nrrd)
+        max_workers : int, optional
+            Number of realisations computed at the same time,
+            default : number of cpus on the machine
+        chunk_bytes : int, optional
+            Memory used to process a slab of the image, default : 64 MiB
+        seed : int, optional
+            Seed of the noise, drawn randomly if not given, default : None
+        """
+        self.image = Volume(image_path)
+        self.max_workers = max_workers if max_workers else cpu_count()
+        self.chunk_bytes = chunk_bytes
+        self.seed = (
+            seed if seed is not None else np.random.SeedSequence().entropy
+        )
+
+    def get_rng(self, level, realisation, volume):
+        return np.random.default_rng(
+            np.random.SeedSequence(
+                self.seed, spawn_key=(level, realisation, volume)
+            )
+        )
+
+    def generate(
+        self,
+        noise_type,
+        variances,
+        n_realisations,
+        output_folder,
+        compress_level=1,
+    ):
+        """
+        Writes noise realisations of the image, named after it with the
+        noise type, variance and index of the realisation as suffix, with
+        its header and data type, integer images being written as floats.
+        The b-values and b-vectors files of the image are linked next to
+        every realisation, and the parameters of the noise are written in
+        a json file named after the image.
+
+        Parameters
+        ----------
+        noise_type : NoiseType
+            Type of the noise
+        variances : list(float)
+            Variances of the noise
+        n_realisations : int
+            Number of realisations drawn for every variance
+        output_folder : str
+            Folder in which to write the realisations
+        compress_level : int, optional
+            Gzip compression level of the realisations, default : 1
+
+        Returns
+        -------
+        list(dict)
+            Path, variance and index of every realisation
+
+        """
+        makedirs(output_folder, exist_ok=True)
+        extension = get_extension(self.image.path)
+        stem = path.basename(self.image.path)[: -len(extension) - 1]
+
+        realisations = [
+            {
+                "path": path.join(
+                    output_folder,
+                    "{}_{}{:g}_{:03d}.{}".format(
+                        stem, noise_type.value, variance, index, extension
+                    ),
+                ),
+                "variance": variance,
+                "level": level,
+                "index": index,
+            }
+            for level, variance in enumerate(variances)
+            for index in range(n_realisations)
+        ]
+
+        dtype = self.image.dtype
+        if not np.issubdtype(dtype, np.floating):
+            dtype = np.dtype(np.float32)
+
+        step = self.image.slab_step(
+            self.chunk_bytes, 4 * np.dtype(np.complex128).itemsize
+        )
+        with ExitStack() as stack:
+            writers = [
+                stack.enter_context(
+                    VolumeWriter(
+                        r["path"],
+                        self.image.shape,
+                        dtype,
+                        self.image,
+                        compress_level,
+                    )
+                )
+                for r in realisations
+            ]
+            pool = stack.enter_context(ThreadPoolExecutor(self.max_workers))
+            for start, stop, slab in self.image.iter_slabs(step):
+                signal = np.asarray(slab, np.float64)
+                list(
+                    pool.map(
+                        lambda args: self._write_realisation(
+                            noise_type, signal, start, stop, *args
+                        ),
+                        zip(realisations, writers),
+                    )
+                )
+
+        self._link_sidecars(stem, [r["path"] for r in realisations])
+        with open(
+            path.join(
+                output_folder, "{}_{}.json".format(stem, noise_type.value)
+            ),
+            "w+",
+        ) as f:
+            json.dump(
+                {
+                    "image": path.abspath(self.image.path),
+                    "noise_type": noise_type.value,
+                    "seed": self.seed,
+                    "realisations": realisations,
+                },
+                f,
+                indent=4,
+            )
+
+        return realisations
+
+    def _write_realisation(
+        self, noise_type, signal, start, stop, realisation, writer
+    ):
+        noisy = np.empty_like(signal)
+        for volume in range(start, stop):
+            rng = self.get_rng(
+                realisation["level"], realisation["index"], volume
+            )
+            noisy[..., volume - start] = add_noise(
+                signal[..., volume - start],
+                noise_type,
+                realisation["variance"],
+                rng,
+            )
+        writer.write(noisy)
+
+    def _link_sidecars(self, stem, outputs):
+        folder = path.dirname(self.image.path)
+        for extension in ["bvals", "bvecs"]:
+            sidecar = path.join(folder, "{}.{}".format(stem, extension))
+            if not path.exists(sidecar):
+                continue
+            for output in outputs:
+                output_stem = output[: -len(get_extension(output)) - 1]
+                materialize(sidecar, "{}.{}".format(output_stem, extension))
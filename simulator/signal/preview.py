@@ -0,0 +1,448 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from os import cpu_count
+from os.path import basename
+
+import numpy as np
+
+from simulator.factory.simulation_factory.parameters import StejskalTannerType
+from simulator.runner.volumes import Volume, VolumeWriter, get_extension
+from .recombination import load_fractions
+from .subsampling import (
+    get_gradient_keys,
+    normalize_vectors,
+    save_gradient_table,
+)
+
+
+logger = logging.getLogger(basename(__file__).split(".")[0])
+
+_VTK_DTYPES = {
+    "float": ">f4",
+    "double": ">f8",
+    "int": ">i4",
+    "vtktypeint32": ">i4",
+    "vtktypeint64": ">i8",
+}
+
+
+def _read_vtk_array(stream, binary, count, dtype):
+    if binary:
+        dtype = np.dtype(dtype)
+        data = np.frombuffer(stream.read(count * dtype.itemsize), dtype)
+        stream.readline()
+        return data
+
+    values = []
+    while len(values) < count:
+        line = stream.readline()
+        if not line:
+            raise ValueError("Unexpected end of the fibers file")
+        values += line.decode("ascii").split()
+    return np.array(values, np.dtype(dtype).newbyteorder("="))
+
+
+def read_fibers(fibers_file):
+    """
+    Reads the streamlines of a fibers file (.fib), a legacy VTK polydata
+    file in ASCII or binary encoding
+
+    Parameters
+    ----------
+    fibers_file : str
+        Fibers file, such as the merged bundles output by voxsim
+
+    Returns
+    -------
+    list(numpy.ndarray)
+        Points of every streamline, of shape (n_points, 3), in mm
+
+    """
+    points, connectivity, offsets = None, None, None
+    with open(fibers_file, "rb") as stream:
+        stream.readline()
+        stream.readline()
+        binary = stream.readline().strip().upper() == b"BINARY"
+        for line in iter(stream.readline, b""):
+            words = line.decode("ascii", "replace").split()
+            if not words:
+                continue
+            keyword = words[0].upper()
+            if keyword == "POINTS":
+                points = _read_vtk_array(
+                    stream,
+                    binary,
+                    3 * int(words[1]),
+                    _VTK_DTYPES[words[2].lower()],
+                ).reshape((-1, 3))
+            elif keyword == "LINES" and offsets is None:
+                position = stream.tell()
+                following = stream.readline().split()
+                if following and following[0].upper() == b"OFFSETS":
+                    offsets = _read_vtk_array(
+                        stream,
+                        binary,
+                        int(words[1]),
+                        _VTK_DTYPES[following[1].decode().lower()],
+                    )
+                else:
+                    stream.seek(position)
+                    connectivity = _read_vtk_array(
+                        stream, binary, int(words[2]), ">i4"
+                    )
+            elif keyword == "CONNECTIVITY":
+                connectivity = _read_vtk_array(
+                    stream,
+                    binary,
+                    int(offsets[-1]),
+                    _VTK_DTYPES[words[1].lower()],
+                )
+
+    if points is None or connectivity is None:
+        raise ValueError("No streamlines found in {}".format(fibers_file))
+
+    if offsets is not None:
+        return [
+            points[connectivity[start:stop]]
+            for start, stop in zip(offsets[:-1], offsets[1:])
+        ]
+
+    streamlines, position = [], 0
+    while position < len(connectivity):
+        n_points = int(connectivity[position])
+        indexes = connectivity[position + 1 : position + 1 + n_points]
+        streamlines.append(points[indexes])
+        position += n_points + 1
+    return streamlines
+
+
+def get_orientation_field(fibers_file, shape, spacing, origin=(0, 0, 0)):
+    """
+    Computes the dominant orientation of the fibers in every voxel of an
+    image, as the principal eigenvector of the sum of the outer products
+    of the directions of the fiber segments crossing it, weighted by their
+    length. Segments are subdivided finer than the voxels before being
+    assigned to them.
+
+    Parameters
+    ----------
+    fibers_file : str
+        Fibers file, such as the merged bundles output by voxsim
+    shape : tuple(int)
+        Shape of the image
+    spacing : tuple(float)
+        Spacing of the image (mm)
+    origin : tuple(float), optional
+        Position of the corner of the first voxel (mm), default : (0, 0, 0)
+
+    Returns
+    -------
+    numpy.ndarray
+        Unit orientation of the fibers in every voxel, null where there
+        are none, of shape shape + (3,)
+
+    """
+    shape, spacing = tuple(shape[:3]), np.asarray(spacing, float)
+    streamlines = [s for s in read_fibers(fibers_file) if len(s) > 1]
+    tensors = np.zeros(shape + (3, 3))
+    if not streamlines:
+        return np.zeros(shape + (3,))
+
+    starts = np.concatenate([s[:-1] for s in streamlines]).astype(float)
+    segments = np.concatenate([np.diff(s, axis=0) for s in streamlines])
+    lengths = np.linalg.norm(segments, axis=1)
+
+    n_sub = np.maximum(1, np.ceil(2 * lengths / spacing.min())).astype(int)
+    index = np.repeat(np.arange(len(segments)), n_sub)
+    steps = np.arange(len(index)) - np.repeat(np.cumsum(n_sub) - n_sub, n_sub)
+    positions = (
+        starts[index]
+        + ((steps + 0.5) / n_sub[index])[:, None] * segments[index]
+    )
+    voxels = np.floor((positions - np.asarray(origin)) / spacing).astype(int)
+    inside = np.all((voxels >= 0) & (voxels < shape), axis=1) & (
+        lengths[index] > 0
+    )
+
+    index, voxels = index[inside], voxels[inside]
+    directions = segments[index] / lengths[index, None]
+    weights = lengths[index] / n_sub[index]
+    np.add.at(
+        tensors,
+        tuple(voxels.T),
+        weights[:, None, None] * directions[:, :, None] * directions[:, None],
+    )
+
+    orientations = np.zeros(shape + (3,))
+    filled = np.trace(tensors, axis1=-2, axis2=-1) > 0
+    orientations[filled] = np.linalg.eigh(tensors[filled])[1][..., -1]
+    return orientations
+
+
+def _get_perpendiculars(orientations):
+    reference = np.zeros_like(orientations)
+    reference[np.abs(orientations[:, 0]) < 0.9, 0] = 1
+    reference[np.abs(orientations[:, 0]) >= 0.9, 1] = 1
+    first = normalize_vectors(np.cross(orientations, reference))
+    return first, np.cross(orientations, first)
+
+
+class PreviewEngine:
+    """
+    Computes, in process and in seconds, the noise-free signal of the stick,
+    tensor and ball compartments generated by the SimulationFactory, to
+    screen parameters before committing to Fiberfox runs. The signal of a
+    voxel is the sum over the compartments of their fraction, their T2
+    relaxation at the echo time and their diffusion attenuation, the fiber
+    compartments being oriented along the fiber orientation of the voxel.
+    Only Stejskal-Tanner acquisitions are supported. T1 relaxation, the
+    k-space acquisition, artifacts and noise are not modelled, so that the
+    preview only approximates the output of Fiberfox.
+
+    The voxels are processed in chunks, in parallel.
+    """
+
+    _MODELS = ["stick", "tensor", "ball"]
+
+    def __init__(
+        self,
+        compartments,
+        bvals,
+        bvecs,
+        echo_time,
+        signal_scale=100,
+        max_workers=None,
+        chunk_bytes=2 ** 26,
+    ):
+        """
+        Parameters
+        ----------
+        compartments : list(dict)
+            Compartments to simulate (must be generated by the
+            SimulationFactory)
+        bvals : list(float)
+            B-values of the volumes (s/mm^2)
+        bvecs : list(list(float))
+            B-vectors of the volumes
+        echo_time : float
+            TE of the sequence (milliseconds)
+        signal_scale : float, optional
+            Signal of a voxel without attenuation nor relaxation,
+            default : 100
+        max_workers : int, optional
+            Number of chunks of voxels processed at the same time,
+            default : number of cpus on the machine
+        chunk_bytes : int, optional
+            Memory used to process a chunk of voxels, default : 64 MiB
+        """
+        unsupported = [
+            c["model"] for c in compartments if c["model"] not in self._MODELS
+        ]
+        if unsupported:
+            raise ValueError(
+                "Unsupported compartment models : {}".format(
+                    ", ".join(unsupported)
+                )
+            )
+
+        self.compartments = {c["ID"]: c for c in compartments}
+        self.bvals = np.asarray(bvals, float)
+        self.bvecs = normalize_vectors(
+            np.asarray(bvecs, float).reshape((-1, 3))
+        )
+        self.echo_time = echo_time
+        self.signal_scale = signal_scale
+        self.max_workers = max_workers if max_workers else cpu_count()
+        self.chunk_bytes = chunk_bytes
+
+    @classmethod
+    def from_profiles(
+        cls, compartments, gradient_profile, acquisition_profile, **kwargs
+    ):
+        """
+        Creates the engine from the profiles of a simulation
+
+        Parameters
+        ----------
+        compartments : list(dict)
+            Compartments to simulate (must be generated by the
+            SimulationFactory)
+        gradient_profile : GradientProfile
+            Gradient profile of the acquisition
+        acquisition_profile : AcquisitionProfile
+            Acquisition profile, giving the echo time and signal scale
+        kwargs :
+            Other arguments given to the engine
+
+        Returns
+        -------
+        PreviewEngine
+            Engine configured
+
+        """
+        if not isinstance(gradient_profile.get_type(), StejskalTannerType):
+            raise ValueError(
+                "Previews only support Stejskal-Tanner acquisitions"
+            )
+        return cls(
+            compartments,
+            gradient_profile.get_bvals(),
+            gradient_profile.get_bvecs(),
+            acquisition_profile.get_echo(),
+            acquisition_profile.get_scale(),
+            **kwargs
+        )
+
+    def simulate(self, fractions, orientations):
+        """
+        Computes the diffusion weighted image
+
+        Parameters
+        ----------
+        fractions : dict
+            Fraction of every compartment, indexed by compartment identifier,
+            as described for load_fractions (e.g. the maps staged for a
+            simulation, or get_phantom_fractions)
+        orientations : numpy.ndarray
+            Unit orientation of the fibers in every voxel, of shape
+            (x, y, z, 3) (see get_orientation_field)
+
+        Returns
+        -------
+        numpy.ndarray
+            Signal of the image, of shape (x, y, z, n_volumes)
+
+        """
+        shape, weights, orientations = self._prepare(fractions, orientations)
+        signal = self._compute(weights, orientations, slice(None))
+        return signal.reshape(shape + (len(self.bvals),))
+
+    def write(
+        self,
+        fractions,
+        orientations,
+        output_path,
+        reference=None,
+        compress_level=1,
+    ):
+        """
+        Writes the diffusion weighted image, a slab of volumes at a time,
+        with its gradient table, as bvals and bvecs files next to nifti
+        images or in the header of nrrd images
+
+        Parameters
+        ----------
+        fractions : dict
+            Fraction of every compartment (see simulate)
+        orientations : numpy.ndarray
+            Unit orientation of the fibers in every voxel (see simulate)
+        output_path : str
+            Path of the image (nii, nii.gz or nrrd)
+        reference : str, optional
+            Image of the same format from which to copy the spatial
+            metadata, such as a fraction map of the phantom, default : None
+        compress_level : int, optional
+            Gzip compression level of the image, default : 1
+
+        Returns
+        -------
+        str
+            Path of the image
+
+        """
+        shape, weights, orientations = self._prepare(fractions, orientations)
+        reference = Volume(reference) if reference is not None else None
+        nrrd = get_extension(output_path) == "nrrd"
+        keys = (
+            get_gradient_keys(
+                self.bvals,
+                self.bvecs,
+                reference.key_values if reference else [],
+            )
+            if nrrd
+            else None
+        )
+
+        n_volumes, n_voxels = len(self.bvals), len(orientations)
+        step = max(1, int(self.chunk_bytes // (8 * n_voxels)))
+        with VolumeWriter(
+            output_path,
+            shape + (n_volumes,),
+            np.float32,
+            reference,
+            compress_level,
+            keys,
+        ) as writer:
+            for start in range(0, n_volumes, step):
+                volumes = slice(start, min(start + step, n_volumes))
+                signal = self._compute(weights, orientations, volumes)
+                writer.write(signal.reshape(shape + (-1,)))
+
+        if not nrrd:
+            save_gradient_table(output_path, self.bvals, self.bvecs)
+        return output_path
+
+    def _prepare(self, fractions, orientations):
+        unknown = [c for c in fractions if c not in self.compartments]
+        if unknown:
+            raise ValueError(
+                "Compartments {} are not simulated".format(", ".join(unknown))
+            )
+
+        orientations = np.asarray(orientations, float)
+        shape = orientations.shape[:3]
+        weights = load_fractions(fractions, shape)
+        return (
+            shape,
+            {c: w.reshape(-1) for c, w in weights.items()},
+            normalize_vectors(orientations.reshape((-1, 3))),
+        )
+
+    def _compute(self, weights, orientations, volumes):
+        bvals, bvecs = self.bvals[volumes], self.bvecs[volumes]
+        signal = np.empty((len(orientations), len(bvals)))
+        chunk = max(1, int(self.chunk_bytes // (32 * len(bvals))))
+
+        def compute_chunk(start):
+            voxels = slice(start, start + chunk)
+            signal[voxels] = self._compute_chunk(
+                {c: w[voxels] for c, w in weights.items()},
+                orientations[voxels],
+                bvals,
+                bvecs,
+            )
+
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            list(pool.map(compute_chunk, range(0, len(orientations), chunk)))
+        return signal
+
+    def _compute_chunk(self, weights, orientations, bvals, bvecs):
+        signal = np.zeros((len(orientations), len(bvals)))
+        cosines = orientations @ bvecs.T
+        perpendiculars = None
+        for cmp_id, fraction in weights.items():
+            compartment = self.compartments[cmp_id]
+            model = compartment["model"]
+            fraction = fraction * np.exp(-self.echo_time / compartment["t2"])
+
+            if model == "ball":
+                signal += fraction[:, None] * np.exp(-bvals * compartment["d"])
+                continue
+
+            if model == "stick":
+                adc = compartment["d"] * cosines ** 2
+            else:
+                if perpendiculars is None:
+                    perpendiculars = [
+                        p @ bvecs.T for p in _get_perpendiculars(orientations)
+                    ]
+                adc = (
+                    compartment["d1"] * cosines ** 2
+                    + compartment["d2"] * perpendiculars[0] ** 2
+                    + compartment["d3"] * perpendiculars[1] ** 2
+                )
+            adc *= -bvals
+            signal += fraction[:, None] * np.exp(adc, out=adc)
+
+        signal *= self.signal_scale
+        return signal
@@ -0,0 +1,388 @@
+from contextlib import ExitStack
+import json
+import logging
+from os import makedirs, path
+from os.path import basename
+
+import numpy as np
+
+from simulator.factory.simulation_factory import SimulationFactory
+from simulator.runner.cache import materialize
+from simulator.runner.datastore import get_unit_fraction_approximations
+from simulator.runner.volumes import Volume, VolumeWriter, get_extension
+
+
+logger = logging.getLogger(basename(__file__).split(".")[0])
+
+CompartmentType = SimulationFactory.CompartmentType
+
+
+def _get_stem(image_path):
+    return image_path[: -len(get_extension(image_path)) - 1]
+
+
+def get_phantom_fractions(
+    phantom_folder,
+    run_name,
+    compartment_ids,
+    inter_axonal_fraction=None,
+    extra_axonal_split=None,
+    use_nifti=True,
+):
+    """
+    Describes the compartment fractions a simulation of the phantom would
+    be given by the runner (see Datastore.load_compartments), in the form
+    expected by a CompartmentRecombiner
+
+    Parameters
+    ----------
+    phantom_folder : str
+        Folder holding the phantom outputs
+    run_name : str
+        Name of the phantom outputs
+    compartment_ids : list(str)
+        Identifiers of the simulated compartments
+    inter_axonal_fraction : float, optional
+        Fraction of the fiber compartment given to the inter axonal
+        compartment, required if it is simulated
+    extra_axonal_split : float, optional
+        Fraction of the extra axonal space given to the second extra axonal
+        compartment, when both are simulated and the phantom has no
+        ellipses map. By default, the first one gets all of it
+    use_nifti : bool, optional
+        The phantom outputs are in nifti format instead of nrrd,
+        default : True
+
+    Returns
+    -------
+    dict
+        Fraction of every compartment, indexed by compartment identifier
+
+    """
+    extension = "nii.gz" if use_nifti else "nrrd"
+    fibers, ellipses = [
+        path.join(
+            phantom_folder,
+            "{}_phantom_merged{}Maps.{}".format(run_name, maps, extension),
+        )
+        for maps in ["Bundles", "Ellipses"]
+    ]
+
+    fractions = []
+    if CompartmentType.INTER_AXONAL.value in compartment_ids:
+        if inter_axonal_fraction is None:
+            raise ValueError(
+                "The inter axonal fraction is required to recombine the "
+                "inter axonal compartment"
+            )
+        fractions += [
+            (fibers, 1.0 - inter_axonal_fraction),
+            (fibers, inter_axonal_fraction),
+        ]
+    else:
+        fractions.append(fibers)
+
+    extras = [
+        c.value
+        for c in [
+            CompartmentType.EXTRA_AXONAL_1,
+            CompartmentType.EXTRA_AXONAL_2,
+        ]
+        if c.value in compartment_ids
+    ]
+    if extras and path.exists(ellipses):
+        fractions += [ellipses, None][: len(extras)]
+    elif len(extras) == 2 and extra_axonal_split is not None:
+        fractions += [
+            (None, 1.0 - extra_axonal_split),
+            (None, extra_axonal_split),
+        ]
+    elif extras:
+        fractions.append(None)
+
+    return dict(zip(compartment_ids, fractions))
+
+
+def _load_map(map_path, maps, shape):
+    if map_path not in maps:
+        volume = Volume(map_path)
+        if volume.shape[:3] != shape:
+            raise ValueError(
+                "Fraction map {} of shape {} does not match the image "
+                "of shape {}".format(map_path, volume.shape, shape)
+            )
+        maps[map_path] = np.asarray(
+            volume.read(0, volume.shape[-1]), np.float64
+        ).reshape(shape)
+    return maps[map_path]
+
+
+def load_fractions(fractions, shape, maps=None, name="fractions"):
+    """
+    Computes the fraction maps of the compartments from their description.
+    The fractions of a compartment are given either as a constant, the path
+    of a fraction map, a (map, scale) pair, or None for the remainder of the
+    voxel left by the other compartments, clipped at 0, which can be scaled
+    too, as (None, scale). A warning is logged for the voxels in which the
+    fractions sum over 1.
+
+    Parameters
+    ----------
+    fractions : dict
+        Fraction of every compartment, indexed by compartment identifier
+        (see get_phantom_fractions)
+    shape : tuple(int)
+        Shape of the image
+    maps : dict, optional
+        Fraction maps already loaded, indexed by path, to which the maps
+        loaded are added, default : None
+    name : str, optional
+        Name of the fractions in the messages, default : "fractions"
+
+    Returns
+    -------
+    dict
+        Fraction map of every compartment, indexed by compartment identifier
+
+    """
+    maps = {} if maps is None else maps
+    weights, remainders = {}, {}
+    for cmp_id, fraction in fractions.items():
+        fraction, scale = (
+            fraction if isinstance(fraction, (tuple, list)) else (fraction, 1)
+        )
+        if fraction is None:
+            remainders[cmp_id] = scale
+        elif isinstance(fraction, str):
+            weights[cmp_id] = scale * _load_map(fraction, maps, shape)
+        else:
+            weights[cmp_id] = np.full(shape, scale * fraction)
+
+    if remainders:
+        remainder = np.clip(1.0 - sum(weights.values()), 0, None)
+        for cmp_id, scale in remainders.items():
+            weights[cmp_id] = scale * remainder
+
+    if any(np.any(w < 0) for w in weights.values()):
+        raise ValueError("Negative compartment fractions for " + name)
+    n_over = int(np.count_nonzero(sum(weights.values()) > 1 + 1e-6))
+    if n_over:
+        logger.warning(
+            "{} : the fractions of the compartments sum over 1 in {} "
+            "voxels".format(name, n_over)
+        )
+
+    return weights
+
+
+class CompartmentRecombiner:
+    """
+    Synthesises the signal of any configuration of the compartment
+    fractions as the voxel-wise weighted sum of the signals of the
+    compartments, simulated once each with a unit fraction map (see
+    SimulationRunner.simulate_compartment_signals). A sweep over fractions
+    then costs one simulation per compartment instead of one per value.
+
+    The fractions of the compartments are described as for load_fractions.
+    The fraction maps, a single volume each, are held in memory, while the
+    signals are streamed, a slab of volumes at a time.
+
+    The recombination is exact for noise-free simulations without k-space
+    or random artifacts. The recombiner reads the parameters of the
+    simulations next to the signals and warns when it only approximates
+    them. Noise is added afterwards, to the recombined signal, with a
+    NoiseEngine.
+    """
+
+    def __init__(self, signals, chunk_bytes=2 ** 26):
+        """
+        Parameters
+        ----------
+        signals : dict
+            Signal of every compartment, simulated with a unit fraction
+            map, indexed by compartment identifier
+        chunk_bytes : int, optional
+            Memory used to process a slab of the signals, default : 64 MiB
+        """
+        self.signals = {c: Volume(s) for c, s in signals.items()}
+        self.chunk_bytes = chunk_bytes
+
+        shapes = set(s.shape for s in self.signals.values())
+        if len(shapes) > 1:
+            raise ValueError(
+                "Compartment signals have different shapes : {}".format(
+                    ", ".join(str(s) for s in shapes)
+                )
+            )
+
+        self.approximations = self._get_approximations()
+        if self.approximations:
+            logger.warning(
+                "Recombined signals only approximate simulations with "
+                "{}".format(", ".join(self.approximations))
+            )
+
+    @property
+    def reference(self):
+        return next(iter(self.signals.values()))
+
+    def _get_approximations(self):
+        approximations = []
+        for cmp_id, signal in self.signals.items():
+            ffp = _get_stem(signal.path) + ".ffp"
+            if not path.exists(ffp):
+                logger.warning(
+                    "No parameters found for the signal of compartment {}, "
+                    "cannot check that it can be recombined".format(cmp_id)
+                )
+                continue
+
+            noise, artifacts = get_unit_fraction_approximations(
+                {
+                    "file_path": path.dirname(ffp),
+                    "param_file": path.basename(ffp),
+                }
+            )
+            if noise:
+                raise ValueError(
+                    "The signal of compartment {} was simulated with noise, "
+                    "which cannot be recombined".format(cmp_id)
+                )
+            approximations += [a for a in artifacts if a not in approximations]
+        return approximations
+
+    def recombine(self, fractions, output_path, compress_level=1):
+        """
+        Writes the signal of a configuration of the compartment fractions,
+        with the header of the compartment signals. The b-values and
+        b-vectors files of the signals are linked next to it.
+
+        Parameters
+        ----------
+        fractions : dict
+            Fraction of every compartment, indexed by compartment
+            identifier (see get_phantom_fractions). Missing compartments
+            are given a null fraction
+        output_path : str
+            Path of the recombined signal
+        compress_level : int, optional
+            Gzip compression level of the signal, default : 1
+
+        Returns
+        -------
+        str
+            Path of the recombined signal
+
+        """
+        return self._write([(output_path, fractions)], compress_level)[0]
+
+    def sweep(self, configurations, output_folder, compress_level=1):
+        """
+        Writes the signals of many configurations of the compartment
+        fractions, reading the compartment signals only once. Each signal
+        is named after its configuration, and the fractions it was
+        recombined from are written in a json file next to it.
+
+        Parameters
+        ----------
+        configurations : dict
+            Fractions of the compartments (see recombine), indexed by the
+            name given to their signal
+        output_folder : str
+            Folder in which to write the signals
+        compress_level : int, optional
+            Gzip compression level of the signals, default : 1
+
+        Returns
+        -------
+        dict
+            Recombined signals, indexed by configuration name
+
+        """
+        makedirs(output_folder, exist_ok=True)
+        extension = get_extension(self.reference.path)
+        outputs = [
+            (
+                path.join(output_folder, "{}.{}".format(name, extension)),
+                fractions,
+            )
+            for name, fractions in configurations.items()
+        ]
+        paths = self._write(outputs, compress_level)
+
+        for name, fractions in configurations.items():
+            with open(
+                path.join(output_folder, "{}_fractions.json".format(name)), "w+"
+            ) as f:
+                json.dump(
+                    {
+                        "signals": {
+                            c: path.abspath(s.path)
+                            for c, s in self.signals.items()
+                        },
+                        "fractions": fractions,
+                        "approximations": self.approximations,
+                    },
+                    f,
+                    indent=4,
+                )
+
+        return dict(zip(configurations, paths))
+
+    def _write(self, outputs, compress_level):
+        reference = self.reference
+        maps = {}
+        weights = [
+            self._get_weights(fractions, maps, output)
+            for output, fractions in outputs
+        ]
+
+        dtype = reference.dtype
+        if not np.issubdtype(dtype, np.floating):
+            dtype = np.dtype(np.float32)
+
+        ids = list(self.signals)
+        step = reference.slab_step(self.chunk_bytes, 8 * (len(ids) + 1))
+        with ExitStack() as stack:
+            writers = [
+                stack.enter_context(
+                    VolumeWriter(
+                        output,
+                        reference.shape,
+                        dtype,
+                        reference,
+                        compress_level,
+                    )
+                )
+                for output, _ in outputs
+            ]
+            for slabs in zip(*[self.signals[c].iter_slabs(step) for c in ids]):
+                data = [np.asarray(slab, np.float64) for _, _, slab in slabs]
+                for writer, output_weights in zip(writers, weights):
+                    signal = np.zeros(data[0].shape)
+                    for cmp_id, slab in zip(ids, data):
+                        if cmp_id in output_weights:
+                            signal += output_weights[cmp_id][..., None] * slab
+                    writer.write(signal)
+
+        self._link_sidecars([output for output, _ in outputs])
+        return [output for output, _ in outputs]
+
+    def _get_weights(self, fractions, maps, output):
+        unknown = [c for c in fractions if c not in self.signals]
+        if unknown:
+            raise ValueError(
+                "No signal for compartments {}".format(", ".join(unknown))
+            )
+        return load_fractions(fractions, self.reference.shape[:3], maps, output)
+
+    def _link_sidecars(self, outputs):
+        stem = _get_stem(self.reference.path)
+        for extension in ["bvals", "bvecs"]:
+            sidecar = "{}.{}".format(stem, extension)
+            if not path.exists(sidecar):
+                continue
+            for output in outputs:
+                materialize(
+                    sidecar, "{}.{}".format(_get_stem(output), extension)
+                )
@@ -0,0 +1,430 @@
+from enum import Enum
+import logging
+from os import path
+from os.path import basename
+from tempfile import TemporaryFile
+
+import numpy as np
+
+from external.qspace_sampler.bases import sh
+from simulator.runner.reader import read_gradient_table
+from simulator.runner.volumes import Volume, VolumeWriter, get_extension
+
+
+logger = logging.getLogger(basename(__file__).split(".")[0])
+
+_NRRD_BVALUE_KEY = "DWMRI_b-value"
+_NRRD_GRADIENT_KEY = "DWMRI_gradient_"
+
+
+def _get_stem(image_path):
+    return image_path[: -len(get_extension(image_path)) - 1]
+
+
+def normalize_vectors(vectors):
+    """
+    Scales vectors of shape (n_vectors, 3) to unit norm, leaving null vectors,
+    such as the b-vectors of b0 volumes, null
+    """
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(
+        vectors, norms, out=np.zeros_like(vectors), where=norms > 0
+    )
+
+
+def _to_angles(directions):
+    theta = np.arccos(np.clip(directions[:, 2], -1.0, 1.0))
+    phi = np.arctan2(directions[:, 1], directions[:, 0])
+    return theta, phi
+
+
+def _scale_gradients(bvalue, gradients):
+    return bvalue * np.sum(gradients ** 2, axis=1), normalize_vectors(gradients)
+
+
+def _scatter(computed, weights, slab, selection):
+    if selection:
+        rows, columns = np.nonzero(weights)
+        computed[..., rows] = slab[..., columns]
+    else:
+        computed += np.tensordot(slab, weights, axes=([-1], [1]))
+
+
+def load_gradient_table(image_path):
+    """
+    Loads the b-values and b-vectors of a diffusion weighted image, from
+    the bvals and bvecs files next to it, from its nrrd header or from the
+    Fiberfox parameter file (ffp) it was simulated from
+
+    Parameters
+    ----------
+    image_path : str
+        Diffusion weighted image output by Fiberfox
+
+    Returns
+    -------
+    tuple(numpy.ndarray, numpy.ndarray)
+        B-values of the volumes, and their unit b-vectors (null for the
+        b0 volumes), of shape (n_volumes, 3)
+
+    """
+    stem = _get_stem(image_path)
+    if path.exists(stem + ".bvals") and path.exists(stem + ".bvecs"):
+        bvals = np.loadtxt(stem + ".bvals", ndmin=1)
+        bvecs = np.loadtxt(stem + ".bvecs", ndmin=2)
+        if bvecs.shape[0] == 3 and not bvecs.shape[1] == 3:
+            bvecs = bvecs.T
+        return bvals, normalize_vectors(bvecs)
+
+    volume = Volume(image_path)
+    if volume.format == "nrrd":
+        keys = dict(k.split(":=", 1) for k in volume.key_values)
+        if _NRRD_BVALUE_KEY in keys:
+            gradients = np.array(
+                [
+                    [float(c) for c in keys[k].split()]
+                    for k in sorted(keys)
+                    if k.startswith(_NRRD_GRADIENT_KEY)
+                ]
+            )
+            return _scale_gradients(float(keys[_NRRD_BVALUE_KEY]), gradients)
+
+    if path.exists(stem + ".ffp"):
+        return read_gradient_table(stem + ".ffp")
+
+    raise ValueError("No gradient table found for {}".format(image_path))
+
+
+def get_gradient_keys(bvals, bvecs, keys=()):
+    """
+    Key/value lines of a nrrd header describing a gradient table, replacing the
+    one of the given lines
+    """
+    keys = [
+        k
+        for k in keys
+        if not k.startswith(_NRRD_GRADIENT_KEY)
+        and not k.startswith(_NRRD_BVALUE_KEY)
+    ]
+    b_max = bvals.max()
+    keys.append("{}:={:g}".format(_NRRD_BVALUE_KEY, b_max))
+    for i, (bval, bvec) in enumerate(zip(bvals, bvecs)):
+        gradient = bvec * np.sqrt(bval / b_max)
+        keys.append(
+            "{}{:04d}:={:.8f} {:.8f} {:.8f}".format(
+                _NRRD_GRADIENT_KEY, i, *gradient
+            )
+        )
+    return keys
+
+
+def save_gradient_table(image_path, bvals, bvecs):
+    """Writes the bvals and bvecs files of a nifti image next to it"""
+    stem = _get_stem(image_path)
+    np.savetxt(stem + ".bvals", np.asarray(bvals)[None], fmt="%g")
+    np.savetxt(stem + ".bvecs", np.asarray(bvecs).T, fmt="%g")
+
+
+class GradientSubsampler:
+    """
+    Extracts acquisition schemes from the output of a simulation of a dense
+    protocol, so that many schemes can be compared from a single run of
+    Fiberfox. The volumes of a requested scheme are either taken from the
+    dense volumes of nearest direction on the same shell, or resampled in
+    the directions of the scheme from a spherical harmonics fit of the
+    shell (see external/qspace_sampler/bases/sh.py).
+
+    The dense image is streamed, a slab of volumes at a time, and the
+    volumes of the scheme are written as they are computed, as many at a
+    time as fit in the memory budget. Uncompressed images are read only
+    for the volumes the scheme needs. Compressed images are decompressed
+    once, every slab being scattered into all the volumes of the scheme
+    that need it, which are accumulated in a temporary file next to the
+    output.
+    """
+
+    class Method(Enum):
+        """Ways of computing a volume of the scheme"""
+
+        NEAREST = "nearest"
+        SPHERICAL_HARMONICS = "sh"
+
+    def __init__(
+        self,
+        image_path,
+        b0_threshold=50.0,
+        shell_tolerance=100.0,
+        chunk_bytes=2 ** 26,
+    ):
+        """
+        Parameters
+        ----------
+        image_path : str
+            Diffusion weighted image of the dense protocol, output by
+            Fiberfox, with its gradient table
+        b0_threshold : float, optional
+            B-value under which a volume is a b0, default : 50
+        shell_tolerance : float, optional
+            Largest difference of b-value between a volume of the scheme
+            and the dense volumes of its shell, default : 100
+        chunk_bytes : int, optional
+            Memory used to hold the dense slabs and the volumes of the
+            scheme being computed, default : 64 MiB
+        """
+        self.image = Volume(image_path)
+        self.bvals, self.bvecs = load_gradient_table(image_path)
+        if not len(self.bvals) == self.image.shape[-1]:
+            raise ValueError(
+                "{} has {} volumes, its gradient table has {}".format(
+                    image_path, self.image.shape[-1], len(self.bvals)
+                )
+            )
+        self.b0_threshold = b0_threshold
+        self.shell_tolerance = shell_tolerance
+        self.chunk_bytes = chunk_bytes
+
+    def match(
+        self,
+        bvals,
+        bvecs,
+        method=Method.NEAREST,
+        sh_rank=8,
+        regularization=6e-3,
+    ):
+        """
+        Computes how the volumes of a scheme are obtained from the dense
+        volumes. The b0 volumes of the scheme are taken in turn from the
+        dense b0 volumes.
+
+        Parameters
+        ----------
+        bvals : list(float)
+            B-values of the scheme
+        bvecs : list(list(float))
+            B-vectors of the scheme
+        method : GradientSubsampler.Method, optional
+            Way of computing the volumes of the scheme,
+            default : Method.NEAREST
+        sh_rank : int, optional
+            Highest rank of the spherical harmonics fitted to every shell,
+            lowered for shells with too few directions, default : 8
+        regularization : float, optional
+            Weight of the Laplace-Beltrami regularization of the spherical
+            harmonics fit, default : 6e-3
+
+        Returns
+        -------
+        tuple(numpy.ndarray, numpy.ndarray, numpy.ndarray)
+            Weights of the dense volumes in every volume of the scheme, of
+            shape (n_scheme, n_dense), and the b-values and b-vectors of
+            the volumes of the scheme as computed. With nearest matching,
+            they are the ones of the dense volumes taken.
+
+        """
+        bvals = np.asarray(bvals, float)
+        bvecs = normalize_vectors(np.asarray(bvecs, float).reshape((-1, 3)))
+        mapping = np.zeros((len(bvals), len(self.bvals)))
+        out_bvals, out_bvecs = bvals.copy(), bvecs.copy()
+
+        dense_b0s = np.flatnonzero(self.bvals <= self.b0_threshold)
+        b0s = np.flatnonzero(bvals <= self.b0_threshold)
+        if len(b0s) and not len(dense_b0s):
+            raise ValueError("The dense protocol has no b0 volume")
+        for i, volume in enumerate(b0s):
+            source = dense_b0s[i % len(dense_b0s)]
+            mapping[volume, source] = 1.0
+            out_bvals[volume] = self.bvals[source]
+            out_bvecs[volume] = self.bvecs[source]
+
+        for volumes, sources in self._get_shells(bvals):
+            if method is GradientSubsampler.Method.NEAREST:
+                cosines = np.abs(bvecs[volumes] @ self.bvecs[sources].T)
+                nearest = sources[np.argmax(cosines, axis=1)]
+                mapping[volumes, nearest] = 1.0
+                out_bvals[volumes] = self.bvals[nearest]
+                out_bvecs[volumes] = self.bvecs[nearest]
+
+                errors = np.degrees(np.arccos(np.clip(cosines.max(1), 0, 1)))
+                logger.info(
+                    "Shell b={:g} : {} directions matched, largest angular "
+                    "error {:.2f} degrees".format(
+                        bvals[volumes].mean(), len(volumes), errors.max()
+                    )
+                )
+                if len(np.unique(nearest)) < len(nearest):
+                    logger.warning(
+                        "Shell b={:g} : {} directions are matched to an "
+                        "already used dense volume".format(
+                            bvals[volumes].mean(),
+                            len(nearest) - len(np.unique(nearest)),
+                        )
+                    )
+            else:
+                mapping[np.ix_(volumes, sources)] = self._fit_shell(
+                    bvecs[volumes], sources, sh_rank, regularization
+                )
+                out_bvals[volumes] = self.bvals[sources].mean()
+
+        return mapping, out_bvals, out_bvecs
+
+    def extract(
+        self,
+        bvals,
+        bvecs,
+        output_path,
+        method=Method.NEAREST,
+        sh_rank=8,
+        regularization=6e-3,
+        compress_level=1,
+    ):
+        """
+        Writes the image of a scheme, along with its gradient table, as
+        bvals and bvecs files for nifti images, or in the header of nrrd
+        images, in the format of the dense image
+
+        Parameters
+        ----------
+        bvals : list(float)
+            B-values of the scheme
+        bvecs : list(list(float))
+            B-vectors of the scheme
+        output_path : str
+            Path of the image of the scheme
+        method : GradientSubsampler.Method, optional
+            Way of computing the volumes of the scheme (see match),
+            default : Method.NEAREST
+        sh_rank : int, optional
+            Highest rank of the spherical harmonics (see match),
+            default : 8
+        regularization : float, optional
+            Weight of the regularization of the spherical harmonics fit
+            (see match), default : 6e-3
+        compress_level : int, optional
+            Gzip compression level of the image, default : 1
+
+        Returns
+        -------
+        tuple(numpy.ndarray, numpy.ndarray)
+            B-values and b-vectors written with the image
+
+        """
+        mapping, out_bvals, out_bvecs = self.match(
+            bvals, bvecs, method, sh_rank, regularization
+        )
+        selection = method is GradientSubsampler.Method.NEAREST
+        dtype = self.image.dtype
+        if not selection and not np.issubdtype(dtype, np.floating):
+            dtype = np.dtype(np.float32)
+
+        shape = self.image.shape[:-1] + (len(out_bvals),)
+        volume_bytes = int(np.prod(shape[:-1])) * 8
+        n_computed = max(1, self.chunk_bytes // (2 * volume_bytes))
+        step = self.image.slab_step(self.chunk_bytes // 2, 8)
+
+        keys = None
+        if self.image.format == "nrrd":
+            keys = get_gradient_keys(
+                out_bvals, out_bvecs, self.image.key_values
+            )
+
+        with VolumeWriter(
+            output_path, shape, dtype, self.image, compress_level, keys
+        ) as writer:
+            if self.image.compressed:
+                self._extract_in_one_pass(
+                    mapping, selection, step, n_computed, writer
+                )
+            else:
+                for first in range(0, len(out_bvals), n_computed):
+                    weights = mapping[first : first + n_computed]
+                    computed = np.zeros(shape[:-1] + (len(weights),))
+                    for start, stop, slab in self._iter_sources(weights, step):
+                        _scatter(
+                            computed, weights[:, start:stop], slab, selection
+                        )
+                    writer.write(computed)
+
+        if not self.image.format == "nrrd":
+            save_gradient_table(output_path, out_bvals, out_bvecs)
+
+        return out_bvals, out_bvecs
+
+    def _get_shells(self, bvals):
+        dense = np.flatnonzero(self.bvals > self.b0_threshold)
+        shells = {}
+        for volume in np.flatnonzero(bvals > self.b0_threshold):
+            sources = dense[
+                np.abs(self.bvals[dense] - bvals[volume])
+                <= self.shell_tolerance
+            ]
+            if not len(sources):
+                raise ValueError(
+                    "No dense volume within b={:g}+/-{:g}".format(
+                        bvals[volume], self.shell_tolerance
+                    )
+                )
+            shells.setdefault(tuple(sources), []).append(volume)
+
+        return [
+            (np.array(volumes), np.array(sources))
+            for sources, volumes in shells.items()
+        ]
+
+    def _fit_shell(self, directions, sources, sh_rank, regularization):
+        rank = sh_rank - sh_rank % 2
+        while rank > 0 and sh.dimension(rank) > len(sources):
+            rank -= 2
+        if rank < sh_rank:
+            logger.warning(
+                "Shell b={:g} : {} dense directions, spherical harmonics "
+                "rank lowered to {}".format(
+                    self.bvals[sources].mean(), len(sources), rank
+                )
+            )
+
+        basis = sh.matrix(*_to_angles(self.bvecs[sources]), rank)
+        laplacian = sh.L(rank)
+        fit = np.linalg.solve(
+            basis.T @ basis + regularization * laplacian @ laplacian, basis.T
+        )
+        return sh.matrix(*_to_angles(directions), rank) @ fit
+
+    def _extract_in_one_pass(
+        self, mapping, selection, step, n_computed, writer
+    ):
+        chunks = range(0, writer.shape[-1], n_computed)
+        last = np.flatnonzero(np.any(mapping != 0, axis=0)).max(initial=-1)
+        with TemporaryFile(dir=path.dirname(path.abspath(writer.path))) as f:
+            computed = np.memmap(
+                f,
+                writer.dtype if selection else np.float64,
+                "w+",
+                shape=writer.shape,
+                order="F",
+            )
+            for start, stop, slab in self.image.iter_slabs(step):
+                for first in chunks:
+                    weights = mapping[first : first + n_computed, start:stop]
+                    if np.any(weights != 0):
+                        _scatter(
+                            computed[..., first : first + n_computed],
+                            weights,
+                            slab,
+                            selection,
+                        )
+                if stop > last:
+                    break
+
+            for first in chunks:
+                writer.write(computed[..., first : first + n_computed])
+
+    def _iter_sources(self, weights, step):
+        used = np.flatnonzero(np.any(weights != 0, axis=0))
+        start = used[0]
+        while start <= used[-1]:
+            stop = min(start + step, used[-1] + 1)
+            yield start, stop, self.image.read(start, stop)
+            following = used[used >= stop]
+            if not len(following):
+                return
+            start = following[0]
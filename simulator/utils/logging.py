@@ -1,72 +1,215 @@
-from queue import Queue
-from threading import Thread
-import time
+import logging
+import os
+from os.path import basename
+from selectors import DefaultSelector, EVENT_READ
+from threading import Event, Lock, Thread
 
 
-class RTLogging:
-    def __init__(self, process, log_file_path, log_tag=""):
-        self._process = process
-        self._log = log_file_path
-        self._tag = log_tag
+logger = logging.getLogger(basename(__file__).split(".")[0])
+
+
+def _open_pidfd(pid):
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return None
+
+
+class _PumpedProcess:
+    def __init__(self, process, log_file_path, log_tag, line_callback):
+        self.process = process
+        self.tag = log_tag
+        self.line_callback = line_callback
+        self.log = open(log_file_path, "a+")
+        self.streams = {
+            process.stdout.fileno(): ["STD", b""],
+            process.stderr.fileno(): ["ERR", b""],
+        }
+        self.pidfd = _open_pidfd(process.pid)
+        self.exited = False
+        self.done = Event()
+
+
+class LogPump:
+    """
+    Writes the outputs of any number of processes to their log files from
+    a single thread. The thread sleeps until one of the pipes is readable
+    or one of the processes exits, and releases a process as soon as it
+    ends.
+    """
+
+    _default = None
+    _default_lock = Lock()
+    _read_size = 2 ** 16
+    _exit_poll = 0.1
+
+    def __init__(self):
+        self._selector = DefaultSelector()
+        self._lock = Lock()
         self._thread = None
+        self._pending = []
+        self._children = []
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        self._selector.register(self._wake_r, EVENT_READ, None)
 
-    def start(self, logging_args=()):
-        self._thread = Thread(target=self._read_output, args=logging_args)
-        self._thread.daemon = True
-        self._thread.start()
+    @classmethod
+    def default(cls):
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = LogPump()
+            return cls._default
 
-    def join(self):
-        self._thread.join()
+    def add(self, process, log_file_path, log_tag="", line_callback=None):
+        """
+        Start pumping the stdout and stderr of a process to a log file
 
-    def _read_output(self, poll_timer=4, logging_callback=lambda a: None):
-        stdout_queue = Queue()
-        stderr_queue = Queue()
-        t1 = Thread(
-            target=self._enqueue_thread_output,
-            args=(self._process.stdout, stdout_queue),
-        )
-        t1.daemon = True
-        t1.start()
-        t2 = Thread(
-            target=self._enqueue_thread_output,
-            args=(self._process.stderr, stderr_queue),
-        )
-        t2.daemon = True
-        t2.start()
+        Parameters
+        ----------
+        process : subprocess.Popen
+            Process launched with stdout and stderr set to PIPE
+        log_file_path : str
+            Log file to which the outputs are appended
+        log_tag : str, optional
+            Tag prepended to every line written to the log
+        line_callback : callable, optional
+            Called with (log_tag, stream_tag, line) for every line read,
+            stream_tag being either STD or ERR
 
-        with open(self._log, "a+") as log_file:
-            while self._process.poll() is None:
-                self._dequeue_output(log_file, stdout_queue, "STD")
-                self._dequeue_output(log_file, stderr_queue, "ERR")
+        Returns
+        -------
+        threading.Event
+            Event set once the process has ended and its outputs are logged
 
-                logging_callback(self._log)
-                time.sleep(poll_timer)
+        """
+        child = _PumpedProcess(process, log_file_path, log_tag, line_callback)
+        with self._lock:
+            self._pending.append(child)
+            if self._thread is None:
+                self._thread = Thread(target=self._pump)
+                self._thread.daemon = True
+                self._thread.start()
+            else:
+                os.write(self._wake_w, b"\0")
 
-            self._dequeue_output(log_file, stdout_queue, "STD")
-            self._dequeue_output(log_file, stderr_queue, "ERR")
+        return child.done
 
-            logging_callback(self._log)
-            time.sleep(poll_timer)
+    def _pump(self):
+        while True:
+            with self._lock:
+                for child in self._pending:
+                    self._register(child)
+                self._pending = []
+                if not self._children:
+                    self._thread = None
+                    return
 
-    def _enqueue_thread_output(self, pipe, queue):
-        while self._process.poll() is None:
-            ln = pipe.readline()
-            queue.put(ln)
+            timeout = (
+                None
+                if all(c.pidfd is not None for c in self._children)
+                else self._exit_poll
+            )
+            for key, _ in self._selector.select(timeout):
+                if key.data is None:
+                    self._clear_wakeups()
+                    continue
+                child, fd = key.data
+                if fd == child.pidfd:
+                    child.exited = True
+                else:
+                    self._read(child, fd)
 
-    def _dequeue_output(self, log_file, queue, tag):
+            for child in list(self._children):
+                if child.exited or (
+                    child.pidfd is None and child.process.poll() is not None
+                ):
+                    self._finish(child)
+
+    def _register(self, child):
+        for fd in child.streams:
+            os.set_blocking(fd, False)
+            self._selector.register(fd, EVENT_READ, (child, fd))
+        if child.pidfd is not None:
+            self._selector.register(
+                child.pidfd, EVENT_READ, (child, child.pidfd)
+            )
+        self._children.append(child)
+
+    def _clear_wakeups(self):
         try:
-            while not queue.empty():
-                ln = queue.get_nowait()
-                if ln:
-                    log_file.write(
-                        "\n".join(
-                            [
-                                "{}[{}] {}".format(self._tag, tag, l)
-                                for l in ln.decode("ascii").strip().split("\n")
-                            ]
-                        )
-                        + "\n"
-                    )
-                    log_file.flush()
-        except:
+            while os.read(self._wake_r, self._read_size):
+                pass
+        except BlockingIOError:
             pass
+
+    def _read(self, child, fd):
+        try:
+            chunk = os.read(fd, self._read_size)
+        except BlockingIOError:
+            return False
+
+        stream = child.streams[fd]
+        lines = (stream[1] + chunk).split(b"\n")
+        stream[1] = lines.pop() if chunk else b""
+        self._write_lines(child, stream[0], lines)
+
+        if not chunk:
+            self._selector.unregister(fd)
+            child.streams.pop(fd)
+
+        return bool(chunk)
+
+    def _write_lines(self, child, stream_tag, lines):
+        lines = [
+            ln.decode("utf-8", "replace").strip() for ln in lines if ln.strip()
+        ]
+        for ln in lines:
+            child.log.write("{}[{}] {}\n".format(child.tag, stream_tag, ln))
+            if child.line_callback is not None:
+                try:
+                    child.line_callback(child.tag, stream_tag, ln)
+                except Exception:
+                    logger.exception(
+                        "Line callback failed on the output of process "
+                        "{}".format(child.process.pid)
+                    )
+        if lines:
+            child.log.flush()
+
+    def _finish(self, child):
+        for fd in list(child.streams):
+            while fd in child.streams and self._read(child, fd):
+                pass
+        for fd, (stream_tag, remainder) in child.streams.items():
+            self._write_lines(child, stream_tag, [remainder])
+            self._selector.unregister(fd)
+        if child.pidfd is not None:
+            self._selector.unregister(child.pidfd)
+            os.close(child.pidfd)
+        child.process.stdout.close()
+        child.process.stderr.close()
+
+        child.process.wait()
+        child.log.close()
+        self._children.remove(child)
+        child.done.set()
+
+
+class RTLogging:
+    def __init__(
+        self, process, log_file_path, log_tag="", line_callback=None, pump=None
+    ):
+        self._process = process
+        self._log = log_file_path
+        self._tag = log_tag
+        self._line_callback = line_callback
+        self._pump = pump if pump else LogPump.default()
+        self._done = None
+
+    def start(self):
+        self._done = self._pump.add(
+            self._process, self._log, self._tag, self._line_callback
+        )
+
+    def join(self, timeout=None):
+        return self._done.wait(timeout)
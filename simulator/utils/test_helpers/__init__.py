@@ -1 +1,2 @@
 from .geometry_helper import GeometryHelper
+from .stub_tools import StubTools
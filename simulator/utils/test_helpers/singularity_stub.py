@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+"""
+Stand-in for the singularity executable, installed by StubTools. It
+understands the commands used by the runners :
+
+    instance start [-B binds] <image> <name>
+    instance stop <name>
+    run [-B binds] --app <app> <image or instance://name> <arguments>
+    exec --app <app> instance://<name> <app runscript> <arguments>
+
+Instances are tracked in a file next to the configuration of the stubs, and
+the apps of the image are replaced by the stand-in of their tool.
+"""
+
+import fcntl
+import json
+import os
+import sys
+
+
+_tools = {"launch_voxsim": "voxsim", "launch_mitk": "fiberfox"}
+
+
+def _update_instances(state_file, command, name):
+    with open(state_file, "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        instances = f.read().split()
+        if command == "start" and name in instances:
+            return "instance {} already exists".format(name)
+        if command == "stop" and name not in instances:
+            return "no instance found with name {}".format(name)
+
+        if command == "start":
+            instances.append(name)
+        else:
+            instances.remove(name)
+
+        f.seek(0)
+        f.truncate()
+        f.write("\n".join(instances))
+
+    return None
+
+
+def _is_running(state_file, name):
+    if not os.path.exists(state_file):
+        return False
+    with open(state_file) as f:
+        return name in f.read().split()
+
+
+def main(config_file, args):
+    with open(config_file) as f:
+        config = json.load(f)
+    state_file = os.path.join(os.path.dirname(config_file), "instances")
+
+    if args[:1] == ["instance"] and args[1:2] in (["start"], ["stop"]):
+        error = _update_instances(state_file, args[1], args[-1])
+        sys.exit(error)
+
+    unsupported = "Unsupported singularity command : {}".format(" ".join(args))
+    if args[:1] not in (["run"], ["exec"]) or "--app" not in args:
+        sys.exit(unsupported)
+
+    app_index = args.index("--app")
+    app, target = args[app_index + 1], args[app_index + 2]
+    arguments = args[app_index + 3 :]
+    if args[0] == "exec":
+        if not arguments[:1] == ["/scif/apps/{}/scif/runscript".format(app)]:
+            sys.exit(unsupported)
+        arguments = arguments[1:]
+    if target.startswith("instance://") and not _is_running(
+        state_file, target[len("instance://") :]
+    ):
+        sys.exit("no instance found with name {}".format(target))
+
+    tool = _tools[app]
+    command = [config["python_exec"], config["tool"]]
+    command += config["profiles"][tool] + [tool] + arguments
+    os.execv(command[0], command)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,156 @@
+import json
+from os import chmod, makedirs, path
+import sys
+
+from ...runner.impl.runner_dry import DryRunBackend
+
+
+class StubTools:
+    """
+    Installs stand-in executables for voxsim, Fiberfox and singularity in a
+    folder, which honour the command lines of the real tools and write
+    synthetic outputs of the right shape (see dry_run_tool.py). They let the
+    runners be exercised and benchmarked without the simulator's image.
+    """
+
+    _profile_keys = ["sleep", "memory", "log_lines"]
+
+    def __init__(
+        self,
+        folder,
+        voxsim_profile=None,
+        fiberfox_profile=None,
+        python_exec=sys.executable,
+    ):
+        """
+        Parameters
+        ----------
+        folder : str
+            Folder in which to install the executables
+        voxsim_profile : dict, optional
+            Resources used by the voxsim stand-in : "sleep" seconds of
+            running time, "memory" bytes allocated progressively over it and
+            "log_lines" lines written to its output, default : None
+        fiberfox_profile : dict, optional
+            Resources used by the Fiberfox stand-in, as for voxsim,
+            default : None
+        python_exec : str, optional
+            Python interpreter running the stand-ins,
+            default : the current interpreter
+        """
+        self.folder = path.abspath(folder)
+        self._profiles = {
+            "voxsim": voxsim_profile if voxsim_profile else {},
+            "fiberfox": fiberfox_profile if fiberfox_profile else {},
+        }
+        self._python = python_exec
+
+    @property
+    def voxsim_exec(self):
+        return path.join(self.folder, "voxsim")
+
+    @property
+    def fiberfox_exec(self):
+        return path.join(self.folder, "MitkFiberfox")
+
+    @property
+    def singularity_exec(self):
+        return path.join(self.folder, "singularity")
+
+    @property
+    def image(self):
+        return path.join(self.folder, "stub.sif")
+
+    def install(self):
+        """
+        Writes the executables in the folder
+
+        Returns
+        -------
+        StubTools
+            The stubs installed
+
+        """
+        for key in set().union(*self._profiles.values()):
+            if key not in self._profile_keys:
+                raise ValueError("Unknown profile key {}".format(key))
+
+        makedirs(self.folder, exist_ok=True)
+        profiles = {
+            tool: self._get_profile_arguments(profile)
+            for tool, profile in self._profiles.items()
+        }
+        config_file = path.join(self.folder, "stubs.json")
+        with open(config_file, "w+") as f:
+            json.dump(
+                {
+                    "python_exec": self._python,
+                    "tool": DryRunBackend.tool,
+                    "profiles": profiles,
+                },
+                f,
+            )
+
+        self._write_executable(
+            self.voxsim_exec,
+            [self._python, DryRunBackend.tool]
+            + profiles["voxsim"]
+            + ["voxsim"],
+        )
+        self._write_executable(
+            self.fiberfox_exec,
+            [self._python, DryRunBackend.tool]
+            + profiles["fiberfox"]
+            + ["fiberfox"],
+        )
+        self._write_executable(
+            self.singularity_exec,
+            [
+                self._python,
+                path.join(path.dirname(__file__), "singularity_stub.py"),
+                config_file,
+            ],
+        )
+        open(self.image, "a+").close()
+
+        return self
+
+    def get_config(self, backend="local"):
+        """
+        Configuration of the simulator running the stand-ins
+
+        Parameters
+        ----------
+        backend : str, optional
+            Backend through which to run them, "local" or "singularity",
+            default : "local"
+
+        Returns
+        -------
+        dict
+            Configuration, as loaded from config.json
+
+        """
+        return {
+            "backend": backend,
+            "singularity_path": self.folder,
+            "singularity_name": path.basename(self.image),
+            "singularity_exec": self.singularity_exec,
+            "voxsim_exec": self.voxsim_exec,
+            "fiberfox_exec": self.fiberfox_exec,
+        }
+
+    def _get_profile_arguments(self, profile):
+        arguments = []
+        for key in self._profile_keys:
+            if key in profile:
+                arguments += [
+                    "--{}".format(key.replace("_", "-")),
+                    str(profile[key]),
+                ]
+        return arguments
+
+    def _write_executable(self, name, command):
+        with open(name, "w+") as f:
+            f.write('#!/bin/sh\nexec {} "$@"\n'.format(" ".join(command)))
+        chmod(name, 0o755)
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+from simulator.factory import SimulationFactory
+from simulator.runner import SimulationRunner
+from simulator.utils.test_helpers import GeometryHelper
+
+
+N_DIRECTIONS = 6
+# Fiberfox simulates a b0 volume before the gradient directions
+N_VOLUMES = N_DIRECTIONS + 1
+INTER_AXONAL_FRACTION = 0.3
+N_SHARDS = 3
+
+
+def _get_simulation_handler(geometry_handler):
+    Type = SimulationFactory.CompartmentType
+    simulation_handler = SimulationFactory.get_simulation_handler(
+        geometry_handler,
+        [
+            SimulationFactory.generate_fiber_stick_compartment(
+                1.7e-3, 900, 80, Type.INTRA_AXONAL
+            ),
+            SimulationFactory.generate_fiber_stick_compartment(
+                1.0e-3, 900, 80, Type.INTER_AXONAL
+            ),
+            SimulationFactory.generate_extra_ball_compartment(
+                3e-3, 4000, 2000, Type.EXTRA_AXONAL_1
+            ),
+            SimulationFactory.generate_extra_ball_compartment(
+                2e-3, 4000, 2000, Type.EXTRA_AXONAL_2
+            ),
+        ],
+    )
+    simulation_handler.set_acquisition_profile(
+        SimulationFactory.generate_acquisition_profile(100, 1000, 1)
+    )
+    directions = np.random.default_rng(0).normal(size=(N_DIRECTIONS, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, None]
+    simulation_handler.set_gradient_profile(
+        SimulationFactory.generate_gradient_profile(
+            [1000] * N_DIRECTIONS, directions.tolist()
+        )
+    )
+    return simulation_handler
+
+
+@pytest.fixture(scope="session")
+def configuration(tmp_path_factory):
+    """Geometry of a bundle and simulation of its four compartments"""
+    folder = str(tmp_path_factory.mktemp("inputs"))
+    geometry_handler = GeometryHelper.get_dummy_geometry_handler()
+    geometry_infos = geometry_handler.generate_json_configuration_files(
+        "geometry", folder
+    )
+    simulation_infos = _get_simulation_handler(
+        geometry_handler
+    ).generate_xml_configuration_file("simulation", folder)
+
+    return geometry_infos, simulation_infos
+
+
+@pytest.fixture(scope="session")
+def sharded_configuration(tmp_path_factory):
+    """Configuration of the simulation, split in N_SHARDS gradient shards"""
+    folder = str(tmp_path_factory.mktemp("sharded_inputs"))
+    geometry_handler = GeometryHelper.get_dummy_geometry_handler()
+    geometry_infos = geometry_handler.generate_json_configuration_files(
+        "geometry", folder
+    )
+    simulation_infos = _get_simulation_handler(
+        geometry_handler
+    ).generate_sharded_xml_configuration_files("simulation", N_SHARDS, folder)
+
+    return geometry_infos, simulation_infos
+
+
+@pytest.fixture(scope="session")
+def runner():
+    return SimulationRunner({"backend": "dry_run"})
+
+
+@pytest.fixture(scope="session", params=[True, False], ids=["nifti", "nrrd"])
+def dry_run(request, tmp_path_factory, configuration, runner):
+    """
+    Output folder, format and image of a run of the runner on the dry-run
+    backend, in nifti and in nrrd
+    """
+    output_folder = str(tmp_path_factory.mktemp("run"))
+    geometry_infos, simulation_infos = configuration
+    image = runner.run(
+        "run",
+        geometry_infos,
+        simulation_infos,
+        output_folder,
+        output_nifti=request.param,
+        inter_axonal_fraction=INTER_AXONAL_FRACTION,
+    )
+    return output_folder, request.param, image
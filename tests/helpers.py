@@ -0,0 +1,20 @@
+import nibabel as nib
+import nrrd
+import numpy as np
+
+from simulator.runner.volumes import get_extension
+
+
+def load_image(image_path):
+    """Loads a whole nifti or nrrd image, without the runner's readers"""
+    if get_extension(image_path) == "nrrd":
+        return nrrd.read(image_path)[0]
+    return np.asarray(nib.load(image_path).dataobj)
+
+
+def save_image(data, image_path, **header):
+    if get_extension(image_path) == "nrrd":
+        nrrd.write(image_path, data, header)
+    else:
+        nib.save(nib.Nifti1Image(data, np.eye(4)), image_path)
+    return image_path
@@ -0,0 +1,90 @@
+import sys
+
+import pytest
+
+from simulator.exceptions import SimulationRunnerException
+from simulator.runner import SimulationRunner
+from simulator.runner.metrics import RunMetrics
+from simulator.runner.simulation_runner import AsyncRunner
+from tests.conftest import INTER_AXONAL_FRACTION
+
+
+def test_run_commands(tmp_path):
+    runner = AsyncRunner(max_concurrent_commands=1)
+    log_file = str(tmp_path / "run.log")
+
+    results = runner._run_commands(
+        [("echo first", log_file, "[A]"), ("ls missing", log_file, "[B]")]
+    )
+    runner.stop()
+
+    assert [return_code == 0 for return_code, _ in results] == [True, False]
+    with open(log_file) as f:
+        lines = f.read().splitlines()
+    assert "[A][STD] first" in lines
+    assert any(line.startswith("[B][ERR] ") for line in lines)
+
+
+@pytest.mark.parametrize(
+    "output_timeout, timeout, reason",
+    [(0.5, None, "produced no output for 0.5s"), (None, 0.5, "timed out")],
+)
+def test_watchdog(tmp_path, output_timeout, timeout, reason):
+    runner = AsyncRunner(output_timeout=output_timeout)
+    runner._kill_grace = 0.5
+    log_file = str(tmp_path / "run.log")
+
+    with pytest.raises(SimulationRunnerException) as error:
+        runner._run_command("sleep 30", log_file, "[A]", timeout=timeout)
+    runner.stop()
+
+    assert (
+        error.value.err_type is SimulationRunnerException.ExceptionType.Timeout
+    )
+    assert reason in error.value.message
+    with open(log_file) as f:
+        assert f.read().startswith("[A][WATCHDOG] {}".format(reason))
+
+
+def test_children_usage(tmp_path):
+    runner = AsyncRunner()
+    runner._metrics = RunMetrics("run")
+    log_file = str(tmp_path / "run.log")
+
+    for name, code in [("large", '"x"*268435456'), ("small", "pass")]:
+        with runner._metrics.stage(name):
+            runner._run_command(
+                "{} -c {}".format(sys.executable, code), log_file, "[A]"
+            )
+    runner.stop()
+
+    large, small = runner._metrics.stages
+    assert large["children_max_rss"] >= 2 ** 28
+    assert 0 < small["children_max_rss"] < 2 ** 27
+    assert large["children_cpu_time"] > 0
+
+
+def test_loop_closed_on_failure(tmp_path, configuration, monkeypatch):
+    runner = SimulationRunner({"backend": "dry_run"})
+    unloaded = []
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("simulation failed")
+
+    monkeypatch.setattr(runner, "simulate_diffusion_mri", fail)
+    monkeypatch.setattr(
+        "simulator.runner.datastore.Datastore.unload",
+        lambda datastore: unloaded.append(datastore),
+    )
+    geometry_infos, simulation_infos = configuration
+    with pytest.raises(RuntimeError):
+        runner.run(
+            "run",
+            geometry_infos,
+            simulation_infos,
+            str(tmp_path),
+            inter_axonal_fraction=INTER_AXONAL_FRACTION,
+        )
+
+    assert runner._event_loop.is_closed()
+    assert len(unloaded) == 1
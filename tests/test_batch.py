@@ -0,0 +1,145 @@
+from os import path
+
+import pytest
+
+from simulator.exceptions import SimulationRunnerException
+from simulator.runner import SimulationRunner
+from simulator.runner.batch import BatchExecutor, BatchJob
+from simulator.runner.cpu import CPUBudget
+from tests.conftest import INTER_AXONAL_FRACTION
+
+
+class _EchoRunner:
+    """Runner returning its arguments, failing the runs named fail"""
+
+    retry_policy = None
+    cpu_budget = None
+    last_metrics = None
+
+    def __init__(self, executed=None):
+        self.executed = executed
+
+    def run(
+        self, run_name, phantom_infos, simulation_infos, output_folder, **kwargs
+    ):
+        if self.executed is not None:
+            self.executed.append(run_name)
+        if run_name == "fail":
+            raise SimulationRunnerException(
+                "failed", SimulationRunnerException.ExceptionType.Parameters
+            )
+        threads = self.cpu_budget.threads if self.cpu_budget else None
+        return run_name, output_folder, threads, kwargs
+
+
+class _SizeModel:
+    """Runtime model estimating the jobs from their size argument"""
+
+    def __init__(self):
+        self.updates = []
+
+    def get_job_features(self, job):
+        return job.run_kwargs["size"]
+
+    def estimate(self, features):
+        return features
+
+    def update(self, features, runtime):
+        self.updates.append(features)
+
+
+def _get_jobs(names):
+    return [
+        BatchJob(name, {}, {}, "/{}".format(name), size=i)
+        for i, name in enumerate(names)
+    ]
+
+
+def test_from_any():
+    job = BatchJob("run", {"g": 1}, {"s": 1}, "output", size=1)
+
+    assert BatchJob.from_any(job) is job
+    for description in [
+        ("run", {"g": 1}, {"s": 1}, "output"),
+        {
+            "run_name": "run",
+            "phantom_infos": {"g": 1},
+            "simulation_infos": {"s": 1},
+            "output_folder": "output",
+            "size": 1,
+        },
+    ]:
+        converted = BatchJob.from_any(description)
+        assert converted.get_arguments() == job.get_arguments()
+    assert converted.run_kwargs == {"size": 1}
+
+
+@pytest.mark.parametrize("use_processes", [False, True])
+def test_map(use_processes):
+    jobs = _get_jobs(["first", "fail", "third"])
+    executor = BatchExecutor(_EchoRunner(), 2, use_processes, CPUBudget(4))
+
+    results = list(executor.map(jobs))
+
+    assert [r.index for r in results] == [0, 1, 2]
+    assert [r.succeeded for r in results] == [True, False, True]
+    assert results[0].get() == ("first", "/first", 2, {"size": 0})
+    assert results[1].error_type == "Parameters"
+    with pytest.raises(SimulationRunnerException):
+        results[1].get()
+    summary = results[1].to_dict()
+    assert (summary["run_name"], summary["succeeded"]) == ("fail", False)
+    assert summary["metrics"]["run_time"] >= 0
+
+
+def test_map_unordered():
+    jobs = _get_jobs(["first", "second", "third"])
+
+    results = list(BatchExecutor(_EchoRunner(), 2, False).map(jobs, False))
+
+    assert sorted(r.index for r in results) == [0, 1, 2]
+
+
+def test_map_longest_first():
+    executed, model = [], _SizeModel()
+    jobs = _get_jobs(["small", "medium", "large", "fail"])
+    executor = BatchExecutor(
+        _EchoRunner(executed), 1, False, runtime_model=model
+    )
+
+    results = list(executor.map(jobs))
+
+    assert executed == ["fail", "large", "medium", "small"]
+    assert [r.job.run_name for r in results] == [
+        "small",
+        "medium",
+        "large",
+        "fail",
+    ]
+    assert sorted(model.updates) == [0, 1, 2]
+
+
+def test_run_batch(tmp_path, configuration):
+    geometry_infos, simulation_infos = configuration
+    jobs = [
+        BatchJob(
+            name,
+            geometry_infos,
+            infos,
+            str(tmp_path / name),
+            inter_axonal_fraction=INTER_AXONAL_FRACTION,
+        )
+        for name, infos in [
+            ("first", simulation_infos),
+            ("missing", {}),
+            ("third", simulation_infos),
+        ]
+    ]
+    runner = SimulationRunner({"backend": "dry_run"})
+
+    results = list(runner.run_batch(jobs, max_workers=2))
+
+    assert [r.succeeded for r in results] == [True, False, True]
+    for result in results[::2]:
+        assert path.exists(result.get())
+        assert result.get().startswith(result.job.output_folder)
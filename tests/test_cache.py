@@ -0,0 +1,82 @@
+from os import listdir, remove
+import time
+
+import pytest
+
+from simulator.runner.cache import PhantomCache, materialize
+
+
+def _write_phantom(folder, prefix, content):
+    folder.mkdir(parents=True, exist_ok=True)
+    for suffix in ["_mergedBundlesMaps.nii.gz", "_mergedEllipsesMaps.nii.gz"]:
+        (folder / (prefix + suffix)).write_bytes(content + suffix.encode())
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return PhantomCache(str(tmp_path / "cache"))
+
+
+def test_materialize(tmp_path):
+    source = tmp_path / "source"
+    source.write_bytes(b"phantom")
+    destination = tmp_path / "destination"
+    destination.write_bytes(b"previous")
+
+    assert materialize(str(source), str(destination))
+    assert destination.read_bytes() == b"phantom"
+    assert destination.stat().st_ino == source.stat().st_ino
+
+
+def test_materialize_in_place(tmp_path):
+    source = tmp_path / "source"
+    source.write_bytes(b"phantom")
+    (tmp_path / "link").symlink_to(source)
+
+    assert materialize(str(source), str(source))
+    assert materialize(str(source), str(tmp_path / "link"))
+    assert source.read_bytes() == b"phantom"
+
+
+def test_store_and_fetch(tmp_path, cache):
+    _write_phantom(tmp_path / "run", "run_phantom", b"maps")
+    cache.store("key", str(tmp_path / "run"), "run_phantom")
+
+    assert not cache.fetch("other", str(tmp_path / "other"), "other_phantom")
+    (tmp_path / "other").mkdir()
+    assert cache.fetch("key", str(tmp_path / "other"), "other_phantom")
+
+    assert sorted(listdir(str(tmp_path / "other"))) == [
+        "other_phantom_mergedBundlesMaps.nii.gz",
+        "other_phantom_mergedEllipsesMaps.nii.gz",
+    ]
+    assert (
+        tmp_path / "other" / "other_phantom_mergedBundlesMaps.nii.gz"
+    ).read_bytes() == b"maps_mergedBundlesMaps.nii.gz"
+    stats = cache.stats()
+    assert (stats["entries"], stats["hits"], stats["misses"]) == (1, 1, 1)
+
+
+def test_fetch_missing_files(tmp_path, cache):
+    _write_phantom(tmp_path / "run", "run_phantom", b"maps")
+    cache.store("key", str(tmp_path / "run"), "run_phantom")
+    remove(str(tmp_path / "cache" / "key" / "_mergedEllipsesMaps.nii.gz"))
+    (tmp_path / "other").mkdir()
+
+    assert not cache.fetch("key", str(tmp_path / "other"), "other_phantom")
+
+    assert listdir(str(tmp_path / "other")) == []
+    assert cache.stats()["entries"] == 0
+
+
+def test_eviction(tmp_path):
+    cache = PhantomCache(str(tmp_path / "cache"), max_size=100)
+    for key in ["first", "second"]:
+        _write_phantom(tmp_path / key, key, b"x" * 30)
+        cache.store(key, str(tmp_path / key), key)
+        time.sleep(0.01)
+
+    stats = cache.stats()
+    assert (stats["entries"], stats["evictions"]) == (1, 1)
+    assert not cache.fetch("first", str(tmp_path / "first"), "first")
+    assert cache.fetch("second", str(tmp_path / "second"), "second")
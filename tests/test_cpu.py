@@ -0,0 +1,85 @@
+from os import sched_getaffinity
+
+import pytest
+
+from simulator.runner.cpu import THREAD_VARIABLES, CPUBudget, parse_cpu_list
+from simulator.runner.simulation_runner import AsyncRunner
+
+
+@pytest.fixture
+def two_nodes(monkeypatch):
+    monkeypatch.setattr(
+        "simulator.runner.cpu.get_numa_nodes",
+        lambda: [[0, 1, 2, 3], [4, 5, 6, 7]],
+    )
+
+
+def test_parse_cpu_list():
+    assert parse_cpu_list("0-3,8,10-11\n") == [0, 1, 2, 3, 8, 10, 11]
+    assert parse_cpu_list("5,1") == [1, 5]
+    assert parse_cpu_list("") == []
+
+
+def test_split():
+    assert [b.threads for b in CPUBudget(8).split(3)] == [2, 2, 2]
+    assert [b.threads for b in CPUBudget(2).split(4)] == [1, 1, 1, 1]
+    assert all(b.cpus is None for b in CPUBudget(8).split(3))
+
+
+def test_split_pinned(two_nodes):
+    budget = CPUBudget(8, range(8))
+
+    assert [b.cpus for b in budget.split(2)] == [[0, 1, 2, 3], [4, 5, 6, 7]]
+    assert [b.cpus for b in budget.split(4)] == [
+        [0, 1],
+        [2, 3],
+        [4, 5],
+        [6, 7],
+    ]
+    slots = budget.split(3)
+    assert sorted(len(b.cpus) for b in slots) == [2, 2, 4]
+    assert all(set(b.cpus) <= {0, 1, 2, 3} or min(b.cpus) >= 4 for b in slots)
+    assert [b.cpus for b in budget.split(10)][7:] == [[7], [0], [1]]
+
+
+def test_split_pinned_outside_nodes(two_nodes):
+    slots = CPUBudget(4, [2, 3, 8, 9]).split(2)
+
+    assert [b.cpus for b in slots] == [[2, 3], [8, 9]]
+    assert [b.threads for b in slots] == [2, 2]
+
+
+def test_get_environment():
+    environment = CPUBudget(3).get_environment()
+
+    assert set(environment) == set(THREAD_VARIABLES)
+    assert set(environment.values()) == {"3"}
+
+
+def test_commands_budget(tmp_path):
+    log_file = str(tmp_path / "run.log")
+    runner = AsyncRunner(cpu_budget=CPUBudget(4))
+    runner._run_commands(
+        [
+            ("printenv OMP_NUM_THREADS", log_file, "[A]"),
+            ("printenv MKL_NUM_THREADS", log_file, "[B]"),
+        ],
+        max_concurrent=2,
+    )
+    runner.stop()
+
+    with open(log_file) as f:
+        assert sorted(f.read().splitlines()) == ["[A][STD] 2", "[B][STD] 2"]
+
+
+def test_commands_pinned(tmp_path):
+    cpu = min(sched_getaffinity(0))
+    log_file = str(tmp_path / "run.log")
+    runner = AsyncRunner(cpu_budget=CPUBudget(1, [cpu]))
+    runner._run_command(
+        "grep Cpus_allowed_list /proc/self/status", log_file, "[A]"
+    )
+    runner.stop()
+
+    with open(log_file) as f:
+        assert f.read().split() == ["[A][STD]", "Cpus_allowed_list:", str(cpu)]
@@ -0,0 +1,165 @@
+from os import path
+import shutil
+
+import numpy as np
+import pytest
+
+from simulator.runner.datastore import Datastore
+from tests.conftest import INTER_AXONAL_FRACTION
+from tests.helpers import load_image, save_image
+
+
+StagingMode = Datastore.StagingMode
+
+
+def _phantom_maps(output_folder, use_nifti):
+    extension = "nii.gz" if use_nifti else "nrrd"
+    return [
+        path.join(
+            output_folder,
+            "phantom",
+            "run_phantom_merged{}Maps.{}".format(maps, extension),
+        )
+        for maps in ["Bundles", "Ellipses"]
+    ]
+
+
+@pytest.mark.parametrize(
+    "mode",
+    [
+        StagingMode.COPY,
+        StagingMode.HARDLINK,
+        StagingMode.SYMLINK,
+        StagingMode.AUTO,
+    ],
+)
+def test_stage_file(tmp_path, mode):
+    source = tmp_path / "source.nii.gz"
+    source.write_bytes(b"fraction map")
+    destination = tmp_path / "staged.nii.gz"
+    destination.write_bytes(b"previous map")
+
+    used = Datastore.stage_file(str(source), str(destination), mode)
+
+    assert destination.read_bytes() == b"fraction map"
+    if mode is StagingMode.AUTO:
+        assert used is StagingMode.HARDLINK
+    else:
+        assert used is mode
+    assert destination.is_symlink() == (used is StagingMode.SYMLINK)
+    assert path.samefile(source, destination) == (used is not StagingMode.COPY)
+
+
+@pytest.mark.parametrize("mode", [StagingMode.COPY, StagingMode.SYMLINK])
+def test_stage_compartments(tmp_path, dry_run, mode):
+    output_folder, use_nifti, _ = dry_run
+    fibers, ellipses = _phantom_maps(output_folder, use_nifti)
+    datastore = Datastore(str(tmp_path), "fibers.fib", ["1", "3"], None, mode)
+    datastore.add_compartment(fibers)
+    datastore.add_compartment(ellipses)
+
+    stats = datastore.stage_compartments("staged")
+
+    staged = datastore.get_staged_paths("staged")
+    for source, destination in zip([fibers, ellipses], staged):
+        assert path.islink(destination) == (mode is StagingMode.SYMLINK)
+        assert np.array_equal(load_image(destination), load_image(source))
+    size = path.getsize(fibers) + path.getsize(ellipses)
+    assert stats[mode.value] == size
+    assert datastore.get_saved_bytes() == (
+        size if mode is StagingMode.SYMLINK else 0
+    )
+    assert datastore.get_bind_paths(False)[1:] == (
+        [fibers, ellipses] if mode is StagingMode.SYMLINK else []
+    )
+
+
+@pytest.mark.parametrize("chunk_size", [2 ** 26, 1000], ids=["whole", "slabs"])
+def test_load_compartments(tmp_path, dry_run, chunk_size):
+    output_folder, use_nifti, _ = dry_run
+    fibers, ellipses = [
+        load_image(m) for m in _phantom_maps(output_folder, use_nifti)
+    ]
+    datastore = Datastore(
+        str(tmp_path),
+        "fibers.fib",
+        ["1", "2", "3", "4"],
+        INTER_AXONAL_FRACTION,
+        chunk_size=chunk_size,
+    )
+
+    datastore.load_compartments(
+        path.join(output_folder, "phantom"), "run", use_nifti, "staged"
+    )
+
+    assert datastore.compartments[:2] + datastore.compartments[3:] == [
+        datastore.get_staged_path(
+            "staged", cmp_id, "nii.gz" if use_nifti else "nrrd"
+        )
+        for cmp_id in ["1", "2", "4"]
+    ]
+    intra, inter, extra_1, extra_2 = [
+        load_image(c) for c in datastore.compartments
+    ]
+    assert intra.dtype == np.float32
+    np.testing.assert_allclose(
+        intra, fibers * (1 - INTER_AXONAL_FRACTION), rtol=1e-6
+    )
+    np.testing.assert_allclose(inter, fibers * INTER_AXONAL_FRACTION, rtol=1e-6)
+    np.testing.assert_array_equal(extra_1, ellipses)
+    np.testing.assert_allclose(
+        extra_2, np.clip(1 - fibers - ellipses, 0, None), atol=1e-6
+    )
+
+
+def test_generate_extra_axonal_fraction(tmp_path, dry_run):
+    output_folder, use_nifti, _ = dry_run
+    phantom_folder = tmp_path / "phantom"
+    phantom_folder.mkdir()
+    fibers = _phantom_maps(output_folder, use_nifti)[0]
+    shutil.copy(fibers, str(phantom_folder))
+    datastore = Datastore(
+        str(tmp_path), "fibers.fib", ["1", "3"], chunk_size=1000
+    )
+
+    datastore.load_compartments(str(phantom_folder), "run", use_nifti)
+
+    extra = load_image(datastore.compartments[1])
+    np.testing.assert_allclose(extra, 1 - load_image(fibers), atol=1e-6)
+
+
+def test_extra_axonal_fraction_clipped(tmp_path, caplog):
+    rng = np.random.default_rng(0)
+    fibers, ellipses = rng.uniform(0, 0.8, (2, 6, 5, 4)).astype("f4")
+    datastore = Datastore(
+        str(tmp_path), "fibers.fib", ["1", "3", "4"], chunk_size=100
+    )
+    for name, fraction in [("fibers", fibers), ("ellipses", ellipses)]:
+        datastore.add_compartment(
+            save_image(fraction, str(tmp_path / (name + ".nii.gz")))
+        )
+    datastore.add_compartment("generate")
+
+    datastore.generate_extra_axonal_fraction("run")
+
+    extra = load_image(datastore.compartments[2])
+    np.testing.assert_allclose(
+        extra, np.clip(1 - fibers - ellipses, 0, None), atol=1e-6
+    )
+    n_clipped = np.count_nonzero(fibers + ellipses > 1)
+    assert n_clipped > 0
+    assert "sum over 1 in {} voxels".format(n_clipped) in caplog.text
+
+
+def test_load_unit_fractions(tmp_path, dry_run):
+    output_folder, use_nifti, _ = dry_run
+    fibers = load_image(_phantom_maps(output_folder, use_nifti)[0])
+    datastore = Datastore(str(tmp_path), "fibers.fib", ["1", "2", "3"])
+
+    datastore.load_unit_fractions(
+        path.join(output_folder, "phantom"), "run", "2", use_nifti
+    )
+
+    for cmp_id, fraction in zip(datastore.ids, datastore.compartments):
+        expected = np.full(fibers.shape, 1 if cmp_id == "2" else 0)
+        np.testing.assert_array_equal(load_image(fraction), expected)
@@ -0,0 +1,121 @@
+from os import path
+import pickle
+
+import pytest
+
+from simulator.exceptions import SimulationRunnerException
+from simulator.runner import SimulationRunner
+from simulator.runner.instances import InstancePool
+from simulator.utils.test_helpers import StubTools
+from tests.conftest import INTER_AXONAL_FRACTION, N_VOLUMES
+from tests.helpers import load_image
+
+
+@pytest.fixture
+def stubs(tmp_path):
+    return StubTools(str(tmp_path / "stubs")).install()
+
+
+def _get_running(stubs):
+    state_file = path.join(stubs.folder, "instances")
+    if not path.exists(state_file):
+        return []
+    with open(state_file) as f:
+        return f.read().split()
+
+
+def test_pool(tmp_path, stubs):
+    pool = InstancePool(
+        stubs.singularity_exec, stubs.image, [str(tmp_path)], 2, "pool"
+    )
+    assert pool.instances == []
+
+    commands = [pool.get_command("launch_mitk", "-o out") for _ in range(3)]
+
+    assert pool.instances == ["pool_0", "pool_1"]
+    assert _get_running(stubs) == pool.instances
+    assert [c.split()[4] for c in commands] == [
+        "instance://pool_0",
+        "instance://pool_1",
+        "instance://pool_0",
+    ]
+    assert commands[0].endswith("/scif/apps/launch_mitk/scif/runscript -o out")
+
+    pool.stop()
+    assert pool.instances == []
+    assert _get_running(stubs) == []
+
+
+def test_covers(tmp_path, stubs):
+    pool = InstancePool(
+        stubs.singularity_exec, stubs.image, [str(tmp_path / "data")]
+    )
+
+    assert pool.covers([str(tmp_path / "data"), str(tmp_path / "data/a/b")])
+    assert pool.covers([None, str(tmp_path / "data" / "a")])
+    assert not pool.covers([str(tmp_path / "data_other")])
+    assert not pool.covers([str(tmp_path / "data" / "a"), str(tmp_path)])
+
+
+def test_copies(tmp_path, stubs):
+    pool = InstancePool(stubs.singularity_exec, stubs.image, [str(tmp_path)])
+    copy = pickle.loads(pickle.dumps(pool))
+    copy._owner = -1
+
+    assert not copy.covers([str(tmp_path)])
+    copy.start()
+    assert _get_running(stubs) == []
+
+    pool.start()
+    copy = pickle.loads(pickle.dumps(pool))
+    copy._owner = -1
+    assert copy.covers([str(tmp_path)])
+    copy.stop()
+    assert _get_running(stubs) == ["simulator_{}_0".format(pool._owner)]
+    pool.stop()
+
+
+def test_start_failure(tmp_path, stubs):
+    running = InstancePool(
+        stubs.singularity_exec, stubs.image, [str(tmp_path)], 1, "pool"
+    )
+    running.start()
+    pool = InstancePool(
+        stubs.singularity_exec, stubs.image, [str(tmp_path)], 2, "pool"
+    )
+
+    with pytest.raises(SimulationRunnerException) as error:
+        pool.start()
+
+    assert "pool_0" in str(error.value)
+    assert pool.instances == []
+    assert _get_running(stubs) == ["pool_0"]
+    running.stop()
+
+
+def test_run_in_instances(tmp_path, stubs, configuration):
+    geometry_infos, simulation_infos = configuration
+    bind_roots = [
+        str(tmp_path),
+        geometry_infos["file_path"],
+        simulation_infos["file_path"],
+    ]
+    config = dict(
+        stubs.get_config("singularity"),
+        instance_pool={"bind_roots": bind_roots, "size": 2},
+    )
+    runner = SimulationRunner(config)
+    pool = runner._backend.instance_pool
+
+    image = runner.run(
+        "run",
+        *configuration,
+        str(tmp_path / "run"),
+        inter_axonal_fraction=INTER_AXONAL_FRACTION
+    )
+
+    assert load_image(image).shape[-1] == N_VOLUMES
+    assert len(pool.instances) == 2
+    assert _get_running(stubs) == pool.instances
+    runner._backend.stop()
+    assert _get_running(stubs) == []
@@ -0,0 +1,61 @@
+from os import listdir
+from subprocess import PIPE, Popen
+
+from simulator.utils.logging import LogPump, RTLogging
+
+
+def _open_fds():
+    return len(listdir("/proc/self/fd"))
+
+
+def _start(command):
+    return Popen(command, shell=True, stdout=PIPE, stderr=PIPE)
+
+
+def test_pump(tmp_path):
+    log_file = str(tmp_path / "run.log")
+    pump = LogPump()
+    loggers = [
+        RTLogging(
+            _start("echo out{0}; echo err{0} >&2".format(i)),
+            log_file,
+            "[{}]".format(i),
+            pump=pump,
+        )
+        for i in range(3)
+    ]
+
+    for logger in loggers:
+        logger.start()
+    assert all(logger.join(10) for logger in loggers)
+
+    with open(log_file) as f:
+        assert sorted(f.read().splitlines()) == sorted(
+            "[{0}][{1}] {2}{0}".format(i, stream, output)
+            for i in range(3)
+            for stream, output in [("STD", "out"), ("ERR", "err")]
+        )
+
+
+def test_failing_callback(tmp_path):
+    log_file = str(tmp_path / "run.log")
+    pump, lines = LogPump(), []
+
+    def fail(tag, stream_tag, line):
+        raise RuntimeError(line)
+
+    first = pump.add(_start("echo first"), log_file, "[A]", fail)
+    assert first.wait(10)
+    fds = _open_fds()
+    second = pump.add(
+        _start("echo second"),
+        log_file,
+        "[B]",
+        lambda *line: lines.append(line),
+    )
+
+    assert second.wait(10)
+    assert lines == [("[B]", "STD", "second")]
+    assert _open_fds() == fds
+    with open(log_file) as f:
+        assert f.read().splitlines() == ["[A][STD] first", "[B][STD] second"]
@@ -0,0 +1,89 @@
+from os import utime
+
+import pytest
+
+from simulator.runner.manifest import Manifest
+
+
+Stage = Manifest.Stage
+
+
+@pytest.fixture
+def output(tmp_path):
+    output = tmp_path / "phantom.nii.gz"
+    output.write_bytes(b"phantom")
+    return output
+
+
+def _rewrite(output, content):
+    mtime = output.stat().st_mtime_ns
+    output.write_bytes(content)
+    utime(str(output), ns=(mtime, mtime))
+
+
+def test_record(tmp_path, output):
+    manifest = Manifest(str(tmp_path / "manifest.json"))
+    manifest.record("run", Stage.PHANTOM, "key", [str(output)])
+
+    assert manifest.is_complete("run", Stage.PHANTOM, "key")
+    assert not manifest.is_complete("run", Stage.PHANTOM, "other")
+    assert not manifest.is_complete("other", Stage.PHANTOM, "key")
+    assert not manifest.is_complete("run", Stage.STAGING, "key")
+
+    output.write_bytes(b"phantom generated again")
+    assert not manifest.is_complete("run", Stage.PHANTOM, "key")
+
+
+def test_record_without_checksums(tmp_path, output, monkeypatch):
+    manifest = Manifest(str(tmp_path / "manifest.json"))
+    monkeypatch.setattr(
+        "simulator.runner.manifest.hash_file",
+        lambda _: pytest.fail("outputs hashed without verify_checksums"),
+    )
+
+    manifest.record("run", Stage.PHANTOM, "key", [str(output)])
+
+    assert manifest.is_complete("run", Stage.PHANTOM, "key")
+    # Same size and modification time, hence considered unchanged
+    _rewrite(output, b"PHANTOM")
+    assert manifest.is_complete("run", Stage.PHANTOM, "key")
+
+
+def test_verify_checksums(tmp_path, output):
+    manifest = Manifest(str(tmp_path / "manifest.json"), True)
+    manifest.record("run", Stage.PHANTOM, "key", [str(output)])
+
+    assert manifest.is_complete("run", Stage.PHANTOM, "key")
+    _rewrite(output, b"PHANTOM")
+    assert not manifest.is_complete("run", Stage.PHANTOM, "key")
+
+
+def test_verify_checksums_of_records_without(tmp_path, output):
+    Manifest(str(tmp_path / "manifest.json")).record(
+        "run", Stage.PHANTOM, "key", [str(output)]
+    )
+    manifest = Manifest(str(tmp_path / "manifest.json"), True)
+
+    assert manifest.is_complete("run", Stage.PHANTOM, "key")
+    output.write_bytes(b"phantom generated again")
+    assert not manifest.is_complete("run", Stage.PHANTOM, "key")
+
+
+def test_get_last_complete(tmp_path, output, configuration):
+    geometry_infos, simulation_infos = configuration
+    keys = Manifest.get_stage_keys(
+        geometry_infos, simulation_infos, str(tmp_path)
+    )
+    manifest = Manifest(str(tmp_path / "manifest.json"))
+    assert manifest.get_last_complete("run", keys) is None
+
+    for stage in [Stage.GEOMETRY, Stage.PHANTOM]:
+        manifest.record("run", stage, keys[stage], [str(output)])
+    assert manifest.get_last_complete("run", keys) is Stage.PHANTOM
+
+    other = Manifest.get_stage_keys(
+        geometry_infos, simulation_infos, str(tmp_path), output_nifti=False
+    )
+    assert other[Stage.GEOMETRY] == keys[Stage.GEOMETRY]
+    assert all(other[s] != keys[s] for s in list(Stage)[1:])
+    assert manifest.get_last_complete("run", other) is Stage.GEOMETRY
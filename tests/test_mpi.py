@@ -0,0 +1,131 @@
+import json
+from os import environ, path
+import pickle
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from simulator.runner import SimulationRunner
+from simulator.runner.batch import BatchJob, BatchResult
+from simulator.runner.scheduler import RuntimeModel
+from tests.conftest import INTER_AXONAL_FRACTION
+
+
+MPICampaign = pytest.importorskip("simulator.runner.mpi").MPICampaign
+
+
+def _get_jobs(configuration, folder, n_jobs):
+    return [
+        BatchJob(
+            "run{}".format(i),
+            *configuration,
+            str(folder / "run{}".format(i)),
+            inter_axonal_fraction=INTER_AXONAL_FRACTION
+        )
+        for i in range(n_jobs)
+    ]
+
+
+class _SizeModel:
+    """Model estimating the jobs from the size of their geometry"""
+
+    def get_features(self, geometry):
+        return geometry["size"]
+
+    def get_job_features(self, job):
+        return self.get_features(job.phantom_infos)
+
+    def estimate(self, features):
+        return features
+
+
+_CAMPAIGN_SCRIPT = """
+import json, pickle, sys
+from simulator.runner import SimulationRunner
+from simulator.runner.mpi import MPICampaign
+
+with open(sys.argv[1], "rb") as f:
+    jobs = pickle.load(f)
+results = MPICampaign(SimulationRunner({"backend": "dry_run"})).run(jobs)
+if results is not None:
+    with open(sys.argv[2], "w") as f:
+        json.dump([result.to_dict() for result in results], f)
+"""
+
+
+def test_order():
+    jobs = [BatchJob(str(i), {"size": i}, {}, "output") for i in [1, 3, 2]]
+    runner = SimulationRunner({"backend": "dry_run"})
+
+    for campaign in [
+        MPICampaign(runner, model=_SizeModel()),
+        MPICampaign(runner, runtime_model=_SizeModel()),
+    ]:
+        tasks = campaign._order(jobs)
+        assert [index for index, _ in tasks] == [1, 2, 0]
+        assert [job.run_name for _, job in tasks] == ["3", "2", "1"]
+
+
+def test_run_single_rank(tmp_path, configuration):
+    jobs = _get_jobs(configuration, tmp_path, 2)
+    jobs.append(BatchJob("missing", configuration[0], {}, str(tmp_path)))
+    runner = SimulationRunner({"backend": "dry_run"})
+
+    results = MPICampaign(runner).run(jobs)
+
+    assert runner.cpu_budget is not None
+    assert [r.job.run_name for r in results] == ["run0", "run1", "missing"]
+    assert [r.succeeded for r in results] == [True, True, False]
+    for result in results[:2]:
+        assert path.exists(result.get())
+        assert result.metrics["rank"] == 0
+        assert result.metrics["wall_time"] >= 0
+
+
+@pytest.mark.skipif(shutil.which("mpirun") is None, reason="needs mpirun")
+def test_run_ranks(tmp_path, configuration):
+    jobs_file, results_file = tmp_path / "jobs.pkl", tmp_path / "results.json"
+    script = tmp_path / "campaign.py"
+    script.write_text(_CAMPAIGN_SCRIPT)
+    with open(jobs_file, "wb") as f:
+        pickle.dump(_get_jobs(configuration, tmp_path, 4), f)
+    environment = dict(
+        environ,
+        OMPI_ALLOW_RUN_AS_ROOT="1",
+        OMPI_ALLOW_RUN_AS_ROOT_CONFIRM="1",
+        PYTHONPATH=path.dirname(path.dirname(path.abspath(__file__))),
+    )
+
+    subprocess.run(
+        ["mpirun", "-n", "3", "--oversubscribe", sys.executable]
+        + [str(script), str(jobs_file), str(results_file)],
+        env=environment,
+        check=True,
+        timeout=300,
+    )
+
+    with open(results_file) as f:
+        results = json.load(f)
+    assert [r["run_name"] for r in results] == ["run0", "run1", "run2", "run3"]
+    assert all(r["succeeded"] and path.exists(r["output"]) for r in results)
+    assert {r["metrics"]["rank"] for r in results} <= {1, 2}
+
+
+def test_learn_from_computed_runs(tmp_path, configuration):
+    model = RuntimeModel()
+    campaign = MPICampaign(
+        SimulationRunner({"backend": "dry_run"}), runtime_model=model
+    )
+    jobs = _get_jobs(configuration, tmp_path, 4)
+    tasks = campaign._order(jobs)
+
+    for index, markers in enumerate(
+        [{}, {"cache_hit": True}, {"reused": True}, {"resumed_stages": ["x"]}]
+    ):
+        result = BatchResult(index, jobs[index], "image")
+        result.metrics.update(run_time=100.0, **markers)
+        campaign._learn(result, tasks)
+
+    assert len(model._observations) == 1
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from simulator.signal import NoiseEngine, NoiseType, add_noise
+from tests.helpers import load_image, save_image
+
+
+@pytest.fixture(scope="module")
+def image(tmp_path_factory):
+    data = np.random.default_rng(0).uniform(50, 100, (6, 6, 4, 5))
+    return save_image(
+        data.astype("f4"),
+        str(tmp_path_factory.mktemp("noise") / "image.nii.gz"),
+    )
+
+
+def _generate(image, folder, noise_type=NoiseType.RICIAN, **kwargs):
+    realisations = NoiseEngine(image, **kwargs).generate(
+        noise_type, [1.0, 4.0], 2, str(folder)
+    )
+    return [load_image(r["path"]) for r in realisations]
+
+
+@pytest.mark.parametrize("noise_type", list(NoiseType))
+def test_seed_reproduces_realisations(image, tmp_path, noise_type):
+    first = _generate(image, tmp_path / "first", noise_type, seed=42)
+    second = _generate(
+        image,
+        tmp_path / "second",
+        noise_type,
+        seed=42,
+        max_workers=1,
+        chunk_bytes=1,
+    )
+
+    for a, b in zip(first, second):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_realisations_differ(image, tmp_path):
+    first = _generate(image, tmp_path / "first", seed=42)
+    other = _generate(image, tmp_path / "other", seed=43)
+
+    for i, a in enumerate(first):
+        assert not np.array_equal(a, other[i])
+        for b in first[i + 1 :]:
+            assert not np.array_equal(a, b)
+
+
+def test_rng_per_volume(image):
+    engine = NoiseEngine(image, seed=7)
+    draws = [
+        engine.get_rng(level, 1, volume).standard_normal(4)
+        for level, volume in [(0, 0), (0, 1), (1, 0), (0, 0)]
+    ]
+    np.testing.assert_array_equal(draws[0], draws[3])
+    assert not np.array_equal(draws[0], draws[1])
+    assert not np.array_equal(draws[0], draws[2])
+
+
+@pytest.mark.parametrize("noise_type", list(NoiseType))
+def test_add_noise_without_variance(noise_type):
+    signal = np.random.default_rng(1).uniform(1, 2, (4, 4, 3))
+    noisy = add_noise(signal, noise_type, 0.0, np.random.default_rng(2))
+    np.testing.assert_allclose(noisy, signal)
+
+
+def test_rician_noise_variance():
+    signal = np.zeros((64, 64, 16))
+    noisy = add_noise(signal, NoiseType.RICIAN, 4.0, np.random.default_rng(3))
+    # The magnitude of null signal follows a Rayleigh distribution
+    np.testing.assert_allclose(np.mean(noisy ** 2), 2 * 4.0, rtol=0.05)
@@ -0,0 +1,180 @@
+import numpy as np
+import pytest
+
+from simulator.factory import SimulationFactory
+from simulator.signal import (
+    PreviewEngine,
+    get_orientation_field,
+    load_gradient_table,
+    read_fibers,
+)
+from tests.helpers import load_image
+
+
+Type = SimulationFactory.CompartmentType
+_ECHO_TIME, _SCALE = 100, 4000
+_STREAMLINES = [
+    np.array([[0.0, 1.5, 1.5], [2.0, 1.5, 1.5], [4.0, 1.5, 1.5]]),
+    np.array([[2.5, 0.0, 3.5], [2.5, 4.0, 3.5]]),
+]
+
+
+def _format(values, binary, dtype):
+    if binary:
+        return np.asarray(values, dtype).tobytes() + b"\n"
+    return (" ".join(str(v) for v in np.ravel(values)) + "\n").encode()
+
+
+def _write_fibers(fibers_file, binary=False, offsets=False):
+    points = np.concatenate(_STREAMLINES)
+    sizes = [len(s) for s in _STREAMLINES]
+    lines = [
+        b"# vtk DataFile Version 3.0\n",
+        b"fibers\n",
+        b"BINARY\n" if binary else b"ASCII\n",
+        b"DATASET POLYDATA\n",
+        "POINTS {} float\n".format(len(points)).encode(),
+        _format(points, binary, ">f4"),
+    ]
+    if offsets:
+        lines += [
+            "LINES {} {}\n".format(len(sizes) + 1, len(points)).encode(),
+            b"OFFSETS vtktypeint64\n",
+            _format(np.cumsum([0] + sizes), binary, ">i8"),
+            b"CONNECTIVITY vtktypeint64\n",
+            _format(np.arange(len(points)), binary, ">i8"),
+        ]
+    else:
+        connectivity, start = [], 0
+        for size in sizes:
+            connectivity += [size] + list(range(start, start + size))
+            start += size
+        lines += [
+            "LINES {} {}\n".format(len(sizes), len(connectivity)).encode(),
+            _format(connectivity, binary, ">i4"),
+        ]
+
+    with open(fibers_file, "wb") as f:
+        f.write(b"".join(lines))
+    return fibers_file
+
+
+@pytest.fixture(params=["ascii", "binary", "ascii-offsets", "binary-offsets"])
+def fibers(request, tmp_path):
+    return _write_fibers(
+        str(tmp_path / "fibers.fib"),
+        request.param.startswith("binary"),
+        request.param.endswith("offsets"),
+    )
+
+
+@pytest.fixture
+def gradients():
+    directions = np.random.default_rng(0).normal(size=(8, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, None]
+    bvals = np.array([0.0] + [1000.0] * 4 + [2000.0] * 4)
+    return bvals, np.concatenate([np.zeros((1, 3)), directions])
+
+
+def test_read_fibers(fibers):
+    streamlines = read_fibers(fibers)
+
+    assert len(streamlines) == len(_STREAMLINES)
+    for streamline, expected in zip(streamlines, _STREAMLINES):
+        np.testing.assert_allclose(streamline, expected)
+
+
+def test_get_orientation_field(fibers):
+    orientations = get_orientation_field(fibers, (4, 4, 4), (1, 1, 1))
+
+    expected = np.zeros((4, 4, 4, 3))
+    expected[:, 1, 1] = [1, 0, 0]
+    expected[2, :, 3] = [0, 1, 0]
+    np.testing.assert_allclose(np.abs(orientations), expected, atol=1e-12)
+
+
+def _get_attenuation(compartment):
+    return _SCALE * np.exp(-_ECHO_TIME / compartment["t2"])
+
+
+def test_preview_ball(gradients):
+    bvals, bvecs = gradients
+    ball = SimulationFactory.generate_extra_ball_compartment(
+        3e-3, 4000, 2000, Type.EXTRA_AXONAL_1
+    )
+    engine = PreviewEngine([ball], bvals, bvecs, _ECHO_TIME, _SCALE)
+
+    signal = engine.simulate({ball["ID"]: 1.0}, np.zeros((2, 3, 4, 3)))
+
+    assert signal.shape == (2, 3, 4, len(bvals))
+    expected = _get_attenuation(ball) * np.exp(-bvals * ball["d"])
+    np.testing.assert_allclose(signal, np.broadcast_to(expected, signal.shape))
+
+
+def test_preview_stick(tmp_path, gradients):
+    bvals, bvecs = gradients
+    stick = SimulationFactory.generate_fiber_stick_compartment(
+        1.7e-3, 900, 80, Type.INTRA_AXONAL
+    )
+    ball = SimulationFactory.generate_extra_ball_compartment(
+        3e-3, 4000, 2000, Type.EXTRA_AXONAL_1
+    )
+    orientations = get_orientation_field(
+        _write_fibers(str(tmp_path / "fibers.fib")), (4, 4, 4), (1, 1, 1)
+    )
+    fractions = np.zeros((4, 4, 4))
+    fractions[:, 1, 1] = 0.6
+    engine = PreviewEngine(
+        [stick, ball], bvals, bvecs, _ECHO_TIME, _SCALE, chunk_bytes=2 ** 10
+    )
+
+    signal = engine.simulate(
+        {stick["ID"]: fractions, ball["ID"]: None}, orientations
+    )
+
+    ball_signal = _get_attenuation(ball) * np.exp(-bvals * ball["d"])
+    stick_signal = _get_attenuation(stick) * np.exp(
+        -bvals * stick["d"] * bvecs[:, 0] ** 2
+    )
+    np.testing.assert_allclose(
+        signal[:, 1, 1], np.tile(0.6 * stick_signal + 0.4 * ball_signal, (4, 1))
+    )
+    np.testing.assert_allclose(signal[1, 2, 2], ball_signal)
+
+
+@pytest.mark.parametrize("extension", ["nii.gz", "nrrd"])
+def test_preview_write(tmp_path, gradients, extension):
+    bvals, bvecs = gradients
+    ball = SimulationFactory.generate_extra_ball_compartment(
+        3e-3, 4000, 2000, Type.EXTRA_AXONAL_1
+    )
+    engine = PreviewEngine(
+        [ball], bvals, bvecs, _ECHO_TIME, _SCALE, chunk_bytes=2 ** 10
+    )
+    orientations = np.zeros((2, 3, 4, 3))
+    output = str(tmp_path / "preview.{}".format(extension))
+
+    assert engine.write({ball["ID"]: 0.5}, orientations, output) == output
+
+    np.testing.assert_allclose(
+        load_image(output),
+        engine.simulate({ball["ID"]: 0.5}, orientations),
+        rtol=1e-6,
+    )
+    loaded_bvals, loaded_bvecs = load_gradient_table(output)
+    np.testing.assert_allclose(loaded_bvals, bvals)
+    np.testing.assert_allclose(loaded_bvecs, bvecs, atol=1e-6)
+
+
+def test_preview_unsupported(gradients):
+    bvals, bvecs = gradients
+    ball = SimulationFactory.generate_extra_ball_compartment(
+        3e-3, 4000, 2000, Type.EXTRA_AXONAL_1
+    )
+
+    with pytest.raises(ValueError):
+        PreviewEngine([dict(ball, model="zeppelin")], bvals, bvecs, 100)
+    with pytest.raises(ValueError):
+        PreviewEngine([ball], bvals, bvecs, 100).simulate(
+            {"1": 1.0}, np.zeros((1, 1, 1, 3))
+        )
@@ -0,0 +1,65 @@
+from os import path
+
+import numpy as np
+
+from simulator.runner.reader import OutputReader, read_gradient_table
+from simulator.runner.volumes import get_extension
+from tests.conftest import N_VOLUMES
+from tests.helpers import load_image
+
+
+def test_gradient_table(dry_run):
+    output_folder, use_nifti, image = dry_run
+    stem = image[: -len(get_extension(image)) - 1]
+    bvals, bvecs = read_gradient_table(stem + ".ffp")
+
+    assert bvals.shape == (N_VOLUMES,) and bvecs.shape == (N_VOLUMES, 3)
+    assert bvals[0] == 0 and np.allclose(bvals[1:], 1000)
+    np.testing.assert_allclose(np.linalg.norm(bvecs[1:], axis=1), 1)
+    if use_nifti:
+        np.testing.assert_allclose(bvals, np.loadtxt(stem + ".bvals"))
+
+
+def test_from_run(dry_run):
+    output_folder, use_nifti, image = dry_run
+    reader = OutputReader.from_run(output_folder, "run", use_nifti)
+
+    assert path.samefile(reader.image.path, image)
+    assert reader.shape == load_image(image).shape
+    assert reader.n_volumes == N_VOLUMES
+    assert reader.shells == [0.0, 1000.0]
+
+
+def test_reads(dry_run):
+    output_folder, use_nifti, image = dry_run
+    reader = OutputReader.from_run(output_folder, "run", use_nifti)
+    data = load_image(image)
+
+    np.testing.assert_array_equal(reader.by_volume(3), data[..., 3])
+    np.testing.assert_array_equal(reader.by_volume([4, 1]), data[..., [4, 1]])
+    np.testing.assert_array_equal(reader.slab(2, 5), data[:, :, 2:5])
+    np.testing.assert_array_equal(
+        reader.slab(0, 3, [5, 0]), data[:, :, 0:3][..., [5, 0]]
+    )
+
+    shell, bvals, bvecs = reader.by_shell(1000)
+    np.testing.assert_array_equal(shell, data[..., 1:])
+    np.testing.assert_array_equal(bvals, reader.bvals[1:])
+    np.testing.assert_array_equal(bvecs, reader.bvecs[1:])
+    np.testing.assert_array_equal(reader.by_shell(0)[0], data[..., :1])
+
+
+def test_iter_chunks(dry_run):
+    output_folder, use_nifti, image = dry_run
+    reader = OutputReader.from_run(output_folder, "run", use_nifti)
+    data = load_image(image)
+    plane_bytes = data.shape[0] * data.shape[1] * 2 * data.itemsize
+
+    chunks = list(reader.iter_chunks(3 * plane_bytes, [2, 5]))
+
+    assert [(z0, z1) for z0, z1, _ in chunks] == [
+        (z, min(z + 3, data.shape[2])) for z in range(0, data.shape[2], 3)
+    ]
+    np.testing.assert_array_equal(
+        np.concatenate([c for _, _, c in chunks], axis=2), data[..., [2, 5]]
+    )
@@ -0,0 +1,160 @@
+import json
+from os import path
+
+import numpy as np
+import pytest
+
+from simulator.signal import (
+    CompartmentRecombiner,
+    get_phantom_fractions,
+    load_fractions,
+)
+from tests.conftest import INTER_AXONAL_FRACTION
+from tests.helpers import load_image, save_image
+
+
+_SHAPE = (6, 5, 4)
+
+
+@pytest.fixture
+def signals(tmp_path):
+    rng = np.random.default_rng(0)
+    return {
+        cmp_id: save_image(
+            rng.uniform(0, 100, _SHAPE + (7,)).astype("f4"),
+            str(tmp_path / "signal{}.nii.gz".format(cmp_id)),
+        )
+        for cmp_id in ["1", "2", "3"]
+    }
+
+
+@pytest.fixture
+def fraction_map(tmp_path):
+    fraction = np.random.default_rng(1).uniform(0, 0.6, _SHAPE)
+    return save_image(fraction.astype("f4"), str(tmp_path / "map.nii.gz"))
+
+
+def _weighted_sum(signals, weights):
+    return sum(
+        weights[cmp_id][..., None] * load_image(signal).astype(np.float64)
+        for cmp_id, signal in signals.items()
+        if cmp_id in weights
+    )
+
+
+def test_load_fractions(fraction_map):
+    fraction = load_image(fraction_map).astype(np.float64)
+
+    weights = load_fractions(
+        {
+            "1": (fraction_map, 0.5),
+            "2": 0.25,
+            "3": (None, 0.4),
+            "4": (None, 0.6),
+        },
+        _SHAPE,
+    )
+
+    np.testing.assert_allclose(weights["1"], 0.5 * fraction)
+    np.testing.assert_allclose(weights["2"], 0.25)
+    remainder = np.clip(0.75 - 0.5 * fraction, 0, None)
+    np.testing.assert_allclose(weights["3"], 0.4 * remainder)
+    np.testing.assert_allclose(weights["4"], 0.6 * remainder)
+
+
+def test_load_fractions_negative():
+    with pytest.raises(ValueError):
+        load_fractions({"1": -0.1}, _SHAPE)
+
+
+@pytest.mark.parametrize("chunk_bytes", [2 ** 26, 1], ids=["whole", "slabs"])
+def test_recombine(tmp_path, signals, fraction_map, chunk_bytes):
+    fraction = load_image(fraction_map).astype(np.float64)
+    recombiner = CompartmentRecombiner(signals, chunk_bytes)
+
+    output = recombiner.recombine(
+        {"1": fraction_map, "2": 0.25, "3": None},
+        str(tmp_path / "recombined.nii.gz"),
+    )
+
+    expected = _weighted_sum(
+        signals,
+        {
+            "1": fraction,
+            "2": np.full(_SHAPE, 0.25),
+            "3": np.clip(0.75 - fraction, 0, None),
+        },
+    )
+    np.testing.assert_allclose(load_image(output), expected, rtol=1e-5)
+
+
+def test_sweep(tmp_path, signals):
+    configurations = {
+        "f{:g}".format(f): {"1": f, "2": None} for f in [0.2, 0.5, 0.8]
+    }
+
+    outputs = CompartmentRecombiner(signals, 1).sweep(
+        configurations, str(tmp_path / "sweep")
+    )
+
+    assert list(outputs) == list(configurations)
+    for name, fractions in configurations.items():
+        expected = _weighted_sum(
+            signals,
+            {
+                "1": np.full(_SHAPE, fractions["1"]),
+                "2": np.full(_SHAPE, 1 - fractions["1"]),
+            },
+        )
+        np.testing.assert_allclose(
+            load_image(outputs[name]), expected, rtol=1e-5
+        )
+        with open(
+            path.join(str(tmp_path / "sweep"), name + "_fractions.json")
+        ) as f:
+            assert json.load(f)["fractions"] == fractions
+
+
+def test_recombine_unknown_compartment(tmp_path, signals):
+    with pytest.raises(ValueError):
+        CompartmentRecombiner(signals).recombine(
+            {"4": 1.0}, str(tmp_path / "recombined.nii.gz")
+        )
+
+
+def test_recombine_dry_run(tmp_path, configuration, runner):
+    geometry_infos, simulation_infos = configuration
+    signals = runner.simulate_compartment_signals(
+        "run", geometry_infos, simulation_infos, str(tmp_path)
+    )
+    phantom_folder = path.join(str(tmp_path), "phantom")
+    fractions = get_phantom_fractions(
+        phantom_folder,
+        "run",
+        list(signals),
+        inter_axonal_fraction=INTER_AXONAL_FRACTION,
+    )
+
+    recombiner = CompartmentRecombiner(signals)
+    output = recombiner.recombine(
+        fractions, str(tmp_path / "recombined.nii.gz")
+    )
+
+    assert recombiner.approximations == []
+    fibers, ellipses = [
+        load_image(
+            path.join(phantom_folder, "run_phantom_merged{}.nii.gz".format(m))
+        ).astype(np.float64)
+        for m in ["BundlesMaps", "EllipsesMaps"]
+    ]
+    expected = _weighted_sum(
+        signals,
+        {
+            "1": fibers * (1 - INTER_AXONAL_FRACTION),
+            "2": fibers * INTER_AXONAL_FRACTION,
+            "3": ellipses,
+            "4": np.clip(1 - fibers - ellipses, 0, None),
+        },
+    )
+    np.testing.assert_allclose(load_image(output), expected, rtol=1e-5)
+    assert path.exists(str(tmp_path / "recombined.bvals"))
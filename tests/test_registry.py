@@ -0,0 +1,216 @@
+import json
+from os import path, remove
+
+import numpy as np
+import pytest
+
+from scripts.run_registry import list_runs, show_run
+from simulator.runner import SimulationRunner
+from simulator.runner.registry import RunRegistry
+from tests.conftest import INTER_AXONAL_FRACTION, N_VOLUMES
+from tests.helpers import load_image
+
+
+@pytest.fixture
+def registry(tmp_path):
+    return RunRegistry(str(tmp_path / "registry" / "runs.db"))
+
+
+@pytest.fixture
+def description(configuration):
+    return RunRegistry.describe(
+        *configuration, inter_axonal_fraction=INTER_AXONAL_FRACTION
+    )
+
+
+def _write_outputs(output_folder, run_name):
+    files = []
+    for folder, suffix in [
+        ("phantom", "_phantom_mergedBundlesMaps.nii.gz"),
+        ("simulation", "_simulation.nii.gz"),
+    ]:
+        folder = output_folder / folder
+        folder.mkdir(parents=True, exist_ok=True)
+        output = folder / (run_name + suffix)
+        output.write_bytes(suffix.encode())
+        files.append(str(output))
+    return {"simulation": files[-1], "files": files}
+
+
+def _complete(registry, description, output_folder, run_name="run"):
+    key, parameters = description
+    run_id = registry.register(run_name, str(output_folder), key, parameters)
+    registry.complete(run_id, _write_outputs(output_folder, run_name))
+    return run_id
+
+
+def test_describe(configuration, description):
+    key, parameters = description
+
+    assert RunRegistry.describe(
+        *configuration, inter_axonal_fraction=INTER_AXONAL_FRACTION
+    ) == (key, parameters)
+    assert RunRegistry.describe(*configuration)[0] != key
+    assert RunRegistry.describe(*configuration, output_nifti=False)[0] != key
+    geometry_infos, _ = configuration
+    assert parameters["geometry"]["resolution"] == list(
+        geometry_infos["resolution"]
+    )
+    assert parameters["simulation"]["gradients"]["count"] == N_VOLUMES
+    assert len(parameters["simulation"]["compartments"]) == 4
+    assert parameters["options"]["inter_axonal_fraction"] == (
+        INTER_AXONAL_FRACTION
+    )
+
+
+def test_register(tmp_path, registry, description):
+    key, parameters = description
+    run_id = registry.register("run", str(tmp_path / "run"), key, parameters)
+
+    run = registry.get(run_id)
+    assert (run["run_name"], run["status"], run["key"]) == (
+        "run",
+        "running",
+        key,
+    )
+    assert run["output_folder"] == str(tmp_path / "run")
+    assert run["parameters"] == json.loads(json.dumps(parameters))
+
+    registry.fail(run_id, RuntimeError("failed"), {"stages": []})
+    run = registry.get(run_id)
+    assert (run["status"], run["error"]) == ("failed", "failed")
+    assert run["metrics"] == {"stages": []}
+    assert registry.get(run_id + 1) is None
+
+
+def test_query(tmp_path, registry, description):
+    first = _complete(registry, description, tmp_path / "first")
+    key, parameters = description
+    other = json.loads(json.dumps(parameters))
+    other["options"]["inter_axonal_fraction"] = 0.5
+    resolution = parameters["geometry"]["resolution"]
+    second = registry.register("other", str(tmp_path / "other"), "key", other)
+
+    assert [r["id"] for r in registry.query()] == [second, first]
+    assert [r["id"] for r in registry.query(limit=1)] == [second]
+    assert [r["id"] for r in registry.query(status="complete")] == [first]
+    assert [r["id"] for r in registry.query(run_name="other")] == [second]
+    assert [r["id"] for r in registry.query(key=key)] == [first]
+    assert [
+        r["id"] for r in registry.query({"options.inter_axonal_fraction": 0.5})
+    ] == [second]
+    assert [
+        r["id"]
+        for r in registry.query(
+            {
+                "geometry.resolution[0]": resolution[0],
+                "simulation.acquisition.tEcho": 100,
+            },
+            status="complete",
+        )
+    ] == [first]
+    with pytest.raises(ValueError):
+        registry.query(folder=str(tmp_path))
+
+
+def test_find_reusable(tmp_path, registry, description):
+    key, _ = description
+    assert registry.find_reusable(key) is None
+
+    run_id = _complete(registry, description, tmp_path / "run")
+    assert registry.find_reusable(key)["id"] == run_id
+    assert registry.find_reusable(key, str(tmp_path / "other"))["id"] == run_id
+    assert registry.find_reusable(key, str(tmp_path / "run")) is None
+    assert registry.find_reusable("other") is None
+
+    remove(registry.get(run_id)["outputs"]["simulation"])
+    assert registry.find_reusable(key) is None
+
+
+def test_reuse(tmp_path, registry, description):
+    run = registry.get(_complete(registry, description, tmp_path / "run"))
+
+    outputs = registry.reuse(run, "other", str(tmp_path / "other"))
+
+    assert outputs["simulation"] == str(
+        tmp_path / "other" / "simulation" / "other_simulation.nii.gz"
+    )
+    assert sorted(outputs["files"]) == sorted(
+        str(tmp_path / "other" / folder / name)
+        for folder, name in [
+            ("phantom", "other_phantom_mergedBundlesMaps.nii.gz"),
+            ("simulation", "other_simulation.nii.gz"),
+        ]
+    )
+    for source, destination in zip(run["outputs"]["files"], outputs["files"]):
+        with open(source, "rb") as s, open(destination, "rb") as d:
+            assert s.read() == d.read()
+
+
+def test_reuse_in_place(tmp_path, registry, description):
+    run = registry.get(_complete(registry, description, tmp_path / "run"))
+
+    outputs = registry.reuse(run, "run", str(tmp_path / "run"))
+
+    assert outputs == run["outputs"]
+    assert all(path.exists(f) for f in outputs["files"])
+
+
+def _run(runner, configuration, run_name, output_folder):
+    return runner.run(
+        run_name,
+        *configuration,
+        output_folder,
+        inter_axonal_fraction=INTER_AXONAL_FRACTION
+    )
+
+
+def _load_stages(output_folder, run_name):
+    metrics_file = path.join(output_folder, run_name + "_metrics.json")
+    with open(metrics_file) as f:
+        return [stage["name"] for stage in json.load(f)["stages"]]
+
+
+def test_rerun_and_reuse(tmp_path, configuration):
+    registry = str(tmp_path / "runs.db")
+    runner = SimulationRunner({"backend": "dry_run"}, registry=registry)
+    first = _run(runner, configuration, "run", str(tmp_path / "run"))
+    expected = load_image(first)
+
+    assert _run(runner, configuration, "run", str(tmp_path / "run")) == first
+    assert "reuse_run" not in _load_stages(str(tmp_path / "run"), "run")
+    np.testing.assert_array_equal(load_image(first), expected)
+
+    other = _run(runner, configuration, "other", str(tmp_path / "other"))
+    assert _load_stages(str(tmp_path / "other"), "other") == ["reuse_run"]
+    assert path.basename(other) == "other_simulation.nii.gz"
+    np.testing.assert_array_equal(load_image(other), expected)
+
+    runs = RunRegistry(registry).query(status="complete")
+    assert [r["run_name"] for r in runs] == ["other", "run", "run"]
+    assert runs[0]["reused_from"] == runs[1]["id"]
+
+
+def test_script(tmp_path, capsys, registry, description):
+    run_id = _complete(registry, description, tmp_path / "run")
+    registry.register("other", str(tmp_path / "other"), "key", description[1])
+
+    list_runs(registry, {"status": "complete", "param": []})
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 1
+    assert lines[0].split()[:3] == [str(run_id), "complete", "run"]
+
+    list_runs(
+        registry,
+        {"run_name": None, "param": ["simulation.acquisition.tEcho=100"]},
+        output_json=True,
+        limit=1,
+    )
+    assert [r["run_name"] for r in json.loads(capsys.readouterr().out)] == [
+        "other"
+    ]
+
+    show_run(registry, run_id)
+    assert json.loads(capsys.readouterr().out)["id"] == run_id
+    with pytest.raises(SystemExit):
+        show_run(registry, run_id + 2)
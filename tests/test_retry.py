@@ -0,0 +1,92 @@
+import pytest
+
+from simulator.exceptions import SimulationRunnerException
+from simulator.runner.batch import BatchJob, execute_job
+from simulator.runner.retry import RetryPolicy
+
+
+ExceptionType = SimulationRunnerException.ExceptionType
+
+
+class _FlakyRunner:
+    """Runner failing with the given errors before succeeding"""
+
+    def __init__(self, errors, retry_policy):
+        self.errors = list(errors)
+        self.retry_policy = retry_policy
+        self.last_metrics = None
+
+    def run(self, run_name, *args, **kwargs):
+        if self.errors:
+            raise self.errors.pop(0)
+        return run_name
+
+
+def _error(err_type):
+    return SimulationRunnerException("failed", err_type)
+
+
+def test_get_retries():
+    policy = RetryPolicy({ExceptionType.Timeout: 3, "Fiberfox": 1}, default=2)
+
+    assert policy.get_retries(_error(ExceptionType.Timeout)) == 3
+    assert policy.get_retries(_error(ExceptionType.Fiberfox)) == 1
+    assert policy.get_retries(_error(ExceptionType.Voxsim)) == 2
+    assert policy.get_retries(RuntimeError()) == 2
+    assert policy.get_retries(_error(ExceptionType.Parameters)) == 0
+
+    assert policy.should_retry(_error(ExceptionType.Fiberfox), 1)
+    assert not policy.should_retry(_error(ExceptionType.Fiberfox), 2)
+
+
+def test_from_config():
+    policy = RetryPolicy.from_config(
+        {"retries": {"Timeout": 2}, "delay": 1.5, "backoff": 3}
+    )
+
+    assert policy.retries == {ExceptionType.Timeout: 2}
+    assert (policy.default, policy.delay, policy.backoff) == (0, 1.5, 3)
+    with pytest.raises(KeyError):
+        RetryPolicy({"Unknown": 1})
+
+
+def test_wait(monkeypatch):
+    delays = []
+    monkeypatch.setattr("time.sleep", delays.append)
+
+    for attempt in range(1, 4):
+        RetryPolicy(delay=0.5, backoff=2).wait(attempt)
+    RetryPolicy().wait(1)
+
+    assert delays == [0.5, 1.0, 2.0]
+
+
+def test_execute_job_retries():
+    job = BatchJob("run", {}, {}, "output")
+    errors = [_error(ExceptionType.Timeout), RuntimeError("crashed")]
+
+    result = execute_job(
+        _FlakyRunner(errors, RetryPolicy({"Timeout": 2}, default=2)), 0, job
+    )
+
+    assert result.succeeded and result.get() == "run"
+    assert result.attempts == 3
+    assert [f["error_type"] for f in result.failures] == [
+        "Timeout",
+        "RuntimeError",
+    ]
+
+
+def test_execute_job_gives_up():
+    job = BatchJob("run", {}, {}, "output")
+    errors = [_error(ExceptionType.Timeout), _error(ExceptionType.Parameters)]
+
+    result = execute_job(_FlakyRunner(errors, RetryPolicy(default=5)), 0, job)
+
+    assert not result.succeeded
+    assert result.error_type == "Parameters"
+    assert result.attempts == 2
+    assert len(result.failures) == 1
+
+    result = execute_job(_FlakyRunner(errors[:1], None), 0, job)
+    assert (result.succeeded, result.attempts) == (False, 1)
@@ -0,0 +1,51 @@
+import time
+
+from simulator.runner.batch import BatchJob
+from simulator.runner.scheduler import MemoryScheduler
+
+
+class _SleepingRunner:
+    """Runner returning the interval during which its job ran"""
+
+    retry_policy = None
+    cpu_budget = None
+    last_metrics = None
+
+    def run(self, run_name, *args, **kwargs):
+        start = time.time()
+        time.sleep(0.5)
+        return start, time.time()
+
+
+class _SizeModel:
+    """Footprint model estimating the jobs from the size of their geometry"""
+
+    def __init__(self):
+        self.updates = []
+
+    def get_features(self, geometry):
+        return geometry["size"]
+
+    def estimate(self, features):
+        return features
+
+    def update(self, features, peak_memory):
+        self.updates.append(features)
+
+
+def _overlap(first, second):
+    return first[0] < second[1] and second[0] < first[1]
+
+
+def test_admission():
+    model = _SizeModel()
+    jobs = [BatchJob(str(s), {"size": s}, {}, "output") for s in [6, 6, 3, 20]]
+
+    results = list(MemoryScheduler(_SleepingRunner(), 10, 4, model).map(jobs))
+
+    assert all(result.succeeded for result in results)
+    intervals = [result.get() for result in results]
+    assert _overlap(intervals[0], intervals[2])
+    assert not _overlap(intervals[0], intervals[1])
+    assert not any(_overlap(intervals[3], i) for i in intervals[:3])
+    assert sorted(model.updates) == [3, 6, 6, 20]
@@ -0,0 +1,246 @@
+import json
+from os import listdir, path, remove
+
+import numpy as np
+
+from simulator.runner import SimulationRunner
+from simulator.runner.cache import PhantomCache
+from simulator.runner.scheduler import (
+    FootprintModel,
+    MemoryScheduler,
+    RuntimeModel,
+)
+from tests.conftest import INTER_AXONAL_FRACTION, N_SHARDS, N_VOLUMES
+from tests.helpers import load_image
+
+
+_STAGES = [
+    "generate_phantom",
+    "load_compartments",
+    "stage_compartments",
+    "simulate_diffusion_mri",
+]
+
+
+def _run(runner, configuration, output_folder, **kwargs):
+    geometry_infos, simulation_infos = configuration
+    return runner.run(
+        "run",
+        geometry_infos,
+        simulation_infos,
+        output_folder,
+        inter_axonal_fraction=INTER_AXONAL_FRACTION,
+        **kwargs
+    )
+
+
+def _load_metrics(output_folder):
+    with open(path.join(output_folder, "run_metrics.json")) as f:
+        return json.load(f)
+
+
+def _job(configuration, output_folder):
+    geometry_infos, simulation_infos = configuration
+    return {
+        "run_name": "run",
+        "phantom_infos": geometry_infos,
+        "simulation_infos": simulation_infos,
+        "output_folder": output_folder,
+        "inter_axonal_fraction": INTER_AXONAL_FRACTION,
+    }
+
+
+def test_run(dry_run, configuration):
+    output_folder, use_nifti, image = dry_run
+    extension = "nii.gz" if use_nifti else "nrrd"
+
+    assert image == path.join(
+        output_folder, "simulation", "run_simulation.{}".format(extension)
+    )
+    geometry_infos, _ = configuration
+    assert load_image(image).shape == tuple(geometry_infos["resolution"]) + (
+        N_VOLUMES,
+    )
+    for cmp_id in range(1, 5):
+        assert path.exists(
+            path.join(
+                output_folder,
+                "simulation",
+                "run_simulation.ffp_VOLUME{}.{}".format(cmp_id, extension),
+            )
+        )
+    assert path.exists(path.join(output_folder, "run.log"))
+
+    metrics = _load_metrics(output_folder)
+    assert [stage["name"] for stage in metrics["stages"]] == _STAGES
+    assert all(stage["status"] == "complete" for stage in metrics["stages"])
+    assert metrics["stages"][0]["cache_hit"] is False
+
+
+def test_phantom_cache(tmp_path, configuration):
+    cache = PhantomCache(str(tmp_path / "cache"))
+    runner = SimulationRunner({"backend": "dry_run"}, phantom_cache=cache)
+    first = _run(runner, configuration, str(tmp_path / "first"))
+    second = _run(runner, configuration, str(tmp_path / "second"))
+
+    np.testing.assert_array_equal(load_image(first), load_image(second))
+    stages = [
+        _load_metrics(str(tmp_path / name))["stages"][0]
+        for name in ["first", "second"]
+    ]
+    assert [stage["cache_hit"] for stage in stages] == [False, True]
+    assert cache.stats()["hits"] == 1
+
+    model = RuntimeModel()
+    jobs = [
+        _job(configuration, str(tmp_path / name))
+        for name in ["first", "second"]
+    ]
+    assert model.learn_from_metrics(jobs) == 1
+
+
+def _cached_jobs(tmp_path, configuration):
+    runner = SimulationRunner(
+        {"backend": "dry_run"},
+        phantom_cache=PhantomCache(str(tmp_path / "cache")),
+    )
+    jobs = [
+        _job(configuration, str(tmp_path / name))
+        for name in ["first", "second"]
+    ]
+    return runner, jobs
+
+
+def test_batch_learns_from_computed_runs(tmp_path, configuration):
+    runner, jobs = _cached_jobs(tmp_path, configuration)
+    model = RuntimeModel()
+
+    results = list(
+        runner.run_batch(
+            jobs,
+            max_workers=1,
+            processes=False,
+            cpu_budget=False,
+            runtime_model=model,
+        )
+    )
+
+    assert all(result.succeeded for result in results)
+    assert sorted(result.metrics["cache_hit"] for result in results) == [
+        False,
+        True,
+    ]
+    assert [result.computed for result in results].count(True) == 1
+    assert len(model._observations) == 1
+
+
+def test_scheduler_learns_from_computed_runs(tmp_path, configuration):
+    runner, jobs = _cached_jobs(tmp_path, configuration)
+    model, runtime_model, updates = FootprintModel(), RuntimeModel(), []
+    model.update = lambda features, peak_memory: updates.append(peak_memory)
+
+    results = list(
+        MemoryScheduler(
+            runner, 2 ** 40, 1, model, runtime_model=runtime_model
+        ).map(jobs)
+    )
+
+    assert all(result.succeeded for result in results)
+    assert len(updates) == 1
+    assert len(runtime_model._observations) == 1
+
+
+def test_resume(tmp_path, configuration, runner):
+    output_folder = str(tmp_path / "run")
+    manifest = str(tmp_path / "manifest.json")
+    image = _run(runner, configuration, output_folder, manifest=manifest)
+    remove(image)
+
+    assert _run(runner, configuration, output_folder, manifest=manifest) == (
+        image
+    )
+
+    metrics = _load_metrics(output_folder)
+    assert [stage["name"] for stage in metrics["stages"]] == _STAGES[-1:]
+    assert metrics["resumed_stages"] == ["geometry", "phantom", "staging"]
+    with open(path.join(output_folder, "run.log")) as f:
+        assert "[MANIFEST]" in f.read()
+    assert (
+        RuntimeModel().learn_from_metrics([_job(configuration, output_folder)])
+        == 0
+    )
+
+
+def test_sharded_run(tmp_path, configuration, sharded_configuration, runner):
+    reference = _run(runner, configuration, str(tmp_path / "reference"))
+    image = _run(runner, sharded_configuration, str(tmp_path / "sharded"))
+
+    np.testing.assert_array_equal(load_image(image), load_image(reference))
+    for table in ["bvals", "bvecs"]:
+        np.testing.assert_allclose(
+            np.loadtxt(image.replace("nii.gz", table)),
+            np.loadtxt(reference.replace("nii.gz", table)),
+        )
+    simulation_folder = path.join(str(tmp_path / "sharded"), "simulation")
+    assert sorted(f for f in listdir(simulation_folder) if "_shard" in f) == [
+        "run_shard{}_simulation.ffp".format(i) for i in range(N_SHARDS)
+    ]
+
+
+def test_sharded_simulations(
+    tmp_path, configuration, sharded_configuration, runner
+):
+    geometry_infos, simulation_infos = configuration
+    outputs = runner.run_simulations(
+        "run",
+        geometry_infos,
+        {
+            "reference": simulation_infos,
+            "sharded": sharded_configuration[1],
+        },
+        str(tmp_path),
+        inter_axonal_fraction=INTER_AXONAL_FRACTION,
+    )
+
+    np.testing.assert_array_equal(
+        load_image(outputs["sharded"]), load_image(outputs["reference"])
+    )
+    assert path.exists(
+        path.join(
+            str(tmp_path),
+            "sharded",
+            "simulation",
+            "sharded_shard0_simulation.ffp",
+        )
+    )
+
+
+def test_sharded_compartment_signals(
+    tmp_path, configuration, sharded_configuration, runner
+):
+    geometry_infos, simulation_infos = configuration
+    signals = [
+        runner.simulate_compartment_signals(
+            "run", geometry_infos, infos, str(tmp_path / name)
+        )
+        for name, infos in [
+            ("reference", simulation_infos),
+            ("sharded", sharded_configuration[1]),
+        ]
+    ]
+
+    assert list(signals[0]) == list(signals[1])
+    for cmp_id in signals[1]:
+        name = "run_compartment{}".format(cmp_id)
+        assert path.exists(
+            path.join(
+                str(tmp_path / "sharded"),
+                name,
+                "simulation",
+                "{}_shard0_simulation.ffp".format(name),
+            )
+        )
+    for cmp_id, reference in signals[0].items():
+        np.testing.assert_array_equal(
+            load_image(signals[1][cmp_id]), load_image(reference)
+        )
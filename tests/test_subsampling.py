@@ -0,0 +1,130 @@
+import numpy as np
+import pytest
+
+from simulator.signal import GradientSubsampler, load_gradient_table
+from simulator.signal.subsampling import (
+    get_gradient_keys,
+    save_gradient_table,
+)
+from tests.helpers import load_image, save_image
+
+
+Method = GradientSubsampler.Method
+_SHAPE = (4, 3, 2)
+_N_DENSE = 60
+# Small enough to split the scheme in many chunks and the image in slabs
+_CHUNK_BYTES = 5 * int(np.prod(_SHAPE)) * 8
+_SCHEME = [0, 5, 3, 17, 40, 58]
+
+
+def _get_gradients():
+    directions = np.random.default_rng(1).normal(size=(_N_DENSE, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, None]
+    bvals = np.array([0.0] + [1000.0] * _N_DENSE)
+    return bvals, np.concatenate([np.zeros((1, 3)), directions])
+
+
+def _get_signal(bvecs):
+    # Quadratic on the sphere, hence exactly fitted by spherical harmonics
+    rng = np.random.default_rng(2)
+    base, scale = rng.uniform(1, 2, _SHAPE), rng.uniform(0, 1, _SHAPE)
+    axes = rng.normal(size=_SHAPE + (3,))
+    axes /= np.linalg.norm(axes, axis=-1, keepdims=True)
+    signal = base[..., None] + scale[..., None] * (axes @ bvecs.T) ** 2
+    signal[..., 0] = 3.0
+    return signal.astype("f4")
+
+
+@pytest.fixture(params=["nii", "nii.gz", "nrrd-raw", "nrrd-gzip"])
+def dense(request, tmp_path):
+    bvals, bvecs = _get_gradients()
+    data = _get_signal(bvecs)
+    extension, _, encoding = request.param.partition("-")
+    image_path = str(tmp_path / "dense.{}".format(extension))
+    if extension == "nrrd":
+        keys = dict(k.split(":=") for k in get_gradient_keys(bvals, bvecs))
+        save_image(data, image_path, encoding=encoding, **keys)
+    else:
+        save_image(data, image_path)
+        save_gradient_table(image_path, bvals, bvecs)
+    return image_path, data, bvals, bvecs
+
+
+def test_load_gradient_table(dense):
+    image_path, _, bvals, bvecs = dense
+
+    loaded_bvals, loaded_bvecs = load_gradient_table(image_path)
+
+    np.testing.assert_allclose(loaded_bvals, bvals)
+    np.testing.assert_allclose(loaded_bvecs, bvecs, atol=1e-6)
+
+
+def test_match_nearest(dense):
+    image_path, _, bvals, bvecs = dense
+    subsampler = GradientSubsampler(image_path)
+    perturbed = bvecs[_SCHEME] + 0.01
+
+    mapping, out_bvals, out_bvecs = subsampler.match(
+        bvals[_SCHEME] + 20, perturbed
+    )
+
+    assert mapping.shape == (len(_SCHEME), _N_DENSE + 1)
+    np.testing.assert_array_equal(np.argmax(mapping, axis=1), _SCHEME)
+    np.testing.assert_array_equal(mapping.sum(axis=1), 1)
+    np.testing.assert_allclose(out_bvals, bvals[_SCHEME])
+    np.testing.assert_allclose(out_bvecs, bvecs[_SCHEME], atol=1e-6)
+
+
+def test_match_outside_shells(dense):
+    image_path, _, _, bvecs = dense
+
+    with pytest.raises(ValueError):
+        GradientSubsampler(image_path).match([3000], bvecs[1:2])
+
+
+def test_extract_nearest(tmp_path, dense, monkeypatch):
+    image_path, data, bvals, bvecs = dense
+    subsampler = GradientSubsampler(image_path, chunk_bytes=_CHUNK_BYTES)
+    passes = []
+    iter_slabs = subsampler.image.iter_slabs
+    monkeypatch.setattr(
+        subsampler.image,
+        "iter_slabs",
+        lambda step: passes.append(step) or iter_slabs(step),
+    )
+    output = str(tmp_path / "scheme.{}".format(subsampler.image.extension))
+
+    out_bvals, out_bvecs = subsampler.extract(
+        bvals[_SCHEME], bvecs[_SCHEME], output
+    )
+
+    np.testing.assert_array_equal(load_image(output), data[..., _SCHEME])
+    assert len(passes) == (1 if subsampler.image.compressed else 0)
+    loaded_bvals, loaded_bvecs = load_gradient_table(output)
+    np.testing.assert_allclose(loaded_bvals, out_bvals)
+    np.testing.assert_allclose(loaded_bvecs, out_bvecs, atol=1e-6)
+    np.testing.assert_allclose(out_bvecs, bvecs[_SCHEME], atol=1e-6)
+
+
+def test_extract_spherical_harmonics(tmp_path, dense):
+    image_path, _, bvals, _ = dense
+    subsampler = GradientSubsampler(image_path, chunk_bytes=_CHUNK_BYTES)
+    directions = np.random.default_rng(3).normal(size=(10, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, None]
+    scheme_bvecs = np.concatenate([np.zeros((1, 3)), directions])
+    output = str(tmp_path / "scheme.{}".format(subsampler.image.extension))
+
+    out_bvals, out_bvecs = subsampler.extract(
+        bvals[:11],
+        scheme_bvecs,
+        output,
+        Method.SPHERICAL_HARMONICS,
+        sh_rank=4,
+        regularization=0,
+    )
+
+    np.testing.assert_allclose(out_bvals, bvals[:11])
+    np.testing.assert_allclose(out_bvecs, scheme_bvecs)
+    np.testing.assert_allclose(
+        load_image(output), _get_signal(scheme_bvecs), rtol=1e-5
+    )
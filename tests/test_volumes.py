@@ -0,0 +1,112 @@
+from os import path
+
+import nrrd
+import numpy as np
+import pytest
+
+from simulator.runner.volumes import Volume, VolumeWriter, merge_volumes
+from tests.helpers import load_image, save_image
+
+
+_LAYOUTS = {
+    "nii": ("nii", None),
+    "nii.gz": ("nii.gz", None),
+    "nrrd-raw": ("nrrd", {"encoding": "raw"}),
+    "nrrd-gzip": ("nrrd", {"encoding": "gzip"}),
+    "nrrd-vector-first-raw": (
+        "nrrd",
+        {"encoding": "raw", "kinds": ["vector", "domain", "domain", "domain"]},
+    ),
+    "nrrd-vector-first-gzip": (
+        "nrrd",
+        {
+            "encoding": "gzip",
+            "kinds": ["vector", "domain", "domain", "domain"],
+        },
+    ),
+}
+
+
+@pytest.fixture(scope="module")
+def data():
+    return np.random.default_rng(0).normal(size=(7, 5, 4, 9)).astype("f4")
+
+
+@pytest.fixture(params=list(_LAYOUTS))
+def image(request, tmp_path, data):
+    extension, header = _LAYOUTS[request.param]
+    file_path = str(tmp_path / "{}.{}".format(request.param, extension))
+    header = header if header else {}
+    if "kinds" in header:
+        data = np.moveaxis(data, -1, 0)
+    return save_image(data, file_path, **header)
+
+
+def test_shape(image, data):
+    volume = Volume(image)
+    assert volume.shape == data.shape
+    assert volume.dtype == data.dtype
+    assert volume.compressed == ("gz" in path.basename(image))
+
+
+def test_read(image, data):
+    volume = Volume(image)
+    np.testing.assert_array_equal(volume.read(2, 6), data[..., 2:6])
+
+
+@pytest.mark.parametrize(
+    "indexes, region",
+    [
+        ([0], ()),
+        ([8, 0, 3, 3, 4], ()),
+        ([-1, 5, 6], (slice(1, 5), slice(None), slice(2, 3))),
+        ([7, 2], (slice(0, 1),)),
+    ],
+)
+def test_take(image, data, indexes, region):
+    volume = Volume(image)
+    full = region + (slice(None),) * (3 - len(region))
+    np.testing.assert_array_equal(
+        volume.take(indexes, region), data[full + (indexes,)]
+    )
+
+
+def test_take_out_of_range(image):
+    with pytest.raises(IndexError):
+        Volume(image).take([9])
+
+
+@pytest.mark.parametrize("step", [1, 4, 9])
+def test_iter_slabs(image, data, step):
+    slabs = list(Volume(image).iter_slabs(step))
+    assert [(start, stop) for start, stop, _ in slabs] == [
+        (s, min(s + step, 9)) for s in range(0, 9, step)
+    ]
+    np.testing.assert_array_equal(
+        np.concatenate([slab for _, _, slab in slabs], axis=-1), data
+    )
+
+
+def test_writer(image, data, tmp_path):
+    reference = Volume(image)
+    output = str(tmp_path / "written.{}".format(reference.extension))
+    with VolumeWriter(output, data.shape, "f8", reference) as writer:
+        for _, _, slab in reference.iter_slabs(4):
+            writer.write(slab)
+
+    np.testing.assert_array_equal(load_image(output), data)
+    if reference.format == "nrrd" and "kinds" in reference.header:
+        kinds = nrrd.read_header(output)["kinds"]
+        assert kinds == ["domain", "domain", "domain", "vector"]
+
+
+def test_merge_volumes(tmp_path, data):
+    sources = [
+        save_image(data[..., indexes], str(tmp_path / "{}.nii.gz".format(i)))
+        for i, indexes in enumerate([[0, 2, 4, 6, 8], [1, 3, 5, 7]])
+    ]
+    merged = str(tmp_path / "merged.nii.gz")
+
+    merge_volumes(sources, [[0, 2, 4, 6, 8], [1, 3, 5, 7]], merged)
+
+    np.testing.assert_array_equal(load_image(merged), data)